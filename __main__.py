@@ -1,11 +1,22 @@
-from octoprintcommunication import OctoPrintClient
+from fleetpolling import FleetPoller
+from printerlist import getClientSettings, getCacheSettings, loadPrinterList, createClient, updateClient
+from printerlist import createResponseCache
+from commandingestion import CommandIngestor, CommandRouter, runPrinterCommand
+from pollscheduler import PollScheduler
+from coordinator import Coordinator
+from filewatch import FileWatcher
+from connectionmanager import ConnectionManager
+from statestore import StateStore
+from tcpcommunication import CommandServer
+from jobdispatcher import JobDispatcher
+from timeseries import SeriesRecorder
+from statusexport import CsvStatusWriter, MmapStatusWriter
 from pathlib import Path
-from time import sleep
+from time import sleep, time
 import configparser
+import sqlite3
 import logging
-import pandas
-import json
-import csv
+import metrics
 import sys
 
 '''
@@ -24,43 +35,115 @@ opcs = list()                                                   # For storing al
 path_ListOfPrinters = Path(config['Paths']['ListOfPrinters'])   # Path to the list of printer IPs / API keys
 path_PrinterStatus = Path(config['Paths']['PrinterStatus'])     # Path to where to export the printer status
 path_PrinterCommands = Path(config['Paths']['PrinterCommands']) # Path to printer commands from the IPC
+path_CommandSpool = config.get('Paths', 'CommandSpool', fallback='')   # Optional directory of command files
 path_Log = Path(config['Paths']['Log'])                         # Where to write the error log
 verbose = config['Settings'].getboolean('Verbose')              # Toggle whether to print all responses to console
 timeoutThreshold = int(config['Settings']['HTTP_timeout'])      # HTTP timeout threshold in seconds
 cycleTime = int(config['Settings']['CycleTime'])                #
 startupAutoConnect = config['Settings'].getboolean('StartupAutoConnect') # Autoconnect to printers when starting script
+connectDeadline = config['Settings'].getfloat('ConnectDeadline', fallback=30)  # Seconds to wait for a printer to connect
+pollWorkers = config['Settings'].getint('PollWorkers', fallback=8)     # Max number of printers queried concurrently
+hotReload = config['Settings'].getboolean('HotReload', fallback=True)  # Reload ListOfPrinters.csv/config.ini on change
+
+clientSettings = getClientSettings(config)                      # Timeout, pool and retry settings for every client
+cacheSettings = getCacheSettings(config)                        # Response cache size and TTLs, None if disabled
+pushEnabled = config.getboolean('Push', 'Enabled', fallback=False)        # Subscribe to OctoPrint's push API
+pushStaleTimeout = config.getint('Push', 'StaleTimeout', fallback=60)     # Seconds of silence before a stream is dropped
+pushReconnectDelay = config.getint('Push', 'ReconnectDelay', fallback=5)  # Seconds between reconnection attempts
+
+path_PrinterStatusBinary = Path(config.get('Paths', 'PrinterStatusBinary', fallback='PrinterStatus.bin'))
+exportBackends = [backend.strip().lower() for backend in config.get('Export', 'Backends', fallback='csv').split(',')]
+binarySlots = config.getint('Export', 'BinarySlots', fallback=64)       # Number of printer records in the binary file
+csvEngine = config.get('Settings', 'CsvEngine', fallback='builtin')     # CSV parser: builtin or pandas
+truncateCommands = config.getboolean('Settings', 'ClearCommandsWhenRead', fallback=True)
+
+metricsEnabled = config.getboolean('Metrics', 'Enabled', fallback=False)  # Collect timing metrics
+metricsPort = config.getint('Metrics', 'Port', fallback=0)                # Local /metrics endpoint (0 = off)
+path_MetricsSnapshot = config.get('Metrics', 'SnapshotFile', fallback='') # Periodic metrics file (empty = off)
+metricsSnapshotInterval = config.getfloat('Metrics', 'SnapshotInterval', fallback=60)
+lastMetricsSnapshot = 0                                         # Time the metrics snapshot file was last written
+recorderEnabled = config.getboolean('Recorder', 'Enabled', fallback=False) # Record temperature/progress history
+stateEnabled = config.getboolean('State', 'Enabled', fallback=False)      # Keep printer state across restarts
+tcpEnabled = config.getboolean('TCP', 'Enabled', fallback=False)          # Serve commands and status over TCP
+stateMaxAge = config.getfloat('State', 'MaxAge', fallback=3600)           # Max age of a stored status to publish at startup
+schedulerEnabled = config.getboolean('Scheduler', 'Enabled', fallback=False) # Poll each printer at its own interval
+coordinatorEnabled = config.getboolean('Coordinator', 'Enabled', fallback=False) # Poll shards of racks in worker processes
+dispatcherEnabled = config.getboolean('Dispatcher', 'Enabled', fallback=False)   # Queue print jobs for any free printer
+
+schedulerSettings = None                                        # Keyword arguments for PollScheduler
+if schedulerEnabled:
+    schedulerSettings = {"fastInterval": config.getfloat('Scheduler', 'FastInterval', fallback=1),
+                         "normalInterval": cycleTime,
+                         "idleInterval": config.getfloat('Scheduler', 'IdleInterval', fallback=15),
+                         "maxBackoff": config.getfloat('Scheduler', 'MaxBackoff', fallback=300),
+                         "nearCompletion": config.getfloat('Scheduler', 'NearCompletion', fallback=90)}
+
+# Objects the main loop works with. They are created by setup() when the script is run, not on import, as the
+# coordinator's worker processes import this module again.
+poller = None                                                   # Thread pool used to query all printers in parallel
+latestStatus = dict()                                           # Latest PrinterStatus of each printer, by IP address
+connectionManager = None                                        # Tracks printers still connecting
+scheduler = None                                                # Decides when each printer is polled next
+recorder = None                                                 # Stores temperature and progress time series
+stateStore = None                                               # Stores printer state for a warm restart
+responseCache = None                                            # File and profile responses, shared by all clients
+jobDispatcher = None                                            # Hands print jobs without a target to free printers
+commandIngestor = None                                          # Reads new commands from the IPC
+router = None                                                   # Queues commands for each printer by IP address
+commandServer = None                                            # TCP command and status server, started in main
+printerListWatcher = None                                       # Watch the printer list and settings for changes, so
+configWatcher = None                                            # they can be applied without restarting the script
+statusWriters = list()                                          # Status export backends, handed every cycle's status
+
+# Settings that are applied while running. Any other change to config.ini only takes effect after a restart.
+liveSettings = {('settings', 'verbose'), ('settings', 'cycletime'), ('settings', 'http_timeout'),
+                ('settings', 'pollworkers'), ('settings', 'hotreload'), ('settings', 'connectdeadline'),
+                ('http', 'jobrefreshinterval'), ('http', 'progressrefreshinterval'), ('scheduler', 'fastinterval'),
+                ('scheduler', 'idleinterval'), ('scheduler', 'maxbackoff'), ('scheduler', 'nearcompletion'),
+                ('cache', 'filesttl'), ('cache', 'profilesttl'), ('upload', 'timeout')}
 
-# Set up logger
-logging.basicConfig(filename=path_Log, level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
 logger = logging.getLogger(__name__)
 
-def inferCsvFormat(path_csv):
+def setup():
     '''
-    Find the delimiter/separation string used in a CSV, then set the data/column header position.
-    Returns: delimiter sign (string), which row number to read headers from (int)
+    Set up the log, and create the poller, scheduler, status writers, command ingestor and the other objects the
+    main loop works with.
     '''
-    with open(path_csv, 'r') as csvfile:
-
-        # Infer delimiter data automatically based on first line
-        dialect = csv.Sniffer().sniff(csvfile.readline(), [',', ';'])
-        csvfile.seek(0) # Return to first line of file for next read operation.
-        delimiter = dialect.delimiter
-        header = 0
-
-        csvData = csv.reader(csvfile)
-        csvDataList = list(csvData)
-        if verbose:
-            print("Opening " + str(path_csv) + " with delimiter=" + delimiter)
-
-        # If the first line contains Excel separator data, use that instead, then use next line as header
-        if csvDataList[0][0] == "sep=;":
-            delimiter = ";"
-            header = 1
-        elif csvDataList[0][0] == "sep=,":
-            delimiter = ","
-            header = 1
-
-        return (delimiter, header)
+    global poller, connectionManager, scheduler, recorder, stateStore, responseCache, jobDispatcher
+    global commandIngestor, router, printerListWatcher, configWatcher
+
+    logging.basicConfig(filename=path_Log, level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    logging.getLogger("urllib3").setLevel(logging.ERROR)        # Connection retries are logged by the clients instead
+
+    poller = FleetPoller(pollWorkers)
+    connectionManager = ConnectionManager(pollWorkers, connectDeadline, verbose=verbose)
+    responseCache = createResponseCache(cacheSettings)
+    if dispatcherEnabled:
+        jobDispatcher = JobDispatcher(config.get('Dispatcher', 'QueueFile', fallback='JobQueue.json'),
+                                      config.getfloat('Dispatcher', 'StartTimeout', fallback=60),
+                                      config.getint('Dispatcher', 'MaxAttempts', fallback=3), verbose)
+    if stateEnabled:
+        stateStore = StateStore(config.get('State', 'File', fallback='PrinterState.db'),
+                                config.getfloat('State', 'CheckpointInterval', fallback=300))
+    if recorderEnabled:
+        recorder = SeriesRecorder(config.get('Recorder', 'Directory', fallback='History'),
+                                  config.getfloat('Recorder', 'SampleInterval', fallback=10),
+                                  config.getfloat('Recorder', 'FlushInterval', fallback=60),
+                                  config.getint('Recorder', 'SegmentSize', fallback=262144),
+                                  config.getint('Recorder', 'MaxSegments', fallback=8))
+    if schedulerSettings is not None:
+        scheduler = PollScheduler(**schedulerSettings)
+    commandIngestor = CommandIngestor(path_PrinterCommands, path_spool=path_CommandSpool or None,
+                                      truncateWhenDrained=truncateCommands)
+    router = CommandRouter(opcs)
+
+    printerListWatcher = FileWatcher(path_ListOfPrinters)
+    configWatcher = FileWatcher('config.ini')
+
+    if "csv" in exportBackends:
+        statusWriters.append(CsvStatusWriter(path_PrinterStatus))    # Publishes the status CSV atomically
+    if "binary" in exportBackends:
+        statusWriters.append(MmapStatusWriter(path_PrinterStatusBinary, binarySlots)) # Memory-mapped binary records
 
 def importPrinterList():
     '''
@@ -70,210 +153,529 @@ def importPrinterList():
         "ipAddress", "apiKey", "username", "password". The delimiter sign is automatically inferred (, or ;).
     All valid rows are used to create OctoPrintClient objects, which are then stored in a list.
     '''
-    global ipList
-    global apiList
-    global usernameList
-    global passwordList
     try:
-
-        delimiter, header = inferCsvFormat(path_ListOfPrinters)
-
-        # Read csv to Pandas dataframe using first row as headers
-        dataframe = pandas.read_csv(path_ListOfPrinters, sep=delimiter, header=header)
-        ipList = list(dataframe.ipAddress)
-        apiList = list(dataframe.apiKey)
-        usernameList = list(dataframe.username)
-        passwordList = list(dataframe.password)
-        rackIDlist = list(dataframe.rackID)
-        xPosList = list(dataframe.xPos)
-        yPosList = list(dataframe.yPos)
+        # Sniff the delimiter and parse the rows in one pass, using the first relevant row as headers
+        printerList = loadPrinterList(path_ListOfPrinters, csvEngine)
+        if verbose:
+            print("Read " + str(len(printerList)) + " printers from " + str(path_ListOfPrinters))
 
         # Create an OPC instance for every element in the List Of Printers
-        for i in range(len(ipList)):
-            opcs.append(OctoPrintClient(ipList[i], apiList[i], usernameList[i], passwordList[i],
-                                        rackIDlist[i], xPosList[i], yPosList[i],
-                                        path_log=path_Log, timeout=timeoutThreshold, verbose=True))
+        for printer in printerList:
+            opcs.append(createClient(printer, clientSettings, responseCache=responseCache))
 
     except Exception as e:
         logger.error(e)
         if verbose:
             print("ListOfPrinters.csv may be missing or of invalid format")
 
+def reloadPrinterList():
+    '''
+    Apply changes to ListOfPrinters.csv while running. Printers are matched by IP address: new printers get a
+    client, removed printers have theirs closed, and edited rows (API key, user, rack, position) update the
+    existing client in place. Clients of unchanged printers are not touched, so sessions and finished flags are kept.
+    '''
+    try:
+        # A file that is being edited may be read half-written, so one bad row keeps all current printers
+        printerList = loadPrinterList(path_ListOfPrinters, csvEngine, strict=True)
+    except Exception as e:
+        logger.error("ListOfPrinters.csv could not be reloaded, keeping the current printers: " + str(e))
+        return
+    if not printerList:
+        logger.error("ListOfPrinters.csv has no printers, keeping the current printers")
+        return
+
+    currentClients = {opc.ipAddress: opc for opc in opcs}
+    newPrinters = [printer for printer in printerList if printer['ipAddress'] not in currentClients]
+    try:
+        newClients = {printer['ipAddress']: createClient(printer, clientSettings, responseCache=responseCache)
+                      for printer in newPrinters}
+    except Exception as e:
+        logger.error("ListOfPrinters.csv could not be reloaded, keeping the current printers: " + str(e))
+        return
+
+    clients = []
+    added, updated = [], []
+    for printer in printerList:
+        opc = currentClients.pop(printer['ipAddress'], None)
+        if opc is None:
+            opc = newClients[printer['ipAddress']]
+            if pushEnabled:
+                opc.subscribe(staleTimeout=pushStaleTimeout, reconnectDelay=pushReconnectDelay)
+            added.append(opc)
+        elif updateClient(opc, printer):
+            # The push stream logged in with the old credentials and carries the old rack position
+            if opc.pushStream is not None:
+                opc.unsubscribe()
+                opc.subscribe(staleTimeout=pushStaleTimeout, reconnectDelay=pushReconnectDelay)
+            latestStatus.pop(opc.ipAddress, None)
+            updated.append(opc)
+        clients.append(opc)
+
+    for opc in currentClients.values():
+        connectionManager.forget(opc)
+        opc.unsubscribe()
+        opc.close()
+        latestStatus.pop(opc.ipAddress, None)
+        if responseCache is not None:
+            responseCache.invalidate("http://" + opc.ipAddress + "/")
+
+    opcs[:] = clients
+    router.setClients(opcs)
+    if commandServer is not None:
+        commandServer.setAddresses(opc.ipAddress for opc in opcs)
+    if scheduler is not None:
+        scheduler.setClients(opcs)
+        for opc in updated:
+            scheduler.pollNow(opc)
+    if startupAutoConnect and added:
+        connectionManager.connect(added)
+
+    msg = ("Reloaded ListOfPrinters.csv: " + str(len(added)) + " added, " + str(len(currentClients)) +
+           " removed, " + str(len(updated)) + " updated")
+    logger.info(msg)
+    if verbose:
+        print(msg)
+
+def reloadConfig():
+    '''
+    Apply changes to config.ini while running. Settings in liveSettings are applied right away, and changes to
+    any other setting are logged as needing a restart.
+    '''
+    global config, verbose, timeoutThreshold, cycleTime, pollWorkers, poller, clientSettings, hotReload
+    newConfig = configparser.ConfigParser()
+    try:
+        newConfig.read('config.ini')
+        newVerbose = newConfig['Settings'].getboolean('Verbose')
+        newTimeout = int(newConfig['Settings']['HTTP_timeout'])
+        newCycleTime = int(newConfig['Settings']['CycleTime'])
+        newPollWorkers = newConfig['Settings'].getint('PollWorkers', fallback=8)
+        newHotReload = newConfig['Settings'].getboolean('HotReload', fallback=True)
+        newClientSettings = getClientSettings(newConfig)
+    except Exception as e:
+        logger.error("config.ini could not be reloaded, keeping the current settings: " + str(e))
+        return
+
+    oldSettings = {(section.lower(), key): value for section in config.sections()
+                   for key, value in config[section].items()}
+    newSettings = {(section.lower(), key): value for section in newConfig.sections()
+                   for key, value in newConfig[section].items()}
+    restartSettings = sorted(section + "/" + key for (section, key) in set(oldSettings) | set(newSettings)
+                             if (section, key) not in liveSettings and
+                             oldSettings.get((section, key)) != newSettings.get((section, key)))
+
+    verbose, timeoutThreshold, cycleTime, hotReload = newVerbose, newTimeout, newCycleTime, newHotReload
+    clientSettings = newClientSettings
+    for opc in opcs:
+        opc.timeout = clientSettings["timeout"]
+        opc.uploadTimeout = clientSettings["uploadTimeout"]
+        opc.jobRefreshInterval = clientSettings["jobRefreshInterval"]
+        opc.progressRefreshInterval = clientSettings["progressRefreshInterval"]
+    connectionManager.deadline = newConfig['Settings'].getfloat('ConnectDeadline', fallback=30)
+    connectionManager.verbose = verbose
+    if newPollWorkers != pollWorkers:
+        oldPoller = poller
+        pollWorkers = newPollWorkers
+        poller = FleetPoller(pollWorkers)
+        oldPoller.shutdown()
+        connectionManager.setMaxWorkers(pollWorkers)
+    if scheduler is not None:
+        scheduler.fastInterval = newConfig.getfloat('Scheduler', 'FastInterval', fallback=1)
+        scheduler.normalInterval = cycleTime
+        scheduler.idleInterval = newConfig.getfloat('Scheduler', 'IdleInterval', fallback=15)
+        scheduler.maxBackoff = newConfig.getfloat('Scheduler', 'MaxBackoff', fallback=300)
+        scheduler.nearCompletion = newConfig.getfloat('Scheduler', 'NearCompletion', fallback=90)
+    newCacheSettings = getCacheSettings(newConfig)
+    if responseCache is not None and newCacheSettings is not None:
+        responseCache.ttls = newCacheSettings["ttls"]
+    config = newConfig
+
+    msg = "Reloaded config.ini"
+    if restartSettings:
+        msg += ". Changes to " + ", ".join(restartSettings) + " take effect after a restart"
+    logger.info(msg)
+    if verbose:
+        print(msg)
+
+def checkForChanges():
+    '''
+    Reload config.ini and ListOfPrinters.csv if they have been edited. Costs one stat() per file when unchanged.
+    '''
+    if not hotReload:
+        return
+    if configWatcher.hasChanged():
+        reloadConfig()
+    if printerListWatcher.hasChanged():
+        reloadPrinterList()
+
+def restoreState():
+    '''
+    Warm start: restore the finished flags, poll failures and last status of every printer from the state store,
+    and publish the status right away, before any printer has been polled.
+    Stored statuses older than stateMaxAge seconds are not published, but the finished flags are always restored.
+    '''
+    try:
+        savedState = stateStore.load()
+    except sqlite3.Error as e:
+        logger.error("Printer state could not be restored: " + str(e))
+        return
+
+    restored = 0
+    for opc in opcs:
+        printerState = savedState.get(opc.ipAddress)
+        if printerState is None:
+            continue
+        opc.printFinished = printerState["printFinished"]
+        if scheduler is not None and printerState["failures"]:
+            scheduler.failures[opc.ipAddress] = printerState["failures"]
+        status = printerState["status"]
+        lastSeen = printerState["lastSeen"]
+        if status is not None and lastSeen is not None and time() - lastSeen <= stateMaxAge:
+            # The rack position may have been edited in ListOfPrinters.csv since
+            status.rackID, status.xPos, status.yPos = opc.rackID, opc.xPos, opc.yPos
+            status.printFinished = opc.printFinished
+            latestStatus[opc.ipAddress] = status
+            restored += 1
+
+    opcSnapshots = [latestStatus.get(opc.ipAddress) or opc.getEmptyStatus() for opc in opcs]
+    for statusWriter in statusWriters:
+        try:
+            statusWriter.write(opcSnapshots)
+        except Exception as e:
+            logger.error(e)
+    if commandServer is not None:
+        commandServer.publishStatus(opcSnapshots)
+    msg = "Restored state of " + str(len(savedState)) + " printers, published " + str(restored) + " stored statuses"
+    logger.info(msg)
+    if verbose:
+        print(msg)
+
+def saveState():
+    '''
+    Write the state of every printer that has changed to the state store.
+    '''
+    if stateStore is None:
+        return
+    try:
+        for opc in opcs:
+            stateStore.update(opc.ipAddress, latestStatus.get(opc.ipAddress), opc.printFinished,
+                              scheduler.failures.get(opc.ipAddress, 0) if scheduler is not None else None)
+        stateStore.commit([opc.ipAddress for opc in opcs])
+    except sqlite3.Error as e:
+        logger.error("Printer state could not be saved: " + str(e))
+
+def getFleetConnectionStats():
+    '''
+    Sum up the connection counters of all clients.
+    Returns a dictionary with the number of HTTP connections opened and reused across the fleet.
+    '''
+    fleetStats = {"opened": 0, "reused": 0, "requests": 0}
+    for opc in opcs:
+        for key, value in opc.getConnectionStats().items():
+            fleetStats[key] += value
+    return fleetStats
+
 def connectToPrinters():
     '''
-    Autoconnect the Pis to their respective printers (over USB)
+    Autoconnect the Pis to their respective printers (over USB).
+    Returns right away. Printers are held back from polling and commands until they are Operational.
+    '''
+    connectionManager.connect(opcs)
 
+def releaseConnectedPrinters():
     '''
-    for i, opc in enumerate(opcs):
-        if verbose:
-            print("Attempting to connect to " + opc.ipAddress)
-        if not opc.isPrinterConnected():
-            response = opc.connectToPrinter()
-            if verbose:
-                print("HTTP " + str(response))
-        else:
-            if verbose:
-                print("Already connected.")
+    Check on the printers that are connecting, and poll the ones that are done right away.
+    '''
+    for opc in connectionManager.update():
+        if scheduler is not None:
+            scheduler.pollNow(opc)
 
-def updatePrinterStatus():
+def pollPrinter(opc):
     '''
-    Read status from all available printers. Write each printer's status as a row in a CSV file.
-    Also, for testing purposes, write each printer's status to a separate txt file.
+    Query a single printer for its current status.
+    Pis that failed their last poll are first probed with a plain TCP connection, which is much cheaper than
+    letting a full HTTP request time out.
+    Returns a PrinterStatus object, which is empty if the printer could not be queried.
     '''
+    try:
+        if scheduler is not None and scheduler.isBackedOff(opc) and not opc.isReachable():
+            return opc.getEmptyStatus()
+        return opc.getSnapshot()
+    except Exception as e:
+        logger.error(opc.ipAddress + " status poll failed: " + str(e))
+        return opc.getEmptyStatus()
 
+def updatePrinterStatus(duePrinters=None):
+    '''
+    Read status from the printers in duePrinters (default: all printers), and keep it as their latest status.
+    Export the latest status of every printer through every configured backend (CSV, binary).
+    The printers are queried concurrently by the FleetPoller, so a full cycle takes about as long as the slowest printer.
+    '''
+    if duePrinters is None:
+        duePrinters = opcs
+    heldBack = [opc for opc in duePrinters if connectionManager.isHeldBack(opc)]
+    if heldBack:
+        # Printers that are still connecting are polled once they are ready, or at their deadline at the latest
+        duePrinters = [opc for opc in duePrinters if not connectionManager.isHeldBack(opc)]
+        if scheduler is not None:
+            for opc in heldBack:
+                scheduler.schedule(opc.ipAddress, connectionManager.getDeadline(opc))
     try:
-        # Row header structure:
-        # [IP]; [connected]; [printing]; [ready]; [operational]; [pausing]; [paused]; [finished]; [nozzle temp]; [bed temp]; [print job]; [rack ID]; [X pos]; [Y pos]
-        opcStatusFields = ("IP;Connected;Printing;Ready;Operational;Pausing;Paused;Finished;NozzleTemp;BedTemp;PrintJob;RackID;Xpos;Ypos\n")
-
-        # Set up status CSV & txt
-        statusCsv = open(path_PrinterStatus, 'w+')  # Clear file before writing
-        statusCsv.write(opcStatusFields)            # Add headers
-
-        # Create status string for each connected printer
-        for i, opc in enumerate(opcs):
-            printerIsConnected = opc.isPrinterConnected()
-            if printerIsConnected:
-                opcStatus = opc.getPrinterStatus()
-                opcSJ = json.loads(opcStatus)
-                opcCurrentPrintJob = json.loads(opcs[0].getCurrentPrintJob())
-
-                # The "finished"-status is a local variable in the client object.
-                # It is only set when "finishing" is true, at the end of each print job.
-                # It is reset by the printer command [printerIP , currentPrint, retrieved]
-                if "true" in str(opcSJ['state']['flags']['finishing']):
-                    opc.printFinished = "true"
-
-                opcStatusString =   (
-                                    str(opc.ipAddress)                              + ';' +
-                                    str(printerIsConnected)                         + ';' +
-                                    str(opcSJ['state']['flags']['printing'])        + ';' +
-                                    str(opcSJ['state']['flags']['ready'])           + ';' +
-                                    str(opcSJ['state']['flags']['operational'])     + ';' +
-                                    str(opcSJ['state']['flags']['pausing'])         + ';' +
-                                    str(opcSJ['state']['flags']['paused'])          + ';' +
-                                    opc.printFinished                               + ';' +
-                                    str(opcSJ['temperature']['bed']['actual'])      + ';' +
-                                    str(opcSJ['temperature']['tool0']['actual'])    + ';' +
-                                    str(opcCurrentPrintJob['job']['file']['name'])  + ';' +
-                                    str(opc.rackID)                                 + ';' +
-                                    str(opc.xPos)                                   + ';' +
-                                    str(opc.yPos)
-                                    )
-            else:
-                opcStatus = "Not connected to Pi!"
-                opcStatusString =   (
-                                    str(opc.ipAddress) + ";" +
-                                    str(printerIsConnected) + ";" +
-                                    ';' +
-                                    ';' +
-                                    ';' +
-                                    ';' +
-                                    ';' +
-                                    ';' +
-                                    ';' +
-                                    ';' +
-                                    ';' +
-                                    ';' +
-                                    ';' +
-                                    ';'
-                                    )
-
-            # Append status string to CSV & txt
-            statusCsv.write(opcStatusString + "\n")
-            # Print responses if the verbose debugging variable is set to true
+        requestsBefore = sum(opc.requestCount for opc in opcs)
+
+        # Query every printer before touching the file, so it is not held open while waiting for the network
+        with metrics.timer("opc_phase_seconds", phase="poll"):
+            polledSnapshots = poller.poll(duePrinters, pollPrinter)
+        for opc, opcSnapshot in zip(duePrinters, polledSnapshots):
+            latestStatus[opc.ipAddress] = opcSnapshot
+            if scheduler is not None:
+                scheduler.reschedule(opc, opcSnapshot)
+            if recorder is not None:
+                recorder.record(opcSnapshot)
+
+        opcSnapshots = [latestStatus.get(opc.ipAddress) or opc.getEmptyStatus() for opc in opcs]
+
+        # Each writer skips the export when nothing has changed since the last cycle
+        for statusWriter in statusWriters:
+            with metrics.timer("opc_phase_seconds", phase="export", backend=type(statusWriter).__name__):
+                written = statusWriter.write(opcSnapshots)
             if verbose:
-                print(opc.ipAddress + " printer status: " + opcStatusString)
-
-        # Close CSV to avoid access issues
-        statusCsv.close()
+                if written:
+                    print(type(statusWriter).__name__ + " exported " + str(statusWriter.lastBytesWritten) +
+                          " bytes in " + str(round(statusWriter.lastWriteLatency * 1000, 2)) + " ms")
+                else:
+                    print(type(statusWriter).__name__ + ": status unchanged, export skipped")
+        if commandServer is not None:
+            commandServer.publishStatus(opcSnapshots)
+
+        # Print responses if the verbose debugging variable is set to true
+        if verbose:
+            for opcSnapshot in opcSnapshots:
+                print(opcSnapshot.ipAddress + " printer status: " + opcSnapshot.toCsvRow())
+            fleetStats = getFleetConnectionStats()
+            print("HTTP connections opened: " + str(fleetStats["opened"]) + ", reused: " + str(fleetStats["reused"]))
+            print("HTTP requests this cycle: " + str(sum(opc.requestCount for opc in opcs) - requestsBefore))
+            if responseCache is not None:
+                cacheStats = responseCache.getStats()
+                print("Response cache: " + str(cacheStats["entries"]) + " entries, hit rate " +
+                      str(round(cacheStats["hitRate"] * 100, 1)) + " %")
 
     except Exception as e:
         logger.error(e)
         if verbose:
             print(e)
+    finally:
+        # Printers the cycle failed to reschedule would never be polled again
+        if scheduler is not None:
+            scheduler.rescheduleFailed(duePrinters)
 
-def getCommandList():
+def runPrinterCommands(opc):
     '''
-    Read and sort CSV containing commands for the printer. The CSV is intended to be written by an IPC.
-    Returns the commands as lists of IP addresses, commands and arguments.
+    Carry out all queued commands for one printer, in the order they were written.
+    Runs in a FleetPoller worker thread, so it must only touch this one client.
+    Returns True if a connect command was sent.
     '''
+    connecting = False
+    for ipAddress, command, argument in router.popCommands(opc.ipAddress):
+        try:
+            if not runPrinterCommand(opc, command, argument, verbose):
+                logger.error(ipAddress + ": unknown command " + command)
+            elif command.lower() == "connect":
+                connecting = True
+
+        except Exception as e:
+            logger.error(ipAddress + " " + command + ": " + str(e))
+            if verbose:
+                print(e)
+    return connecting
 
-    delimiter, header = inferCsvFormat(path_PrinterCommands)
-
-    # Read csv to Pandas dataframe using the first relevant row as headers
-    dataframe = pandas.read_csv(path_PrinterCommands, sep=delimiter, header=header)
-    ipList = list(dataframe.IP_Address)
-    commandList = list(dataframe.Command)
-    argumentList = list(dataframe.Argument)
-
-    # Create a 2D list of command data.
-    outputList = [ipList, commandList, argumentList]
+def runAdminCommands(adminCommands):
+    '''
+    Carry out administrative commands (shutdown, connections), which are not meant for one specific printer.
+    '''
+    for ipAddress, command, argument in adminCommands:
+        # Terminate script remotely
+        if ipAddress.lower() in ("shutdown", "exit"):
+            msg = "Script shut down by external command"
+            logger.info(msg)
+            if verbose:
+                print(msg)
+            saveState()
+            sys.exit()
 
-    open(path_PrinterCommands, 'w').close() # Clear file after parsing it
+        # (Re)connect all Pis to their printers
+        if command.lower() == "connect" and argument.lower() == "all":
+            connectToPrinters()
 
-    return outputList
+def processCommands():
+    '''
+    Read new commands from the IPC, queue them for their printers and carry them out.
+    Only printers with pending commands are visited, and they are handled concurrently.
+    '''
+    try:
+        with metrics.timer("opc_phase_seconds", phase="command_parse"):
+            commands = commandIngestor.poll()
+            if commandServer is not None:
+                commands.extend(commandServer.popCommands())
+            if jobDispatcher is not None:
+                # Jobs without a target printer wait in the queue until a printer is free
+                commands = jobDispatcher.submit(commands, opcs)
+                commands.extend(jobDispatcher.dispatch(
+                    [latestStatus[opc.ipAddress] for opc in opcs if opc.ipAddress in latestStatus],
+                    {opc.ipAddress for opc in opcs if connectionManager.isHeldBack(opc)}, printers=opcs))
+                jobDispatcher.save()
+            adminCommands = router.route(commands)
+        # Commands for printers that are still connecting stay queued until they are ready
+        pendingClients = [opc for opc in router.getPendingClients() if not connectionManager.isHeldBack(opc)]
+        with metrics.timer("opc_phase_seconds", phase="command_dispatch"):
+            connecting = poller.poll(pendingClients, runPrinterCommands)
+
+        for opc, connectSent in zip(pendingClients, connecting):
+            if connectSent:
+                connectionManager.track(opc)
+            elif scheduler is not None:
+                # Commands change the printer state, so poll these printers again right away
+                scheduler.pollNow(opc)
+    except Exception as e:
+        logger.error(e)
+        if verbose:
+            print(e)
+        return
+    runAdminCommands(adminCommands)
 
+def waitForNextCycle(seconds):
+    '''
+    Sleep until the next cycle is due. Commands received over TCP in the meantime are carried out right away.
+    With the scheduler, the commanded printers are due for a poll at once, so the next cycle starts right away too.
+    '''
+    if commandServer is None:
+        sleep(seconds)
+        return
+    endTime = time() + seconds
+    while commandServer.waitForCommands(endTime - time()):
+        processCommands()
+        if scheduler is not None:
+            return
+
+def runCoordinator():
+    '''
+    Hand the printers over to worker processes, one per shard of racks, and coordinate them until shut down.
+    The status export and command file stay with this process.
+    '''
+    settings = {"clientSettings": clientSettings, "pollWorkers": pollWorkers, "cycleTime": cycleTime,
+                "scheduler": schedulerSettings, "pushEnabled": pushEnabled, "pushStaleTimeout": pushStaleTimeout,
+                "pushReconnectDelay": pushReconnectDelay, "startupAutoConnect": startupAutoConnect,
+                "connectDeadline": connectDeadline, "cacheSettings": cacheSettings, "verbose": verbose,
+                "metricsEnabled": metricsEnabled}
+    coordinator = Coordinator(loadPrinterList(path_ListOfPrinters, csvEngine),
+                              config.getint('Coordinator', 'Shards', fallback=0), settings,
+                              statusWriters, commandIngestor, recorder, cycleTime,
+                              config.getfloat('Coordinator', 'HeartbeatTimeout', fallback=60),
+                              config.getfloat('Coordinator', 'RestartDelay', fallback=5), verbose,
+                              stateStore, stateMaxAge, commandServer, jobDispatcher)
+    coordinator.run()
+
+def publishMetrics():
+    '''
+    Count the cycle, and write the metrics snapshot file if it is due.
+    '''
+    global lastMetricsSnapshot
+    if not metrics.enabled:
+        return
+    metrics.increment("opc_cycles_total")
+    if path_MetricsSnapshot and time() - lastMetricsSnapshot >= metricsSnapshotInterval:
+        try:
+            metrics.writeSnapshot(path_MetricsSnapshot)
+        except OSError as e:
+            logger.error(e)
+        lastMetricsSnapshot = time()
 
 
 '''
 MAIN SCRIPT STARTS HERE
 
-From the PrinterCommands.csv, each column (IP, command, argument) is parsed and stored in a list.
-For every cycle, the program checks if there is an IP address matching that of a registered OctoPrint client.
-If there is, the command is read and carried out, using arguments if applicable.
+Every cycle, the printer status is exported, then new rows in PrinterCommands.csv (IP, command, argument) are read.
+Each command is queued for the OctoPrint client with the matching IP address, and carried out.
 '''
-if __name__ == "__main__":
+def main():
+    '''
+    Run the communicator until it is shut down by an external command or the shell is closed.
+    '''
+    global commandServer
+    setup()
+
+    # Timing hooks are only active when metrics are enabled
+    if metricsEnabled:
+        metrics.enable()
+        if metricsPort:
+            metrics.MetricsServer(port=metricsPort).start()
+
+    # Commands and status can be exchanged over TCP as well, with much lower latency than through the files
+    if tcpEnabled:
+        commandServer = CommandServer(config.get('TCP', 'Host', fallback='127.0.0.1'),
+                                      config.getint('TCP', 'Port', fallback=5050),
+                                      config.getint('TCP', 'MaxClients', fallback=64))
+        commandServer.start()
+
+    # On large farms, the printers can be spread over several worker processes instead
+    if coordinatorEnabled:
+        if hotReload:
+            msg = "HotReload is not supported in coordinator mode, changes to config.ini and ListOfPrinters.csv " \
+                  "take effect after a restart"
+            logger.info(msg)
+            if verbose:
+                print(msg)
+        runCoordinator()
+        return
+
     # Upon calling the script, printers are connected to Pis, then ran until the script / shell is closed.
     importPrinterList()  # Must be run first. Otherwise there won't be any OPCs to work with.
+    if commandServer is not None:
+        commandServer.setAddresses(opc.ipAddress for opc in opcs)
+
+    # Publish the last known status right away, and carry finished flags over from the last run
+    if stateStore is not None:
+        restoreState()
+
+    # In push mode, every client keeps its status up to date from OctoPrint's push API, and only falls back to
+    # polling while its stream is down.
+    if pushEnabled:
+        for opc in opcs:
+            opc.subscribe(staleTimeout=pushStaleTimeout, reconnectDelay=pushReconnectDelay)
 
-    # Connection time varies between hardware and network configurations.
-    # Printers will usually take around 10 seconds to establish connection to OctoPrint.
+    # Connection time varies between hardware and network configurations, and printers usually take around
+    # 10 seconds to establish connection to OctoPrint. Polling starts right away for the printers that are ready.
     if startupAutoConnect:
         connectToPrinters()
-        sleep(10)
-
-    while True:
-        updatePrinterStatus()
-        commandList = getCommandList()
-
-        # Parse and run commands
-        for i, opc in enumerate(opcs):
-            ipAddress = commandList[0][i]
-            command = commandList[1][i]
-            argument = commandList[2][i]
-
-            # # # If printer is connected, run commands # # #
-            if opc.isPrinterConnected:
-                if ipAddress == opc.ipAddress:
-
-                    if command.lower() == "print":
-                        selectedFile = argument
-                        # Check if the string actually points to the files directory
-                        if "api/files" in str(selectedFile):
-                            opc.selectPrintJob(selectedFile)
-                            opc.startPrintJob()
-                            print(ipAddress + ": attempting to print: " + selectedFile)
-
-                    # For external applications,
-                    if command == "printRetrieved":
-                        opc.printFinished = "false"
-
-            #Administrative commands (shutdown, settings, connections, debug)
-
-            # Terminate script remotely
-            if "shutdown" or "exit" in ipAddress.lower():
-                msg = "Script shut down by external command"
-                logger.info(msg)
-                if verbose:
-                    print(msg)
-                sys.exit()
-
-            # (Re)connect Pi to printer
-            if command.lower == "connect":
-                if ipAddress == opc.ipAddress:
-                    opc.connectToPrinter()
-                if argument.lower == "all":
-                    connectToPrinters()
-
-        sleep(cycleTime) # Slow down cycle time to reduce congestion, as tasks are not really time sensitive.
+
+    router.setClients(opcs)
+    if scheduler is not None:
+        scheduler.setClients(opcs)
+
+    try:
+        while True:
+            if scheduler is not None:
+                # Only poll the printers that are due. Sleep until the next one is due, or at most one cycle,
+                # so commands are still picked up every cycle.
+                releaseConnectedPrinters()
+                updatePrinterStatus(scheduler.popDue())
+                processCommands()
+                saveState()
+                publishMetrics()
+                checkForChanges()
+                nextDue = scheduler.nextDue()
+                waitForNextCycle(max(0.1, min(cycleTime, nextDue - time() if nextDue is not None else cycleTime)))
+            else:
+                releaseConnectedPrinters()
+                updatePrinterStatus()
+                processCommands()
+                saveState()
+                publishMetrics()
+                checkForChanges()
+                waitForNextCycle(cycleTime) # Slow down cycle time to reduce congestion, as tasks are not really time sensitive.
+    finally:
+        # Samples are only written every FlushInterval, so the last ones would be lost on shutdown
+        if recorder is not None:
+            recorder.flush()
+
+if __name__ == "__main__":
+    main()
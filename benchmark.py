@@ -0,0 +1,502 @@
+import statistics
+import tracemalloc
+import subprocess
+import tempfile
+import argparse
+import timeit
+import time
+import sys
+import csv
+import os
+
+'''
+Benchmarks for the OctoPrintCommunicator script. Run from the script directory:
+    python benchmark.py csv     Startup cost and per-cycle CSV parse cost, builtin reader versus pandas
+    python benchmark.py fleet   Poll cycle time, requests, latency and memory against a simulated farm
+    python benchmark.py status  CPU time and allocations for turning responses into status rows
+    python benchmark.py shards  Printers polled per second by the coordinator, for different numbers of shards
+    python benchmark.py cache   Requests, bytes and time for file and profile data, with and without the cache
+    python benchmark.py dispatch  Farm throughput with jobs assigned to fixed printers versus the job dispatcher
+'''
+
+def timeSubprocess(code, repeat=5):
+    '''
+    Run a snippet of Python in a fresh interpreter repeat times.
+    Returns the median wall time in seconds.
+    '''
+    times = []
+    for i in range(repeat):
+        startTime = timeit.default_timer()
+        subprocess.run([sys.executable, "-c", code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(timeit.default_timer() - startTime)
+    return statistics.median(times)
+
+
+def importMemory(module):
+    '''
+    Import a module in a fresh interpreter and measure how much memory the import allocates.
+    Returns the peak traced memory in bytes.
+    '''
+    code = ("import tracemalloc; tracemalloc.start(); import " + module +
+            "; print(tracemalloc.get_traced_memory()[1])")
+    result = subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return int(result.stdout)
+
+
+def legacyReadCsv(path_csv):
+    '''
+    The parse path used before the builtin reader: sniff the delimiter, parse the whole file to look for an
+    Excel "sep=" line, then parse it again with pandas.
+    '''
+    import pandas
+
+    with open(path_csv, 'r') as csvfile:
+        delimiter = csv.Sniffer().sniff(csvfile.readline(), [',', ';']).delimiter
+        csvfile.seek(0)
+        header = 0
+        csvDataList = list(csv.reader(csvfile))
+        if csvDataList[0][0] == "sep=;":
+            delimiter, header = ";", 1
+        elif csvDataList[0][0] == "sep=,":
+            delimiter, header = ",", 1
+    dataframe = pandas.read_csv(path_csv, sep=delimiter, header=header)
+    return [list(dataframe.IP_Address), list(dataframe.Command), list(dataframe.Argument)]
+
+
+def benchmarkCsv(rows=10, number=200):
+    '''
+    Compare the builtin CSV reader with the legacy pandas path on a command file of the given number of rows.
+    '''
+    from csvreader import readCsvRecords
+
+    print("Startup (fresh interpreter, median of 5 runs)")
+    baseline = timeSubprocess("pass")
+    builtinStartup = timeSubprocess("import csvreader")
+    print("  interpreter only:      %8.1f ms" % (baseline * 1000))
+    print("  import csvreader:      %8.1f ms, %8.1f kB allocated" %
+          (builtinStartup * 1000, importMemory("csvreader") / 1024))
+    try:
+        pandasStartup = timeSubprocess("import pandas")
+        print("  import pandas:         %8.1f ms, %8.1f kB allocated" %
+              (pandasStartup * 1000, importMemory("pandas") / 1024))
+        hasPandas = True
+    except subprocess.CalledProcessError:
+        print("  import pandas:         not installed")
+        hasPandas = False
+
+    with tempfile.TemporaryDirectory() as path_temp:
+        path_csv = os.path.join(path_temp, "PrinterCommands.csv")
+        with open(path_csv, 'w') as csvfile:
+            csvfile.write("sep=;\nIP_Address;Command;Argument\n")
+            for i in range(rows):
+                csvfile.write("192.168.0.%d;print;/api/files/local/part%d.gcode\n" % (i + 1, i))
+
+        print("Parse cost per cycle (" + str(rows) + " rows, mean of " + str(number) + " runs)")
+        builtinParse = timeit.timeit(lambda: readCsvRecords(path_csv), number=number) / number
+        print("  builtin reader:        %8.3f ms" % (builtinParse * 1000))
+        if hasPandas:
+            pandasParse = timeit.timeit(lambda: readCsvRecords(path_csv, 'pandas'), number=number) / number
+            legacyParse = timeit.timeit(lambda: legacyReadCsv(path_csv), number=number) / number
+            print("  pandas reader:         %8.3f ms" % (pandasParse * 1000))
+            print("  legacy (sniff+pandas): %8.3f ms" % (legacyParse * 1000))
+
+
+def percentile(values, fraction):
+    '''
+    Returns the value at the given fraction (0 to 1) of the sorted values, or 0 for an empty list.
+    '''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def benchmarkFleet(sizes=(1, 10, 50, 100, 250, 500), cycles=5, workers=32, latency=0.02, jitter=0.005,
+                   failureRate=0.0, dropRate=0.0, printing=False):
+    '''
+    Poll simulated farms of increasing size, the way the main loop does, and report per-cycle figures.
+    With printing set, every printer is printing, which is when the job info (progress) is fetched most often.
+    Latency is measured per printer, for the whole status snapshot. Memory is the peak allocated while creating
+    the clients and running the first cycle. The simulator runs in the same process, so figures include its cost.
+    '''
+    from octoprintsimulator import OctoPrintSimulator
+    from octoprintcommunication import OctoPrintClient
+    from fleetpolling import FleetPoller
+    import logging
+
+    logging.getLogger("octoprintcommunication").setLevel(logging.CRITICAL)
+    print("%8s %12s %12s %10s %10s %12s" % ("Printers", "Cycle (ms)", "Req/cycle", "p50 (ms)", "p99 (ms)",
+                                             "Memory (kB)"))
+    for size in sizes:
+        simulator = OctoPrintSimulator(size, latency=latency, latencyJitter=jitter, failureRate=failureRate,
+                                       dropRate=dropRate)
+        if printing:
+            for printer in simulator.printers.values():
+                printer.selected = "part.gcode"
+                printer.printStarted = time.time()
+        simulator.start()
+        poller = FleetPoller(workers)
+
+        tracemalloc.start()
+        opcs = [OctoPrintClient(printer["ipAddress"], printer["apiKey"], printer["username"], printer["password"],
+                                printer["rackID"], printer["xPos"], printer["yPos"], timeout=5)
+                for printer in simulator.getPrinterList()]
+        latencies = []
+
+        def pollPrinter(opc):
+            startTime = timeit.default_timer()
+            opc.getSnapshot()
+            latencies.append(timeit.default_timer() - startTime)
+
+        # Warm-up: opens connections and fills the job cache. Memory is traced for this cycle only, as tracing
+        # slows down everything else.
+        poller.poll(opcs, pollPrinter)
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        latencies.clear()
+        requestsBefore = simulator.requestCount
+        cycleTimes = []
+        for cycle in range(cycles):
+            startTime = timeit.default_timer()
+            poller.poll(opcs, pollPrinter)
+            cycleTimes.append(timeit.default_timer() - startTime)
+
+        print("%8d %12.1f %12.1f %10.1f %10.1f %12.1f" % (
+            size, statistics.mean(cycleTimes) * 1000, (simulator.requestCount - requestsBefore) / cycles,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, memory / 1024))
+
+        for opc in opcs:
+            opc.close()
+        poller.shutdown()
+        simulator.stop()
+
+
+def legacyStatusRow(ipAddress, connectionText, printerText, jobText, rackID, xPos, yPos):
+    '''
+    The status path used before PrinterStatus: /api/connection and /api/printer parsed separately,
+    /api/printer parsed twice, and the row built by concatenation.
+    '''
+    import json
+
+    printerIsConnected = json.loads(connectionText)["current"]["state"] in ("Operational", "Printing")
+    json.loads(printerText)
+    opcSJ = json.loads(printerText)
+    opcCurrentPrintJob = json.loads(jobText)
+    return (str(ipAddress)                                      + ';' +
+            str(printerIsConnected)                             + ';' +
+            str(opcSJ['state']['flags']['printing'])            + ';' +
+            str(opcSJ['state']['flags']['ready'])               + ';' +
+            str(opcSJ['state']['flags']['operational'])         + ';' +
+            str(opcSJ['state']['flags']['pausing'])             + ';' +
+            str(opcSJ['state']['flags']['paused'])              + ';' +
+            "false"                                             + ';' +
+            str(opcSJ['temperature']['bed']['actual'])          + ';' +
+            str(opcSJ['temperature']['tool0']['actual'])        + ';' +
+            str(opcCurrentPrintJob['job']['file']['name'])      + ';' +
+            str(rackID)                                         + ';' +
+            str(xPos)                                           + ';' +
+            str(yPos))
+
+
+def benchmarkStatus(printers=100, number=200):
+    '''
+    Compare the legacy status path with PrinterStatus on one cycle of canned responses for the given number of
+    printers. The job info is cached by the client between state changes, so it is not parsed on the new path.
+    '''
+    from octoprintsimulator import SimulatedPrinter
+    from printerstatus import PrinterStatus
+    import json
+
+    simulated = SimulatedPrinter("127.0.0.1", "key", printDuration=600, finishDuration=5)
+    simulated.selected = "part.gcode"
+    simulated.printStarted = time.time()
+    printerText = json.dumps(simulated.getPrinterJson())
+    jobJson = simulated.getJobJson()
+    jobText = json.dumps(jobJson)
+    connectionText = json.dumps({"current": {"state": simulated.getStateText(), "port": "/dev/ttyACM0",
+                                             "baudrate": 115200, "printerProfile": "_default"}, "options": {}})
+    addresses = ["192.168.%d.%d" % (i // 250, i % 250 + 1) for i in range(printers)]
+
+    def legacyCycle():
+        return [legacyStatusRow(ipAddress, connectionText, printerText, jobText, 1, 1, 1) for ipAddress in addresses]
+
+    def statusCycle():
+        rows = []
+        for ipAddress in addresses:
+            status = PrinterStatus(ipAddress, 1, 1, 1)
+            status.updateFromPrinterJson(json.loads(printerText))
+            status.updateFromJobJson(jobJson)
+            rows.append(status.toCsvRow())
+        return rows
+
+    print("Status rows for " + str(printers) + " printers (mean of " + str(number) + " cycles)")
+    print("%-16s %12s %16s %14s" % ("", "Cycle (ms)", "Retained (kB)", "Peak (kB)"))
+    for name, cycle in (("legacy", legacyCycle), ("PrinterStatus", statusCycle)):
+        cycleTime = timeit.timeit(cycle, number=number) / number
+        tracemalloc.start()
+        rows = cycle()
+        allocated, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%-16s %12.3f %16.1f %14.1f" % (name, cycleTime * 1000, allocated / 1024, peak / 1024))
+        del rows
+
+    # The main loop keeps the latest record of every printer, so the record size counts as well
+    class DictStatus:
+        pass
+    dictStatus = DictStatus()
+    for field in PrinterStatus.__slots__:
+        setattr(dictStatus, field, None)
+    print("Record size: %d bytes with __slots__, %d bytes with a __dict__" % (
+        sys.getsizeof(PrinterStatus("192.168.0.1")), sys.getsizeof(dictStatus) + sys.getsizeof(dictStatus.__dict__)))
+
+
+def runSimulator(printerCount, latency, jitter, connection, stopEvent):
+    '''
+    Run a simulated farm in its own process, so it does not compete with the coordinator for the GIL.
+    The printer list is sent back over connection.
+    '''
+    from octoprintsimulator import OctoPrintSimulator
+
+    simulator = OctoPrintSimulator(printerCount, latency=latency, latencyJitter=jitter)
+    simulator.start()
+    connection.send(simulator.getPrinterList())
+    stopEvent.wait()
+    simulator.stop()
+
+
+def benchmarkShards(printers=500, shardCounts=(1, 2, 4), duration=10, workers=32, latency=0.02, jitter=0.005):
+    '''
+    Let the coordinator poll a simulated farm as fast as it can, and report how many printers are polled per second
+    for each number of shards. The simulator runs in a separate process, but shares the cores with the shards.
+    '''
+    from coordinator import Coordinator
+    import multiprocessing
+
+    parentConnection, childConnection = multiprocessing.Pipe()
+    stopEvent = multiprocessing.Event()
+    simulatorProcess = multiprocessing.Process(target=runSimulator, daemon=True,
+                                               args=(printers, latency, jitter, childConnection, stopEvent))
+    simulatorProcess.start()
+    printerList = parentConnection.recv()
+    settings = {"clientSettings": {"timeout": 5}, "pollWorkers": workers, "cycleTime": 0, "scheduler": None,
+                "pushEnabled": False, "pushStaleTimeout": 60, "pushReconnectDelay": 5, "startupAutoConnect": False,
+                "connectDeadline": 30, "verbose": False}
+
+    print(str(printers) + " printers, " + str(os.cpu_count()) + " CPU cores, " + str(duration) + " s per run")
+    print("%8s %18s" % ("Shards", "Polled per second"))
+    for shardCount in shardCounts:
+        coordinator = Coordinator(printerList, shardCount, settings)
+        coordinator.start()
+        coordinator.receive(2)          # Warm-up: start the workers and open the connections
+        polledBefore = coordinator.polledCount
+        startTime = timeit.default_timer()
+        coordinator.receive(duration)
+        rate = (coordinator.polledCount - polledBefore) / (timeit.default_timer() - startTime)
+        coordinator.stop()
+        print("%8d %18.1f" % (len(coordinator.shards), rate))
+
+    stopEvent.set()
+    simulatorProcess.join()
+
+
+def benchmarkCache(printers=100, cycles=20, files=50, workers=32, latency=0.02, jitter=0.005, ttl=60):
+    '''
+    Ask every printer of a simulated farm for its file list, printer profiles and the info of its selected file
+    every cycle, without a cache, with a cache that only revalidates (TTL 0) and with a cache using the given TTL.
+    Every fifth cycle a file is selected on one printer, which invalidates its cached file data.
+    '''
+    from octoprintsimulator import OctoPrintSimulator
+    from octoprintcommunication import OctoPrintClient
+    from responsecache import ResponseCache
+    from fleetpolling import FleetPoller
+    import logging
+
+    logging.getLogger("octoprintcommunication").setLevel(logging.CRITICAL)
+    simulator = OctoPrintSimulator(printers, latency=latency, latencyJitter=jitter)
+    for printer in simulator.printers.values():
+        for i in range(files):
+            printer.files["part%03d.gcode" % i] = (100000 + i, "%040x" % i)
+        printer.selected = "part000.gcode"
+    simulator.start()
+    poller = FleetPoller(workers)
+
+    def askPrinter(opc):
+        opc.getFileList()
+        opc.getPrinterProfiles()
+        opc.getJobFileInfo()
+
+    print(str(printers) + " printers with " + str(files) + " files each, " + str(cycles) + " cycles")
+    print("%-18s %12s %14s %16s %10s" % ("", "Cycle (ms)", "Req/cycle", "Bytes/cycle", "Hit rate"))
+    for name, responseCache in (("no cache", None), ("revalidate only", ResponseCache(ttls={"/api/files": 0,
+                                                                                        "/api/printerprofiles": 0})),
+                                ("TTL " + str(ttl) + " s", ResponseCache(ttls={"/api/files": ttl,
+                                                                          "/api/printerprofiles": ttl}))):
+        opcs = [OctoPrintClient(printer["ipAddress"], printer["apiKey"], printer["username"], printer["password"],
+                                timeout=5, responseCache=responseCache) for printer in simulator.getPrinterList()]
+        bytesReceived = [0]
+
+        def countBytes(r, *args, **kwargs):
+            bytesReceived[0] += len(r.content)
+        for opc in opcs:
+            opc.session.hooks["response"].append(countBytes)
+
+        poller.poll(opcs, askPrinter)   # Warm-up: opens connections and fills the cache
+        requestsBefore = simulator.requestCount
+        bytesReceived[0] = 0
+        cycleTimes = []
+        for cycle in range(cycles):
+            if cycle % 5 == 4:
+                opcs[cycle % len(opcs)].selectPrintJob("/api/files/local/part001.gcode")
+            startTime = timeit.default_timer()
+            poller.poll(opcs, askPrinter)
+            cycleTimes.append(timeit.default_timer() - startTime)
+        hitRate = responseCache.getStats()["hitRate"] * 100 if responseCache is not None else 0.0
+        print("%-18s %12.1f %14.1f %16.0f %9.1f%%" % (name, statistics.mean(cycleTimes) * 1000,
+                                                      (simulator.requestCount - requestsBefore) / cycles,
+                                                      bytesReceived[0] / cycles, hitRate))
+        for opc in opcs:
+            opc.close()
+
+    poller.shutdown()
+    simulator.stop()
+
+
+def benchmarkDispatch(printers=20, jobs=100, minDuration=1, maxDuration=5, cycleTime=0.2, retrieveDelay=0.5,
+                      workers=32, seed=1):
+    '''
+    Print a batch of jobs of random duration on a simulated farm until all of them are done, in two ways:
+    the IPC assigning the jobs to the printers in turn up front (each printer gets its next job once it is free),
+    and every job sent to "any" printer through the JobDispatcher. Finished prints are retrieved retrieveDelay
+    seconds after the printer reports them. Reports the time to finish the batch, throughput and utilization.
+    '''
+    from octoprintsimulator import OctoPrintSimulator
+    from octoprintcommunication import OctoPrintClient
+    from commandingestion import Command, runPrinterCommand
+    from jobdispatcher import JobDispatcher
+    from fleetpolling import FleetPoller
+    from collections import deque
+    import logging
+    import random
+
+    logging.getLogger("octoprintcommunication").setLevel(logging.CRITICAL)
+    logging.getLogger("jobdispatcher").setLevel(logging.CRITICAL)
+    durations = random.Random(seed).sample(range(jobs), jobs)
+    durations = [minDuration + (maxDuration - minDuration) * rank / max(1, jobs - 1) for rank in durations]
+    files = ["job%04d.gcode" % i for i in range(jobs)]
+    finishDuration = cycleTime * 2      # Long enough for the finished state to be seen by a poll
+
+    print(str(printers) + " printers, " + str(jobs) + " jobs of " + str(minDuration) + "-" + str(maxDuration) +
+          " s, " + str(round(sum(durations) / printers, 1)) + " s of printing per printer")
+    print("%-12s %14s %14s %14s" % ("", "Batch (s)", "Jobs/min", "Utilization"))
+    for strategy in ("fixed", "dispatcher"):
+        simulator = OctoPrintSimulator(printers, finishDuration=finishDuration)
+        for printer in simulator.printers.values():
+            for name, duration in zip(files, durations):
+                printer.files[name] = (1, "0")
+                printer.fileDurations[name] = duration
+        simulator.start()
+        poller = FleetPoller(workers)
+        opcs = [OctoPrintClient(printer["ipAddress"], printer["apiKey"], printer["username"], printer["password"],
+                                printer["rackID"], printer["xPos"], printer["yPos"], timeout=5)
+                for printer in simulator.getPrinterList()]
+        clients = {opc.ipAddress: opc for opc in opcs}
+        dispatcher = JobDispatcher(startTimeout=10)
+        fixedQueues = {opc.ipAddress: deque() for opc in opcs}
+        for i, name in enumerate(files):
+            if strategy == "fixed":
+                fixedQueues[opcs[i % printers].ipAddress].append(Command(opcs[i % printers].ipAddress, "print",
+                                                                         "/api/files/local/" + name))
+            else:
+                dispatcher.submit([Command("any", "print", "/api/files/local/" + name)])
+
+        retrieveAt = {}                 # Time each finished print is taken off the bed, by IP address
+        completed = 0
+        startTime = timeit.default_timer()
+        while completed < jobs:
+            cycleStart = timeit.default_timer()
+            statuses = poller.poll(opcs, lambda opc: opc.getSnapshot())
+            for status in statuses:
+                if status.printFinished == "true" and status.ipAddress not in retrieveAt:
+                    retrieveAt[status.ipAddress] = cycleStart + retrieveDelay
+            for ipAddress, retrieveTime in list(retrieveAt.items()):
+                if cycleStart >= retrieveTime:
+                    clients[ipAddress].printFinished = "false"
+                    del retrieveAt[ipAddress]
+                    completed += 1
+
+            if strategy == "fixed":
+                commands = [fixedQueues[status.ipAddress].popleft() for status in statuses
+                            if dispatcher.isFree(status) and status.ipAddress not in retrieveAt and
+                            fixedQueues[status.ipAddress]]
+            else:
+                commands = dispatcher.dispatch(statuses, retrieveAt)
+            gcodePaths = {command.ipAddress: command.argument for command in commands}
+            poller.poll([clients[ipAddress] for ipAddress in gcodePaths],
+                        lambda opc: runPrinterCommand(opc, "print", gcodePaths[opc.ipAddress]))
+            time.sleep(max(0, cycleTime - (timeit.default_timer() - cycleStart)))
+        batchTime = timeit.default_timer() - startTime
+
+        print("%-12s %14.1f %14.1f %13.1f%%" % (strategy, batchTime, jobs / batchTime * 60,
+                                                100 * sum(durations) / (printers * batchTime)))
+        for opc in opcs:
+            opc.close()
+        poller.shutdown()
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OctoPrintCommunicator benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    csvParser = subparsers.add_parser("csv", help="startup and CSV parse cost, builtin reader versus pandas")
+    csvParser.add_argument("--rows", type=int, default=10)
+    csvParser.add_argument("--number", type=int, default=200)
+    fleetParser = subparsers.add_parser("fleet", help="poll cycle figures against a simulated farm")
+    fleetParser.add_argument("--sizes", default="1,10,50,100,250,500", help="comma-separated farm sizes")
+    fleetParser.add_argument("--cycles", type=int, default=5)
+    fleetParser.add_argument("--workers", type=int, default=32)
+    fleetParser.add_argument("--latency", type=float, default=0.02, help="mean simulated response time (s)")
+    fleetParser.add_argument("--jitter", type=float, default=0.005)
+    fleetParser.add_argument("--failure-rate", dest="failureRate", type=float, default=0.0)
+    fleetParser.add_argument("--drop-rate", dest="dropRate", type=float, default=0.0)
+    fleetParser.add_argument("--printing", action="store_true", help="all printers printing")
+    statusParser = subparsers.add_parser("status", help="CPU time and allocations per cycle for status rows")
+    statusParser.add_argument("--printers", type=int, default=100)
+    statusParser.add_argument("--number", type=int, default=200)
+    shardsParser = subparsers.add_parser("shards", help="coordinator throughput for different numbers of shards")
+    shardsParser.add_argument("--printers", type=int, default=500)
+    shardsParser.add_argument("--shards", default="1,2,4", help="comma-separated numbers of shards")
+    shardsParser.add_argument("--duration", type=float, default=10)
+    shardsParser.add_argument("--workers", type=int, default=32)
+    shardsParser.add_argument("--latency", type=float, default=0.02, help="mean simulated response time (s)")
+    cacheParser = subparsers.add_parser("cache", help="file and profile requests with and without the cache")
+    cacheParser.add_argument("--printers", type=int, default=100)
+    cacheParser.add_argument("--cycles", type=int, default=20)
+    cacheParser.add_argument("--files", type=int, default=50, help="files stored on each printer")
+    cacheParser.add_argument("--workers", type=int, default=32)
+    cacheParser.add_argument("--latency", type=float, default=0.02, help="mean simulated response time (s)")
+    cacheParser.add_argument("--ttl", type=float, default=60)
+    dispatchParser = subparsers.add_parser("dispatch", help="farm throughput, fixed assignment versus dispatcher")
+    dispatchParser.add_argument("--printers", type=int, default=20)
+    dispatchParser.add_argument("--jobs", type=int, default=100)
+    dispatchParser.add_argument("--min-duration", dest="minDuration", type=float, default=1)
+    dispatchParser.add_argument("--max-duration", dest="maxDuration", type=float, default=5)
+    dispatchParser.add_argument("--cycle-time", dest="cycleTime", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.benchmark == "csv":
+        benchmarkCsv(args.rows, args.number)
+    elif args.benchmark == "fleet":
+        benchmarkFleet([int(size) for size in args.sizes.split(",")], args.cycles, args.workers, args.latency,
+                       args.jitter, args.failureRate, args.dropRate, args.printing)
+    elif args.benchmark == "shards":
+        benchmarkShards(args.printers, [int(count) for count in args.shards.split(",")], args.duration,
+                        args.workers, args.latency)
+    elif args.benchmark == "status":
+        benchmarkStatus(args.printers, args.number)
+    elif args.benchmark == "dispatch":
+        benchmarkDispatch(args.printers, args.jobs, args.minDuration, args.maxDuration, args.cycleTime)
+    elif args.benchmark == "cache":
+        benchmarkCache(args.printers, args.cycles, args.files, args.workers, args.latency, ttl=args.ttl)
+    else:
+        parser.print_help()
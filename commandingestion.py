@@ -0,0 +1,363 @@
+from csvreader import sniffDelimiter
+from collections import deque, namedtuple
+
+import logging
+import json
+import zlib
+import csv
+import os
+
+'''
+Reads commands written by the IPC and hands them to the printer they are meant for.
+
+CommandIngestor tails PrinterCommands.csv: every poll only reads the lines appended since the last poll, and the
+processed byte offset is kept in a small journal file so a restart does not replay old commands. The journal also
+identifies the file the offset belongs to, so a file that was replaced while the script was stopped is read from the
+beginning, even if it has grown past the old offset. Once every line in the file has been read, it is cleared by
+renaming it to PrinterCommands.csv.drained, and the IPC starts a new file with its next command. Truncating it
+instead could throw away a command the IPC appends between the check and the truncate. A writer that still has the
+old file open keeps appending to the renamed file, so that is read on as well, until it has not grown for a whole poll.
+On Windows, the rename simply fails while the IPC has the file open.
+Commands may also be dropped as separate CSV files into a spool directory, which are deleted once read. Writing to a
+temporary name and renaming into the spool directory makes the handover completely race-free.
+
+CommandRouter keeps an index of clients by IP address and a command queue for each printer.
+'''
+
+Command = namedtuple("Command", ["ipAddress", "command", "argument"])
+
+# Commands that are not meant for one specific printer
+adminAddresses = ("shutdown", "exit")
+
+# Bytes at the start of the command file that are hashed to tell it apart from a later file with the same inode number
+identityHeadSize = 512
+
+
+class CommandIngestor:
+
+    def __init__(self, path_commands, path_journal=None, path_spool=None, truncateWhenDrained=True):
+        '''
+        Initialize an ingestor for the command CSV at path_commands.
+        path_journal is where the processed offset is stored (default: path_commands + ".offset").
+        path_spool is an optional directory to pick up command files from.
+        If truncateWhenDrained is set, the command file is cleared once every command in it has been read,
+        by renaming it to path_commands + ".drained".
+        '''
+        self.path_commands = str(path_commands)
+        self.path_journal = str(path_journal) if path_journal else self.path_commands + ".offset"
+        self.path_spool = str(path_spool) if path_spool else None
+        self.path_drained = self.path_commands + ".drained"
+        self.truncateWhenDrained = truncateWhenDrained
+        self.offset = 0                 # Bytes of the command file already processed
+        self.lastSize = None            # Size of the command file at the last poll
+        self.identity = None            # Device, inode number, head length and head hash of the command file
+        self.drainedOffset = None       # Bytes of the renamed command file already processed
+        self.drainedSize = None         # Size of the renamed command file at the last poll
+        self.delimiter = ","            # Delimiter of the command file, inferred from its header
+        self.columns = None             # Column index of IP_Address, Command and Argument
+        self.logger = logging.getLogger(__name__)
+        self.loadJournal()
+
+
+    def loadJournal(self):
+        '''
+        Restore the processed offset and CSV format from the journal, if there is one.
+        '''
+        try:
+            with open(self.path_journal, 'r') as journalFile:
+                journal = json.load(journalFile)
+            self.offset = int(journal["offset"])
+            self.drainedOffset = journal.get("drainedOffset")
+            self.identity = journal.get("identity")
+            self.delimiter = journal["delimiter"]
+            self.columns = tuple(journal["columns"]) if journal["columns"] is not None else None
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.error(self.path_journal + " could not be read, starting from the beginning: " + str(e))
+            self.offset = 0
+
+
+    def saveJournal(self):
+        '''
+        Store the processed offset and CSV format. The journal is replaced atomically.
+        '''
+        journal = {"offset": self.offset, "identity": self.identity, "drainedOffset": self.drainedOffset,
+                   "delimiter": self.delimiter, "columns": self.columns}
+        with open(self.path_journal + ".tmp", 'w') as journalFile:
+            json.dump(journal, journalFile)
+        os.replace(self.path_journal + ".tmp", self.path_journal)
+
+
+    def poll(self):
+        '''
+        Read all commands added since the last poll, from the command file and the spool directory.
+        Returns a list of Command tuples, in the order they were written.
+        '''
+        commands = self.readDrainedFile()
+        commands.extend(self.readCommandFile())
+        if self.path_spool is not None:
+            commands.extend(self.readSpool())
+        return commands
+
+
+    def readLines(self, commandFile, offset, lastSize):
+        '''
+        Read the complete lines of an open command file from offset on.
+        A last line without a line break may still be being written, and is left for the next poll.
+        If the file has not grown since then (it is still lastSize bytes), the line is taken to be complete.
+        Returns the lines (list of strings), the number of bytes they take up, and the size of the file.
+        '''
+        size = os.fstat(commandFile.fileno()).st_size
+        if size <= offset:
+            return [], 0, size
+        commandFile.seek(offset)
+        data = commandFile.read(size - offset)
+        end = data.rfind(b"\n") + 1
+        if end < len(data) and size == lastSize:
+            end = len(data)
+        return data[:end].decode("utf-8", "replace").splitlines(), end, size
+
+
+    def readCommandFile(self):
+        '''
+        Read the complete lines appended to the command file since the last poll.
+        Once every line has been read, the file is renamed, unless the last renamed file is still being read.
+        '''
+        try:
+            commandFile = open(self.path_commands, 'rb')
+        except FileNotFoundError:
+            return []
+
+        with commandFile:
+            if os.fstat(commandFile.fileno()).st_size < self.offset:
+                # The file has been cleared or rewritten by someone else. Start over.
+                self.offset, self.identity = 0, None
+            elif self.offset and self.identity is not None and \
+                    self.getIdentity(commandFile, self.identity[2]) != self.identity:
+                self.logger.error(self.path_commands + " has been replaced, reading it from the beginning")
+                self.offset, self.identity = 0, None
+            lines, end, size = self.readLines(commandFile, self.offset, self.lastSize)
+            self.lastSize = size
+            commands = self.parseLines(lines, self.offset == 0) if end else []
+            self.offset += end
+            if end and (self.identity is None or self.identity[2] < min(self.offset, identityHeadSize)):
+                self.identity = self.getIdentity(commandFile, min(self.offset, identityHeadSize))
+
+        rotated = False
+        if self.truncateWhenDrained and 0 < size == self.offset and self.drainedOffset is None:
+            try:
+                os.replace(self.path_commands, self.path_drained)
+                self.drainedOffset, self.drainedSize = self.offset, size
+                self.offset, self.lastSize, self.identity = 0, None, None
+                rotated = True
+            except OSError:
+                pass                    # The IPC has the file open (Windows). Cleared once it has been closed.
+
+        if end or rotated:
+            self.saveJournal()
+        return commands
+
+
+    def getIdentity(self, commandFile, headLength):
+        '''
+        Returns what tells an open command file apart from one that replaced it: its device and inode number,
+        and a hash of its first headLength bytes. Inode numbers of deleted files are reused, and the modification
+        time changes with every appended line, so neither is enough on its own.
+        '''
+        stat = os.fstat(commandFile.fileno())
+        commandFile.seek(0)
+        return [stat.st_dev, stat.st_ino, headLength, zlib.crc32(commandFile.read(headLength))]
+
+
+    def readDrainedFile(self):
+        '''
+        Read lines that were appended to the renamed command file by a writer that still had it open.
+        The file is deleted once it has not grown since the last poll.
+        '''
+        if self.drainedOffset is None:
+            return []
+        try:
+            drainedFile = open(self.path_drained, 'rb')
+        except FileNotFoundError:
+            self.drainedOffset = self.drainedSize = None
+            self.saveJournal()
+            return []
+
+        with drainedFile:
+            lines, end, size = self.readLines(drainedFile, self.drainedOffset, self.drainedSize)
+            commands = self.parseLines(lines, False)
+            self.drainedOffset += end
+            finished = size == self.drainedSize and self.drainedOffset >= size
+            self.drainedSize = size
+
+        if finished:
+            try:
+                os.remove(self.path_drained)
+                self.drainedOffset = self.drainedSize = None
+            except OSError:
+                pass                    # Still open somewhere (Windows). Deleted at the next poll.
+        if end or finished:
+            self.saveJournal()
+        return commands
+
+
+    def readSpool(self):
+        '''
+        Read every CSV file in the spool directory, oldest first, then delete it.
+        '''
+        commands = []
+        try:
+            names = sorted((name for name in os.listdir(self.path_spool) if name.lower().endswith(".csv")),
+                           key=lambda name: os.path.getmtime(os.path.join(self.path_spool, name)))
+        except FileNotFoundError:
+            return commands
+
+        for name in names:
+            path_file = os.path.join(self.path_spool, name)
+            try:
+                with open(path_file, 'r') as spoolFile:
+                    lines = spoolFile.read().splitlines()
+                commands.extend(self.parseLines(lines, True))
+                os.remove(path_file)
+            except OSError as e:
+                self.logger.error("Could not read spooled command file " + path_file + ": " + str(e))
+        return commands
+
+
+    def parseLines(self, lines, atStart):
+        '''
+        Parse CSV lines into Command tuples. At the start of a file, an optional Excel "sep=" line and the
+        header row are consumed first, to find the delimiter and the column order.
+        '''
+        lines = [line for line in lines if line.strip()]
+        if atStart and lines:
+            if lines[0].lower().startswith("sep="):
+                self.delimiter = lines[0][4:5] or self.delimiter
+                lines = lines[1:]
+            if lines and "ip_address" in lines[0].lower():
+                self.readHeader(lines[0])
+                lines = lines[1:]
+
+        if self.columns is None:
+            if lines:
+                self.logger.error(self.path_commands + " has no header row, commands ignored")
+            return []
+
+        ipColumn, commandColumn, argumentColumn = self.columns
+        commands = []
+        for row in csv.reader(lines, delimiter=self.delimiter):
+            if len(row) <= max(ipColumn, commandColumn):
+                continue
+            argument = row[argumentColumn].strip() if argumentColumn is not None and argumentColumn < len(row) else ""
+            commands.append(Command(row[ipColumn].strip(), row[commandColumn].strip(), argument))
+        return commands
+
+
+    def readHeader(self, line):
+        '''
+        Infer the delimiter from the header row and find the position of each column.
+        '''
+        if "sep=" not in line:
+            self.delimiter = sniffDelimiter(line, default=self.delimiter)
+        header = [field.strip().lower() for field in next(csv.reader([line], delimiter=self.delimiter))]
+        argumentColumn = header.index("argument") if "argument" in header else None
+        self.columns = (header.index("ip_address"), header.index("command"), argumentColumn)
+
+
+class CommandRouter:
+
+    def __init__(self, opcs):
+        '''
+        Initialize a router for a list of OctoPrintClient objects.
+        '''
+        self.clients = {}               # OctoPrintClient for each IP address
+        self.queues = {}                # Pending commands for each IP address
+        self.logger = logging.getLogger(__name__)
+        self.setClients(opcs)
+
+
+    def setClients(self, opcs):
+        '''
+        Rebuild the IP index, e.g. after printers have been added or removed.
+        Queued commands for printers that are still present are kept.
+        '''
+        self.clients = {opc.ipAddress: opc for opc in opcs}
+        self.queues = {ipAddress: self.queues.get(ipAddress, deque()) for ipAddress in self.clients}
+
+
+    def route(self, commands):
+        '''
+        Put every command in the queue of the printer it names.
+        Returns the list of administrative commands, which are not meant for one printer: shutdown, and connect
+        with the argument "all", which is meant for every printer whichever IP address it is written for.
+        Commands for unknown printers are logged and dropped.
+        '''
+        adminCommands = []
+        for command in commands:
+            if command.ipAddress.lower() in adminAddresses or \
+                    (command.command.lower() == "connect" and command.argument.lower() == "all"):
+                adminCommands.append(command)
+                continue
+            queue = self.queues.get(command.ipAddress)
+            if queue is not None:
+                queue.append(command)
+            else:
+                self.logger.error("Command for unknown printer " + command.ipAddress + " dropped: " +
+                                  (command.command + " " + command.argument).strip())
+        return adminCommands
+
+
+    def getPendingClients(self):
+        '''
+        Returns the clients that have commands waiting.
+        '''
+        return [self.clients[ipAddress] for ipAddress, queue in self.queues.items() if queue]
+
+
+    def popCommands(self, ipAddress):
+        '''
+        Take all queued commands for one printer, oldest first.
+        '''
+        queue = self.queues.get(ipAddress)
+        commands = []
+        while queue:
+            commands.append(queue.popleft())
+        return commands
+
+
+def runPrinterCommand(opc, command, argument, verbose=False):
+    '''
+    Carry out one command on one OctoPrintClient.
+    Returns False if the command is unknown, True otherwise.
+    '''
+    if command.lower() == "print":
+        selectedFile = argument
+        # Check if the string actually points to the files directory
+        if "api/files" in str(selectedFile):
+            # If the file cannot be selected, starting would print whichever file was selected before
+            location, separator, filename = str(selectedFile).split("api/files/", 1)[-1].partition("/")
+            if opc.getFileInfo(filename, location) is None:
+                # A failed request marks the client unreachable, an answer without the file does not
+                reason = "file not found" if opc.reachable else "no connection to Pi"
+                errorStr = opc.ipAddress + ": cannot print " + selectedFile + ", " + reason
+                logging.getLogger(__name__).error(errorStr)
+                if verbose:
+                    print(errorStr)
+                return True
+            opc.selectPrintJob(selectedFile)
+            opc.startPrintJob()
+            if verbose:
+                print(opc.ipAddress + ": attempting to print: " + selectedFile)
+
+    # For external applications, to tell that the finished print has been removed from the printer
+    elif command.lower() in ("printretrieved", "retrievedprint"):
+        opc.printFinished = "false"
+
+    # (Re)connect Pi to printer
+    elif command.lower() == "connect":
+        opc.connectToPrinter()
+
+    else:
+        return False
+    return True
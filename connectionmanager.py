@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+import metrics
+import time
+
+'''
+Connects Pis to their printers without holding up the main loop.
+
+OctoPrint answers a connect request right away, but the printer usually takes several seconds to become
+Operational. Instead of waiting a fixed time for every printer, connect requests are sent to all printers at once in
+background threads, and each printer that is still connecting is checked again every checkInterval seconds until it
+is Operational or its deadline has passed. Only the printers that are still connecting are held back from polling
+and commands. All other printers are served as usual in the meantime.
+'''
+
+class ConnectionManager:
+
+    def __init__(self, maxWorkers=8, deadline=30, checkInterval=1, verbose=False):
+        '''
+        Initialize the manager. maxWorkers sets how many connect requests and checks may run at the same time.
+        Printers that are not Operational deadline seconds after their connect request are given up on.
+        '''
+        self.maxWorkers = max(1, int(maxWorkers))
+        self.executor = ThreadPoolExecutor(max_workers=self.maxWorkers, thread_name_prefix="Connect")
+        self.deadline = deadline
+        self.checkInterval = checkInterval
+        self.verbose = verbose
+        self.clients = {}               # OctoPrintClient for each IP address that is connecting
+        self.startTimes = {}            # Time each connection was requested, by IP address
+        self.nextChecks = {}            # Time each printer is checked again, by IP address
+        self.futures = {}               # Request or check in progress, by IP address
+        self.logger = logging.getLogger(__name__)
+
+
+    def connect(self, opcs):
+        '''
+        Connect every Pi in opcs to its printer, unless it is connected already. Returns right away.
+        Printers that are already connecting keep their deadline.
+        '''
+        now = time.time()
+        for opc in opcs:
+            if opc.ipAddress in self.clients:
+                continue
+            if self.verbose:
+                print("Attempting to connect to " + opc.ipAddress)
+            self.clients[opc.ipAddress] = opc
+            self.startTimes[opc.ipAddress] = now
+            self.futures[opc.ipAddress] = self.executor.submit(self.connectIfNeeded, opc)
+
+
+    def setMaxWorkers(self, maxWorkers):
+        '''
+        Change how many connect requests and checks may run at the same time, e.g. after config.ini was reloaded.
+        Requests in progress finish in the old threads, new ones are started in the new ones.
+        '''
+        maxWorkers = max(1, int(maxWorkers))
+        if maxWorkers == self.maxWorkers:
+            return
+        oldExecutor = self.executor
+        self.maxWorkers = maxWorkers
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="Connect")
+        oldExecutor.shutdown(wait=False)
+
+
+    def track(self, opc):
+        '''
+        Hold a printer back until it is Operational, after a connect request has been sent to it elsewhere.
+        '''
+        if opc.ipAddress in self.clients:
+            return
+        now = time.time()
+        self.clients[opc.ipAddress] = opc
+        self.startTimes[opc.ipAddress] = now
+        self.nextChecks[opc.ipAddress] = now + self.checkInterval
+
+
+    def connectIfNeeded(self, opc):
+        '''
+        Send a connect request, unless the printer is connected already.
+        Returns True if the printer is connected (Operational or printing).
+        '''
+        if opc.isPrinterConnected():
+            return True
+        opc.connectToPrinter()
+        return False
+
+
+    def update(self, now=None):
+        '''
+        Collect finished requests and checks, and start new checks for printers that are due.
+        Returns the list of clients that have become ready or were given up on, which are no longer held back.
+        '''
+        now = time.time() if now is None else now
+        released = []
+        for ipAddress in list(self.clients):
+            opc = self.clients[ipAddress]
+            future = self.futures.get(ipAddress)
+            if future is not None:
+                if not future.done():
+                    continue
+                del self.futures[ipAddress]
+                try:
+                    connected = future.result()
+                except Exception as e:
+                    self.logger.error(ipAddress + " connect: " + str(e))
+                    connected = False
+                if connected:
+                    self.release(ipAddress)
+                    released.append(opc)
+                    metrics.increment("opc_connects_total", outcome="ready")
+                    if metrics.enabled:
+                        metrics.registry.observe("opc_connect_seconds", now - self.startTimes.get(ipAddress, now))
+                    if self.verbose:
+                        print(ipAddress + " is connected")
+                    continue
+                self.nextChecks[ipAddress] = now + self.checkInterval
+
+            if now - self.startTimes[ipAddress] >= self.deadline:
+                errorStr = (ipAddress + " connect: printer not operational after " + str(self.deadline) +
+                            " seconds, giving up")
+                self.logger.error(errorStr)
+                if self.verbose:
+                    print(errorStr)
+                self.release(ipAddress)
+                released.append(opc)
+                metrics.increment("opc_connects_total", outcome="timeout")
+            elif now >= self.nextChecks.get(ipAddress, now):
+                self.futures[ipAddress] = self.executor.submit(opc.isPrinterConnected)
+        return released
+
+
+    def release(self, ipAddress):
+        self.clients.pop(ipAddress, None)
+        self.startTimes.pop(ipAddress, None)
+        self.nextChecks.pop(ipAddress, None)
+
+
+    def forget(self, opc):
+        '''
+        Stop tracking a client, e.g. after it has been removed from the printer list.
+        '''
+        self.release(opc.ipAddress)
+        self.futures.pop(opc.ipAddress, None)
+
+
+    def isHeldBack(self, opc):
+        '''
+        Returns True if the printer is still connecting, so it should not be polled or sent commands yet.
+        '''
+        return opc.ipAddress in self.clients
+
+
+    def getDeadline(self, opc):
+        '''
+        Returns the time a connecting printer will be given up on, or None if it is not connecting.
+        '''
+        startTime = self.startTimes.get(opc.ipAddress)
+        return None if startTime is None else startTime + self.deadline
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,499 @@
+from commandingestion import Command, CommandRouter, runPrinterCommand
+from printerlist import createClient, createResponseCache
+from fleetpolling import FleetPoller
+from connectionmanager import ConnectionManager
+from pollscheduler import PollScheduler
+from printerstatus import PrinterStatus
+
+import multiprocessing
+import logging
+import metrics
+import queue
+import time
+import os
+
+'''
+Runs very large farms on several processes. The printer list is split into shards by rack, and every shard is
+polled and commanded by its own worker process, with its own clients, thread pool and scheduler. This way the work
+is spread over all cores of the controller, instead of being capped by the GIL of a single process.
+
+The parent process (Coordinator) owns the files shared with the IPC: it reads the commands and sends each one to
+the shard that owns the printer, and merges the status reported by every shard into one export. Workers only
+report the records that changed since their last report. Every report doubles as a heartbeat: workers that die or
+stop reporting are restarted, and get the finished flags of their printers handed back. With metrics enabled, each
+report also carries the HTTP and phase timings the worker has taken since its last report, which the parent adds
+to the metrics it serves.
+'''
+
+# Messages from the parent to a worker: a Command tuple, connectAllCommand, or None to stop
+connectAllCommand = Command("", "connect", "all")
+
+
+def shardPrinters(printerList, shardCount):
+    '''
+    Split the rows of ListOfPrinters.csv into at most shardCount shards. All printers of a rack stay in one shard.
+    Racks are handed out largest first, each to the shard with the fewest printers so far.
+    Returns a list of non-empty lists of printer rows.
+    '''
+    racks = {}
+    for printer in printerList:
+        racks.setdefault(str(printer['rackID']), []).append(printer)
+
+    shards = [[] for i in range(max(1, min(shardCount, len(racks))))]
+    for rack in sorted(racks.values(), key=len, reverse=True):
+        min(shards, key=len).extend(rack)
+    return [shard for shard in shards if shard]
+
+
+def runShard(shardIndex, printers, settings, commandQueue, statusQueue):
+    '''
+    Worker process: poll and command the printers of one shard until None is received on commandQueue.
+    settings is a dictionary with clientSettings, pollWorkers, cycleTime, scheduler (keyword arguments for
+    PollScheduler, or None), pushEnabled, pushStaleTimeout, pushReconnectDelay, startupAutoConnect, connectDeadline,
+    cacheSettings (keyword arguments for ResponseCache, or None), verbose, metricsEnabled and printFinished
+    (finished flag by IP address, to carry over from a previous worker).
+    Every cycle, (shardIndex, changed PrinterStatus records, number of printers polled, cycle seconds, IP addresses
+    of the printers still connecting, metrics taken since the last report or None) is put on statusQueue.
+    '''
+    logger = logging.getLogger(__name__)
+    verbose = settings["verbose"]
+    if settings.get("metricsEnabled"):
+        # A forked worker starts out with a copy of the parent's metrics, which must not be reported back again
+        metrics.registry.clear()
+        metrics.enable()
+    responseCache = createResponseCache(settings.get("cacheSettings"))
+    opcs = [createClient(printer, settings["clientSettings"], verbose=False, responseCache=responseCache)
+            for printer in printers]
+    for opc in opcs:
+        opc.printFinished = settings["printFinished"].get(opc.ipAddress, "false")
+    poller = FleetPoller(settings["pollWorkers"])
+    router = CommandRouter(opcs)
+    scheduler = None
+    if settings["scheduler"] is not None:
+        scheduler = PollScheduler(**settings["scheduler"])
+        scheduler.setClients(opcs)
+    if settings["pushEnabled"]:
+        for opc in opcs:
+            opc.subscribe(staleTimeout=settings["pushStaleTimeout"], reconnectDelay=settings["pushReconnectDelay"])
+    connectionManager = ConnectionManager(settings["pollWorkers"], settings["connectDeadline"])
+    if settings["startupAutoConnect"]:
+        connectionManager.connect(opcs)
+
+    def pollPrinter(opc):
+        try:
+            if scheduler is not None and scheduler.isBackedOff(opc) and not opc.isReachable():
+                return opc.getEmptyStatus()
+            return opc.getSnapshot()
+        except Exception as e:
+            logger.error(opc.ipAddress + " status poll failed: " + str(e))
+            return opc.getEmptyStatus()
+
+    def runPrinterCommands(opc):
+        connecting = False
+        for ipAddress, command, argument in router.popCommands(opc.ipAddress):
+            try:
+                if not runPrinterCommand(opc, command, argument, verbose):
+                    logger.error(ipAddress + ": unknown command " + command)
+                elif command.lower() == "connect":
+                    connecting = True
+            except Exception as e:
+                logger.error(ipAddress + " " + command + ": " + str(e))
+        return connecting
+
+    lastRows = {}                       # Last reported CSV row of each printer
+    running = True
+    try:
+        while running:
+            startTime = time.time()
+            duePrinters = []
+            changed = []
+            # A failed cycle is logged and the next one is tried, like in the single-process main loop
+            try:
+                for opc in connectionManager.update():
+                    if scheduler is not None:
+                        scheduler.pollNow(opc)
+                duePrinters = scheduler.popDue() if scheduler is not None else opcs
+                if scheduler is not None:
+                    for opc in duePrinters:
+                        if connectionManager.isHeldBack(opc):
+                            scheduler.schedule(opc.ipAddress, connectionManager.getDeadline(opc))
+                duePrinters = [opc for opc in duePrinters if not connectionManager.isHeldBack(opc)]
+                with metrics.timer("opc_phase_seconds", phase="poll"):
+                    polledSnapshots = poller.poll(duePrinters, pollPrinter)
+                for opc, opcSnapshot in zip(duePrinters, polledSnapshots):
+                    if scheduler is not None:
+                        scheduler.reschedule(opc, opcSnapshot)
+                    row = opcSnapshot.toCsvRow()
+                    if lastRows.get(opc.ipAddress) != row:
+                        lastRows[opc.ipAddress] = row
+                        changed.append(opcSnapshot)
+            except Exception as e:
+                logger.error("Shard " + str(shardIndex) + " status poll failed: " + str(e))
+            finally:
+                if scheduler is not None:
+                    scheduler.rescheduleFailed(duePrinters)
+            metricsDelta = metrics.registry.takeDelta() if metrics.enabled else None
+            statusQueue.put((shardIndex, changed, len(duePrinters), time.time() - startTime,
+                             list(connectionManager.clients), metricsDelta))
+
+            # Wait for commands until the next poll is due. Commands are carried out as soon as they arrive.
+            if scheduler is not None:
+                nextDue = scheduler.nextDue()
+                waitUntil = time.time() + max(0.1, min(settings["cycleTime"],
+                                                       nextDue - time.time() if nextDue is not None
+                                                       else settings["cycleTime"]))
+            else:
+                waitUntil = startTime + settings["cycleTime"]
+            while running:
+                try:
+                    message = commandQueue.get(timeout=max(0, waitUntil - time.time()))
+                except queue.Empty:
+                    break
+                messages = [message]
+                while True:
+                    try:
+                        messages.append(commandQueue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in messages:
+                    running = False
+                    break
+                pendingClients = []
+                try:
+                    if connectAllCommand in messages:
+                        connectionManager.connect(opcs)
+                    router.route([message for message in messages if message != connectAllCommand])
+                    pendingClients = [opc for opc in router.getPendingClients()
+                                      if not connectionManager.isHeldBack(opc)]
+                    with metrics.timer("opc_phase_seconds", phase="command_dispatch"):
+                        connecting = poller.poll(pendingClients, runPrinterCommands)
+                    for opc, connectSent in zip(pendingClients, connecting):
+                        if connectSent:
+                            connectionManager.track(opc)
+                except Exception as e:
+                    logger.error("Shard " + str(shardIndex) + " command processing failed: " + str(e))
+                if scheduler is not None:
+                    for opc in pendingClients:
+                        if not connectionManager.isHeldBack(opc):
+                            scheduler.pollNow(opc)
+                    break
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.error("Shard " + str(shardIndex) + " failed: " + str(e))
+        raise
+    finally:
+        for opc in opcs:
+            opc.unsubscribe()
+            opc.close()
+        connectionManager.shutdown()
+        poller.shutdown()
+
+
+class Shard:
+
+    def __init__(self, index, printers):
+        '''
+        Bookkeeping for one worker process and the printers it owns.
+        '''
+        self.index = index
+        self.printers = printers
+        self.process = None
+        self.commandQueue = None
+        self.lastReport = 0             # Time of the last status report (heartbeat)
+        self.restartAt = None           # Time to restart the worker, after it has failed
+        self.restarts = 0
+        self.pendingCommands = []       # Commands received while the worker was down
+        self.reported = set()           # Printers the running worker has reported a status for
+        self.connecting = ()            # Printers the running worker is still connecting
+
+
+class Coordinator:
+
+    def __init__(self, printerList, shardCount, settings, statusWriters=(), commandIngestor=None, recorder=None,
+                 cycleTime=4, heartbeatTimeout=60, restartDelay=5, verbose=False, stateStore=None, stateMaxAge=3600,
+                 commandServer=None, jobDispatcher=None):
+        '''
+        Initialize a coordinator for the rows of ListOfPrinters.csv, split into at most shardCount worker processes
+        (0 = one per CPU core). settings is handed to every worker, see runShard().
+        The merged status is written through statusWriters and recorder every cycleTime seconds, and commands are
+        read through commandIngestor. Workers that have not reported for heartbeatTimeout seconds are restarted,
+        restartDelay seconds after they failed. If a StateStore is given, finished flags and statuses younger than
+        stateMaxAge seconds are restored from it at startup, and the merged status is saved to it every cycle.
+        If a CommandServer is given, its commands are sent to the workers as soon as they arrive, and status
+        changes are published through it. If a JobDispatcher is given, print jobs without a target printer are
+        queued, and handed to free printers going by the merged status.
+        '''
+        self.settings = settings
+        self.statusWriters = statusWriters
+        self.commandIngestor = commandIngestor
+        self.recorder = recorder
+        self.cycleTime = cycleTime
+        self.heartbeatTimeout = heartbeatTimeout
+        self.restartDelay = restartDelay
+        self.verbose = verbose
+        self.logger = logging.getLogger(__name__)
+
+        self.shards = [Shard(index, printers) for index, printers in
+                       enumerate(shardPrinters(printerList, shardCount or os.cpu_count() or 1))]
+        self.shardOf = {}               # Shard owning each IP address
+        self.latestStatus = {}          # Latest PrinterStatus of each printer, in ListOfPrinters order
+        self.printFinished = {}         # Finished flag of each printer, as restored or last reported by its worker
+        for shard in self.shards:
+            for printer in shard.printers:
+                self.shardOf[printer['ipAddress']] = shard
+        for printer in printerList:
+            self.latestStatus[printer['ipAddress']] = PrinterStatus(printer['ipAddress'], printer['rackID'],
+                                                                    printer['xPos'], printer['yPos'])
+        self.router = CommandRouter(list(self.latestStatus.values()))   # Routes commands by IP address only
+        self.stateStore = stateStore
+        self.commandServer = commandServer
+        self.jobDispatcher = jobDispatcher
+        if commandServer is not None:
+            commandServer.setAddresses(self.latestStatus)
+        if stateStore is not None:
+            self.restoreState(stateMaxAge)
+        self.statusQueue = multiprocessing.Queue()
+        self.polledCount = 0            # Printers polled by all workers, for throughput figures
+
+
+    def restoreState(self, maxAge):
+        '''
+        Take the finished flags and recent statuses of all printers from the state store. The finished flags are
+        handed to the workers when they start.
+        '''
+        for ipAddress, printerState in self.stateStore.load().items():
+            current = self.latestStatus.get(ipAddress)
+            if current is None:
+                continue
+            status = printerState["status"]
+            lastSeen = printerState["lastSeen"]
+            if status is not None and lastSeen is not None and time.time() - lastSeen <= maxAge:
+                status.rackID, status.xPos, status.yPos = current.rackID, current.xPos, current.yPos
+                current = self.latestStatus[ipAddress] = status
+            current.printFinished = self.printFinished[ipAddress] = printerState["printFinished"]
+
+
+    def startShard(self, shard):
+        '''
+        Start (or restart) the worker process of a shard. Finished flags known to the parent are handed over.
+        '''
+        settings = dict(self.settings)
+        settings["printFinished"] = {printer['ipAddress']: self.printFinished.get(printer['ipAddress'], "false")
+                                     for printer in shard.printers}
+        # A new queue, as a worker that was killed may have left the old one locked
+        shard.commandQueue = multiprocessing.Queue()
+        for command in shard.pendingCommands:
+            shard.commandQueue.put(command)
+        shard.pendingCommands = []
+        shard.reported = set()
+        shard.connecting = ()
+        shard.process = multiprocessing.Process(target=runShard, name="OPCShard" + str(shard.index),
+                                                args=(shard.index, shard.printers, settings, shard.commandQueue,
+                                                      self.statusQueue), daemon=True)
+        shard.process.start()
+        shard.lastReport = time.time()
+        shard.restartAt = None
+        if self.verbose:
+            print("Started shard " + str(shard.index) + " with " + str(len(shard.printers)) + " printers")
+
+
+    def start(self):
+        for shard in self.shards:
+            self.startShard(shard)
+
+
+    def receive(self, timeout):
+        '''
+        Merge status reports from the workers into latestStatus, for up to timeout seconds.
+        Returns the number of status records that have changed.
+        '''
+        endTime = time.time() + timeout
+        changedCount = 0
+        while True:
+            try:
+                shardIndex, changed, polled, cycleSeconds, connecting, metricsDelta = self.statusQueue.get(
+                    timeout=max(0, endTime - time.time()))
+            except queue.Empty:
+                return changedCount
+            changedCount += len(changed)
+            shard = self.shards[shardIndex]
+            shard.lastReport = time.time()
+            shard.connecting = connecting
+            self.polledCount += polled
+            for opcSnapshot in changed:
+                self.latestStatus[opcSnapshot.ipAddress] = opcSnapshot
+                self.printFinished[opcSnapshot.ipAddress] = opcSnapshot.printFinished
+                shard.reported.add(opcSnapshot.ipAddress)
+            if metricsDelta is not None:
+                metrics.registry.merge(metricsDelta)
+            if metrics.enabled:
+                metrics.registry.observe("opc_shard_cycle_seconds", cycleSeconds, (("shard", str(shardIndex)),))
+
+
+    def getUnavailable(self):
+        '''
+        Returns the IP addresses of the printers that must not get a print job: printers of workers that are down,
+        printers still connecting, and printers whose status has not been reported since their worker started
+        (a restored status may be out of date).
+        '''
+        unavailable = set()
+        for shard in self.shards:
+            if shard.restartAt is not None or shard.process is None or not shard.process.is_alive():
+                unavailable.update(printer['ipAddress'] for printer in shard.printers)
+                continue
+            unavailable.update(shard.connecting)
+            unavailable.update(printer['ipAddress'] for printer in shard.printers
+                               if printer['ipAddress'] not in shard.reported)
+        return unavailable
+
+
+    def export(self):
+        '''
+        Write the merged status of all shards through every status writer. The state store gets the finished flags
+        kept by the parent, which a restarted worker starts from.
+        '''
+        opcSnapshots = list(self.latestStatus.values())
+        for statusWriter in self.statusWriters:
+            with metrics.timer("opc_phase_seconds", phase="export", backend=type(statusWriter).__name__):
+                statusWriter.write(opcSnapshots)
+        if self.recorder is not None:
+            for opcSnapshot in opcSnapshots:
+                self.recorder.record(opcSnapshot)
+        if self.stateStore is not None:
+            for opcSnapshot in opcSnapshots:
+                self.stateStore.update(opcSnapshot.ipAddress, opcSnapshot,
+                                       self.printFinished.get(opcSnapshot.ipAddress, "false"))
+            self.stateStore.commit(list(self.latestStatus))
+        if self.commandServer is not None:
+            self.commandServer.publishStatus(opcSnapshots)
+
+
+    def processCommands(self):
+        '''
+        Read new commands and send each one to the worker owning its printer.
+        Returns False if a shutdown command was received.
+        '''
+        commands = []
+        with metrics.timer("opc_phase_seconds", phase="command_parse"):
+            if self.commandIngestor is not None:
+                commands.extend(self.commandIngestor.poll())
+            if self.commandServer is not None:
+                commands.extend(self.commandServer.popCommands())
+            if self.jobDispatcher is not None:
+                commands = self.jobDispatcher.submit(commands, self.latestStatus.values())
+                commands.extend(self.jobDispatcher.dispatch(self.latestStatus.values(), self.getUnavailable()))
+                self.jobDispatcher.save()
+            adminCommands = self.router.route(commands)
+        for opcSnapshot in self.router.getPendingClients():
+            shard = self.shardOf[opcSnapshot.ipAddress]
+            for command in self.router.popCommands(opcSnapshot.ipAddress):
+                self.sendCommand(shard, command)
+
+        for ipAddress, command, argument in adminCommands:
+            if ipAddress.lower() in ("shutdown", "exit"):
+                msg = "Script shut down by external command"
+                self.logger.info(msg)
+                if self.verbose:
+                    print(msg)
+                return False
+            if command.lower() == "connect" and argument.lower() == "all":
+                for shard in self.shards:
+                    self.sendCommand(shard, connectAllCommand)
+        return True
+
+
+    def sendCommand(self, shard, command):
+        '''
+        Send a command to the worker of a shard. While the worker is down, it is kept until the worker restarts.
+        '''
+        if shard.restartAt is None and shard.process.is_alive():
+            shard.commandQueue.put(command)
+        else:
+            shard.pendingCommands.append(command)
+
+
+    def supervise(self):
+        '''
+        Restart workers that have died or stopped reporting.
+        '''
+        now = time.time()
+        for shard in self.shards:
+            if shard.restartAt is not None:
+                if now >= shard.restartAt:
+                    self.startShard(shard)
+                continue
+            if shard.process.is_alive() and now - shard.lastReport < self.heartbeatTimeout:
+                continue
+
+            if shard.process.is_alive():
+                errorStr = "Shard " + str(shard.index) + " has not reported for " + str(self.heartbeatTimeout) + " s"
+                shard.process.terminate()
+            else:
+                errorStr = "Shard " + str(shard.index) + " exited with code " + str(shard.process.exitcode)
+            shard.process.join(1)
+            shard.restarts += 1
+            shard.restartAt = now + self.restartDelay
+            metrics.increment("opc_shard_restarts_total", shard=str(shard.index))
+            self.logger.error(errorStr + ", restarting in " + str(self.restartDelay) + " s")
+            if self.verbose:
+                print(errorStr)
+
+
+    def stop(self, timeout=5):
+        '''
+        Ask every worker to stop, and terminate the ones that do not stop within timeout seconds.
+        '''
+        for shard in self.shards:
+            if shard.process is not None and shard.process.is_alive():
+                shard.commandQueue.put(None)
+        for shard in self.shards:
+            if shard.process is not None:
+                shard.process.join(timeout)
+                if shard.process.is_alive():
+                    shard.process.terminate()
+
+
+    def runCycleStep(self, step):
+        '''
+        Run one step of the coordinator loop, logging any error instead of stopping the loop.
+        Returns the result of the step, or True if it failed, so a failed step never stops the loop.
+        '''
+        try:
+            return step()
+        except Exception as e:
+            self.logger.error(e)
+            if self.verbose:
+                print(e)
+            return True
+
+
+    def run(self):
+        '''
+        Start the workers and coordinate them until a shutdown command is received.
+        '''
+        self.export()                   # Publish the restored status before the workers have polled anything
+        self.start()
+        try:
+            running = True
+            while running:
+                # Commands from the command server are passed on, and status changes published, within a few
+                # milliseconds
+                cycleEnd = time.time() + self.cycleTime
+                while running and time.time() < cycleEnd:
+                    if self.commandServer is None:
+                        self.receive(cycleEnd - time.time())
+                        break
+                    if self.receive(min(0.02, cycleEnd - time.time())):
+                        self.commandServer.publishStatus(list(self.latestStatus.values()))
+                    if self.commandServer.commandEvent.is_set():
+                        running = self.runCycleStep(self.processCommands)
+                if running:
+                    self.runCycleStep(self.export)
+                    running = self.runCycleStep(self.processCommands)
+                self.supervise()
+                metrics.increment("opc_cycles_total")
+        finally:
+            self.stop()
+            if self.recorder is not None:
+                self.recorder.flush()
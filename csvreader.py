@@ -0,0 +1,66 @@
+import csv
+
+'''
+A lightweight CSV reader for the small configuration and command files exchanged with the IPC.
+The delimiter is inferred and the rows are parsed in a single pass over the file, without pulling in pandas.
+Files may start with an Excel "sep=;" or "sep=," line, in which case that delimiter is used and the next line
+holds the column headers.
+'''
+
+def sniffDelimiter(line, delimiters=',;', default=','):
+    '''
+    Infer the delimiter from a single line of text.
+    Returns the delimiter (string), or default if it cannot be inferred.
+    '''
+    try:
+        return csv.Sniffer().sniff(line, delimiters).delimiter
+    except csv.Error:
+        return default
+
+
+def readCsv(path_csv):
+    '''
+    Read a CSV file, inferring its delimiter from the first line.
+    Returns the column headers (list of strings) and the data rows (list of lists of strings).
+    Blank lines are skipped.
+    '''
+    with open(path_csv, 'r', newline='') as csvfile:
+        firstLine = csvfile.readline()
+        if firstLine.strip().lower() in ("sep=;", "sep=,"):
+            delimiter = firstLine.strip()[4]
+            firstLine = csvfile.readline()
+        else:
+            delimiter = sniffDelimiter(firstLine)
+
+        header = [field.strip() for field in next(csv.reader([firstLine], delimiter=delimiter), [])]
+        rows = [row for row in csv.reader(csvfile, delimiter=delimiter) if row and any(field.strip() for field in row)]
+    return header, rows
+
+
+def readCsvRecords(path_csv, engine='builtin'):
+    '''
+    Read a CSV file into a list of dictionaries, one per row, keyed by column header.
+    engine selects the parser: 'builtin' (default) or 'pandas'. pandas is only imported if it is selected.
+    '''
+    if engine == 'pandas':
+        return readCsvRecordsPandas(path_csv)
+
+    header, rows = readCsv(path_csv)
+    return [dict(zip(header, row)) for row in rows]
+
+
+def readCsvRecordsPandas(path_csv):
+    '''
+    Read a CSV file into a list of dictionaries using pandas, as the script did before the builtin reader.
+    '''
+    import pandas
+
+    with open(path_csv, 'r') as csvfile:
+        firstLine = csvfile.readline()
+    if firstLine.strip().lower() in ("sep=;", "sep=,"):
+        delimiter, header = firstLine.strip()[4], 1
+    else:
+        delimiter, header = sniffDelimiter(firstLine), 0
+
+    dataframe = pandas.read_csv(path_csv, sep=delimiter, header=header)
+    return dataframe.to_dict('records')
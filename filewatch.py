@@ -0,0 +1,61 @@
+import hashlib
+import os
+
+'''
+Detects changes to the files the script reads at startup (ListOfPrinters.csv, config.ini), so they can be reloaded
+while the main loop keeps running. Checking costs one stat() call per file. The file is only read and hashed when
+its modification time or size has changed, and a change is only reported if the content differs as well, so
+touching or re-saving a file without editing it does not trigger a reload. A new modification time or size must
+also be seen on two checks in a row, so a file that is still being written is not picked up half-way.
+'''
+
+class FileWatcher:
+
+    def __init__(self, path_file):
+        '''
+        Initialize a watcher for path_file. The current content counts as unchanged.
+        '''
+        self.path_file = str(path_file)
+        self.signature = self.getSignature()
+        self.pendingSignature = None    # Signature seen on the last check, not yet confirmed
+        self.digest = self.getDigest()
+
+
+    def getSignature(self):
+        '''
+        Returns the modification time and size of the file, or None if it does not exist.
+        '''
+        try:
+            stat = os.stat(self.path_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+
+    def getDigest(self):
+        try:
+            with open(self.path_file, 'rb') as watchedFile:
+                return hashlib.sha1(watchedFile.read()).hexdigest()
+        except OSError:
+            return None
+
+
+    def hasChanged(self):
+        '''
+        Returns True if the content of the file has changed since the last call (or since the watcher was created).
+        A file that is missing is not reported as changed, so a file being replaced does not unload everything.
+        '''
+        signature = self.getSignature()
+        if signature == self.signature or signature is None:
+            self.pendingSignature = None
+            return False
+        if signature != self.pendingSignature:
+            self.pendingSignature = signature
+            return False
+        self.signature = signature
+        self.pendingSignature = None
+        digest = self.getDigest()
+        if digest is None or digest == self.digest:
+            return False
+        self.digest = digest
+        return True
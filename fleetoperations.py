@@ -0,0 +1,137 @@
+from printerlist import getClientSettings, loadPrinterList, createClient
+from fleetpolling import FleetPoller
+
+import configparser
+import argparse
+import hashlib
+import time
+import os
+
+'''
+Operations carried out on many printers at once, such as uploading a G-code file to a whole rack and starting it.
+All printers are handled concurrently, so a batch takes about as long as the slowest printer.
+
+Command-line usage, from the script directory:
+    python fleetoperations.py upload part.gcode --print
+    python fleetoperations.py upload part.gcode --rack 2 --skip-identical --select
+    python fleetoperations.py upload part.gcode --ip 192.168.0.11 --ip 192.168.0.12 --print
+'''
+
+def fileHash(path_file, blockSize=65536):
+    '''
+    Compute the SHA1 hash of a file, the same hash Octoprint keeps for its stored files.
+    Returns the hash as hex string.
+    '''
+    sha1 = hashlib.sha1()
+    with open(path_file, 'rb') as hashedFile:
+        for block in iter(lambda: hashedFile.read(blockSize), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def uploadToPrinter(opc, path_file, hashValue=None, select=False, printAfterSelect=False, location="local"):
+    '''
+    Upload a file to one printer, then select and print it if asked to.
+    If hashValue is given and the printer already holds a file with the same name and hash, the upload is skipped.
+    Returns a dictionary describing the result for this printer.
+    '''
+    filename = os.path.basename(path_file)
+    result = {"ipAddress": opc.ipAddress, "uploaded": False, "skipped": False, "selected": False,
+              "started": False, "error": None, "seconds": 0.0}
+    startTime = time.perf_counter()
+
+    try:
+        fileInfo = opc.getFileInfo(filename, location) if hashValue is not None else None
+        if fileInfo is not None and fileInfo.get("hash") == hashValue:
+            result["skipped"] = True
+            if select or printAfterSelect:
+                response = opc.selectPrintJob("/api/files/" + location + "/" + filename)
+                result["selected"] = response is not None
+                if printAfterSelect and result["selected"]:
+                    result["started"] = opc.startPrintJob() is not None
+        else:
+            statusCode = opc.uploadFile(path_file, location, select or printAfterSelect, printAfterSelect)
+            if statusCode == 201:
+                result["uploaded"] = True
+                result["selected"] = select or printAfterSelect
+                result["started"] = printAfterSelect
+            else:
+                result["error"] = "Upload failed (HTTP " + str(statusCode) + ")"
+    except Exception as e:
+        opc.logger.error(str(opc.ipAddress) + " upload of " + filename + " failed: " + str(e))
+        result["error"] = str(e)
+
+    result["seconds"] = time.perf_counter() - startTime
+    return result
+
+
+def uploadToFleet(opcs, path_file, select=False, printAfterSelect=False, skipIdentical=False,
+                  location="local", poller=None):
+    '''
+    Upload a file to every printer in opcs concurrently, then select and print it if asked to.
+    With skipIdentical, printers that already hold an identical file (same name and hash) are not uploaded to.
+    poller is the FleetPoller to upload with. If None, a poller with one worker per printer is used for this upload
+    and shut down afterwards.
+    Returns a list of result dictionaries, one per printer, in the same order as opcs.
+    '''
+    hashValue = fileHash(path_file) if skipIdentical else None
+    ownPoller = FleetPoller(len(opcs)) if poller is None else None
+    try:
+        return (poller or ownPoller).poll(opcs, lambda opc: uploadToPrinter(opc, path_file, hashValue, select,
+                                                                            printAfterSelect, location))
+    finally:
+        if ownPoller is not None:
+            ownPoller.shutdown()
+
+
+def printReport(results):
+    '''
+    Print a per-printer result table, followed by a summary line.
+    '''
+    print("%-22s %-9s %-9s %-8s %8s  %s" % ("Printer", "Upload", "Selected", "Started", "Seconds", "Error"))
+    for result in results:
+        upload = "skipped" if result["skipped"] else ("done" if result["uploaded"] else "failed")
+        print("%-22s %-9s %-9s %-8s %8.2f  %s" % (result["ipAddress"], upload, result["selected"],
+                                                 result["started"], result["seconds"], result["error"] or ""))
+    failed = sum(1 for result in results if result["error"])
+    print(str(len(results) - failed) + " of " + str(len(results)) + " printers succeeded")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run operations on many Octoprint-connected printers at once")
+    parser.add_argument("--config", default="config.ini", help="path to config.ini")
+    subparsers = parser.add_subparsers(dest="operation")
+    uploadParser = subparsers.add_parser("upload", help="upload a file to many printers, optionally print it")
+    uploadParser.add_argument("file", help="G-code file to upload")
+    uploadParser.add_argument("--ip", action="append", help="only this printer (may be repeated)")
+    uploadParser.add_argument("--rack", help="only printers in this rack")
+    uploadParser.add_argument("--location", default="local", help="Octoprint storage location (default: local)")
+    uploadParser.add_argument("--select", action="store_true", help="select the file after uploading")
+    uploadParser.add_argument("--print", dest="printAfterSelect", action="store_true",
+                              help="select the file and start printing")
+    uploadParser.add_argument("--skip-identical", dest="skipIdentical", action="store_true",
+                              help="do not upload to printers that already hold an identical file")
+    uploadParser.add_argument("--workers", type=int, default=16, help="max number of printers handled at once")
+    args = parser.parse_args()
+
+    if args.operation != "upload":
+        parser.print_help()
+    else:
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        printerList = loadPrinterList(config['Paths']['ListOfPrinters'],
+                                      config.get('Settings', 'CsvEngine', fallback='builtin'))
+        if args.ip:
+            printerList = [printer for printer in printerList if printer['ipAddress'] in args.ip]
+        if args.rack is not None:
+            printerList = [printer for printer in printerList if str(printer['rackID']) == args.rack]
+
+        clientSettings = getClientSettings(config)
+        opcs = [createClient(printer, clientSettings, verbose=False) for printer in printerList]
+        poller = FleetPoller(args.workers)
+        try:
+            results = uploadToFleet(opcs, args.file, args.select, args.printAfterSelect, args.skipIdentical,
+                                    args.location, poller)
+        finally:
+            poller.shutdown()
+        printReport(results)
@@ -0,0 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Fans out per-printer work over a bounded thread pool, so that one cycle takes about as long as the slowest printer
+instead of the sum of all of them. Results are always returned in the same order as the clients were passed in,
+which makes the output identical to looping over the clients one after another.
+'''
+
+class FleetPoller:
+
+    def __init__(self, maxWorkers=8):
+        '''
+        Initialize the poller. maxWorkers sets how many printers may be queried at the same time.
+        A value of 1 or lower disables the thread pool, and all work is done sequentially in the calling thread.
+        '''
+        self.maxWorkers = max(1, int(maxWorkers))
+        self.executor = None
+        if self.maxWorkers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.maxWorkers, thread_name_prefix="FleetPoller")
+
+
+    def poll(self, opcs, pollFunction):
+        '''
+        Run pollFunction(opc) for every client in opcs.
+        Returns a list of results, ordered like opcs.
+        Exceptions raised by pollFunction are re-raised in the calling thread, same as the sequential path.
+        '''
+        if self.executor is None or len(opcs) <= 1:
+            return [pollFunction(opc) for opc in opcs]
+        return list(self.executor.map(pollFunction, opcs))
+
+
+    def shutdown(self):
+        '''
+        Stop the worker threads. Pending work is finished before returning.
+        '''
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
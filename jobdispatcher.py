@@ -0,0 +1,321 @@
+from commandingestion import Command
+
+import logging
+import metrics
+import heapq
+import json
+import time
+import os
+
+'''
+Queues print jobs that are not meant for one specific printer, and hands each one to the next free printer.
+
+A print command may name a target instead of an IP address in PrinterCommands.csv (or over TCP):
+    any;print;/api/files/local/part.gcode           Print on any printer
+    rack:2;print;/api/files/local/part.gcode        Print on any printer in rack 2
+    any:10;print;/api/files/local/part.gcode        Print on any printer, with priority 10 (default 0)
+    rack:2:10;print;/api/files/local/part.gcode     Print on any printer in rack 2, with priority 10
+
+Jobs with a higher priority are handed out first, and jobs with the same priority in the order they were received.
+Every cycle, each job is given to a free printer: connected, ready, not printing or paused, and with the finished
+flag cleared (printRetrieved). Of the free printers, the one that has been idle the longest gets the job, and jobs
+that may go anywhere prefer racks that no waiting rack job needs. A printer is reserved for its job until its status
+shows the print has started. If it has not started within startTimeout seconds, the job is queued again for another
+printer, up to maxAttempts times. Jobs that no known printer may print (e.g. for a rack without printers) are given
+up on right away.
+
+Waiting jobs are saved to path_queue, so they survive a restart. Jobs that have already been handed to a printer
+are not, as they may have started by then.
+'''
+
+class Job:
+
+    __slots__ = ("gcodePath", "rackID", "priority", "sequence", "submitted", "attempts", "excluded")
+
+    def __init__(self, gcodePath, rackID=None, priority=0, sequence=0, submitted=None, attempts=0, excluded=()):
+        self.gcodePath = gcodePath      # Argument of the print command, e.g. /api/files/local/part.gcode
+        self.rackID = rackID            # Rack the job must be printed in (string), or None for any rack
+        self.priority = priority
+        self.sequence = sequence        # Order the job was received in, among jobs of the same priority
+        self.submitted = time.time() if submitted is None else submitted
+        self.attempts = attempts        # Number of times the job was handed to a printer without starting
+        self.excluded = set(excluded)   # Printers the job did not start on
+
+
+    def toDict(self):
+        return {"gcodePath": self.gcodePath, "rackID": self.rackID, "priority": self.priority,
+                "submitted": self.submitted, "attempts": self.attempts, "excluded": sorted(self.excluded)}
+
+
+def parseJobTarget(target):
+    '''
+    Parse the IP address field of a command as a job target: any[:priority] or rack:<ID>[:priority].
+    Returns (rackID or None, priority), or None if the field is not a job target (e.g. an IP address).
+    '''
+    fields = target.strip().lower().split(":")
+    if fields[0] == "any" and len(fields) <= 2:
+        rackID, priorityField = None, fields[1] if len(fields) > 1 else ""
+    elif fields[0] == "rack" and len(fields) in (2, 3) and fields[1]:
+        rackID, priorityField = fields[1], fields[2] if len(fields) > 2 else ""
+    else:
+        return None
+    try:
+        priority = int(priorityField) if priorityField else 0
+    except ValueError:
+        return None
+    return rackID, priority
+
+
+def isJobTarget(target):
+    return parseJobTarget(target) is not None
+
+
+class JobDispatcher:
+
+    def __init__(self, path_queue=None, startTimeout=60, maxAttempts=3, verbose=False):
+        '''
+        Initialize a dispatcher, restoring the waiting jobs from path_queue if given.
+        '''
+        self.path_queue = str(path_queue) if path_queue else None
+        self.startTimeout = startTimeout
+        self.maxAttempts = maxAttempts
+        self.verbose = verbose
+        self.queue = []                 # Heap of (-priority, sequence, Job)
+        self.sequence = 0
+        self.reservations = {}          # (Job, deadline) for each printer a job was handed to, by IP address
+        self.idleSince = {}             # Time each free printer was first seen free, by IP address
+        self.changed = False            # The queue has changed since it was last saved
+        self.stats = {"queued": 0, "dispatched": 0, "started": 0, "requeued": 0, "failed": 0}
+        self.logger = logging.getLogger(__name__)
+        self.load()
+
+
+    def load(self):
+        if self.path_queue is None:
+            return
+        try:
+            with open(self.path_queue, 'r') as queueFile:
+                jobs = json.load(queueFile)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.error(self.path_queue + " could not be read, starting with an empty job queue: " + str(e))
+            return
+        for job in jobs:
+            self.enqueue(Job(job["gcodePath"], job.get("rackID"), job.get("priority", 0),
+                             submitted=job.get("submitted"), attempts=job.get("attempts", 0),
+                             excluded=job.get("excluded", ())))
+        self.changed = False
+        if jobs:
+            self.logger.info("Restored " + str(len(jobs)) + " waiting print jobs from " + self.path_queue)
+
+
+    def save(self):
+        '''
+        Store the waiting jobs, if they have changed. The file is replaced atomically.
+        '''
+        if self.path_queue is None or not self.changed:
+            return
+        jobs = [job.toDict() for priority, sequence, job in sorted(self.queue)]
+        with open(self.path_queue + ".tmp", 'w') as queueFile:
+            json.dump(jobs, queueFile)
+        os.replace(self.path_queue + ".tmp", self.path_queue)
+        self.changed = False
+
+
+    def enqueue(self, job):
+        self.sequence += 1
+        job.sequence = self.sequence
+        heapq.heappush(self.queue, (-job.priority, job.sequence, job))
+        self.changed = True
+
+
+    def submit(self, commands, printers=None):
+        '''
+        Queue the print commands addressed to a job target (any, rack:<ID>). printers are all known printers
+        (clients or PrinterStatus records), and jobs none of them may print are given up on instead of queued.
+        Returns the list of all other commands, to be routed as usual.
+        '''
+        racks = self.indexPrinters(printers) if printers is not None else None
+        otherCommands = []
+        for command in commands:
+            target = parseJobTarget(command.ipAddress)
+            if target is None:
+                otherCommands.append(command)
+                continue
+            if command.command.lower() != "print" or "api/files" not in command.argument:
+                self.logger.error("Only print commands with a file can be queued for " + command.ipAddress + ": " +
+                                  command.command + " " + command.argument)
+                continue
+            job = Job(command.argument, target[0], target[1])
+            if racks is not None and not self.hasCandidate(job, racks):
+                self.giveUp(job, self.getNoCandidateReason(job, racks))
+                continue
+            self.enqueue(job)
+            self.stats["queued"] += 1
+            metrics.increment("opc_jobs_total", outcome="queued")
+            if self.verbose:
+                print("Queued print job " + command.argument + " for " + command.ipAddress)
+        return otherCommands
+
+
+    def isFree(self, status):
+        '''
+        Returns True if the printer can take a new job, going by its latest status.
+        '''
+        return (status.connected is True and status.ready is True and not status.printing and not status.paused and
+                not status.pausing and str(status.printFinished).lower() == "false")
+
+
+    def isCandidate(self, job, status):
+        '''
+        Returns True if the job may be printed on the printer, whether it is free or not.
+        '''
+        return (status.ipAddress not in job.excluded and
+                (job.rackID is None or str(status.rackID).lower() == job.rackID))
+
+
+    def indexPrinters(self, printers):
+        '''
+        Group printers (clients or PrinterStatus records) by rack, to find out which jobs can be printed at all.
+        Returns the IP addresses of the printers in each rack (lower case rack ID), and of all printers under None.
+        '''
+        racks = {None: []}
+        for printer in printers:
+            racks[None].append(printer.ipAddress)
+            racks.setdefault(str(printer.rackID).lower(), []).append(printer.ipAddress)
+        return racks
+
+
+    def hasCandidate(self, job, racks):
+        '''
+        Returns True if any printer in racks (see indexPrinters) may print the job, whether it is free or not.
+        With no printers known at all, nothing can be told, and True is returned.
+        '''
+        if not racks[None]:
+            return True
+        return any(ipAddress not in job.excluded for ipAddress in racks.get(job.rackID, ()))
+
+
+    def getNoCandidateReason(self, job, racks):
+        if job.rackID is not None and job.rackID not in racks:
+            return "is for rack " + job.rackID + ", which has no printers"
+        return "did not start on " + ", ".join(sorted(job.excluded))
+
+
+    def giveUp(self, job, reason):
+        '''
+        Count a job as failed, and log why.
+        '''
+        errorStr = "Print job " + job.gcodePath + " " + reason + ", giving up"
+        self.stats["failed"] += 1
+        metrics.increment("opc_jobs_total", outcome="failed")
+        self.logger.error(errorStr)
+        if self.verbose:
+            print(errorStr)
+
+
+    def checkReservations(self, statuses, now, racks):
+        '''
+        Release printers whose job has started, and queue jobs that did not start in time again.
+        '''
+        for ipAddress, (job, deadline) in list(self.reservations.items()):
+            status = statuses.get(ipAddress)
+            if status is not None and (status.printing or str(status.printFinished).lower() == "true"):
+                del self.reservations[ipAddress]
+                self.stats["started"] += 1
+                metrics.increment("opc_jobs_total", outcome="started")
+                if metrics.enabled:
+                    metrics.registry.observe("opc_job_wait_seconds", now - job.submitted)
+                continue
+            if status is not None and now < deadline:
+                continue
+
+            del self.reservations[ipAddress]
+            job.attempts += 1
+            job.excluded.add(ipAddress)
+            if job.attempts >= self.maxAttempts or not self.hasCandidate(job, racks):
+                self.giveUp(job, "did not start on " + ", ".join(sorted(job.excluded)))
+                continue
+            errorStr = "Print job " + job.gcodePath + " did not start on " + ipAddress + ", queued again"
+            self.stats["requeued"] += 1
+            metrics.increment("opc_jobs_total", outcome="requeued")
+            self.enqueue(job)
+            self.logger.error(errorStr)
+            if self.verbose:
+                print(errorStr)
+
+
+    def dispatch(self, statuses, unavailable=(), now=None, printers=None):
+        '''
+        Hand waiting jobs to free printers. statuses are the latest PrinterStatus records of the printers, and
+        unavailable the IP addresses of printers that must not get a job right now (e.g. still connecting).
+        printers are all known printers (clients or PrinterStatus records, default: statuses). Waiting jobs that
+        none of them may print, e.g. after a restart or a change to the printer list, are given up on.
+        Returns a list of print Commands for the chosen printers, to be routed as usual.
+        '''
+        now = time.time() if now is None else now
+        statuses = {status.ipAddress: status for status in statuses}
+        racks = self.indexPrinters(statuses.values() if printers is None else printers)
+        self.checkReservations(statuses, now, racks)
+        impossible = [entry for entry in self.queue if not self.hasCandidate(entry[2], racks)]
+        if impossible:
+            self.queue = [entry for entry in self.queue if self.hasCandidate(entry[2], racks)]
+            heapq.heapify(self.queue)
+            self.changed = True
+            for entry in impossible:
+                self.giveUp(entry[2], self.getNoCandidateReason(entry[2], racks))
+
+        freePrinters = []
+        for ipAddress, status in statuses.items():
+            if ipAddress in self.reservations or ipAddress in unavailable or not self.isFree(status):
+                self.idleSince.pop(ipAddress, None)
+                continue
+            freePrinters.append(status)
+            self.idleSince.setdefault(ipAddress, now)
+        for ipAddress in set(self.idleSince) - set(statuses):
+            del self.idleSince[ipAddress]
+        if not self.queue or not freePrinters:
+            return []
+
+        # Printers idle the longest go first, then by rack and position
+        freePrinters.sort(key=lambda status: (self.idleSince[status.ipAddress], str(status.rackID),
+                                              str(status.yPos), str(status.xPos)))
+        rackDemand = {job.rackID for priority, sequence, job in self.queue if job.rackID is not None}
+        commands = []
+        waiting = []
+        while self.queue and freePrinters:
+            entry = heapq.heappop(self.queue)
+            job = entry[2]
+            candidates = [status for status in freePrinters if self.isCandidate(job, status)]
+            if not candidates:
+                waiting.append(entry)
+                continue
+            if job.rackID is None:
+                chosen = min(candidates, key=lambda status: str(status.rackID).lower() in rackDemand)
+            else:
+                chosen = candidates[0]
+            freePrinters.remove(chosen)
+            self.idleSince.pop(chosen.ipAddress, None)
+            self.reservations[chosen.ipAddress] = (job, now + self.startTimeout)
+            commands.append(Command(chosen.ipAddress, "print", job.gcodePath))
+            self.stats["dispatched"] += 1
+            metrics.increment("opc_jobs_total", outcome="dispatched")
+            if self.verbose:
+                print("Dispatching print job " + job.gcodePath + " to " + chosen.ipAddress)
+        for entry in waiting:
+            heapq.heappush(self.queue, entry)
+        if commands:
+            self.changed = True
+        return commands
+
+
+    def getStats(self):
+        '''
+        Returns a dictionary with the number of jobs waiting and starting (handed to a printer, not started yet),
+        and the number of jobs queued, dispatched, started, queued again and given up on so far.
+        '''
+        stats = dict(self.stats)
+        stats["waiting"] = len(self.queue)
+        stats["starting"] = len(self.reservations)
+        return stats
@@ -0,0 +1,291 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+import threading
+import bisect
+import time
+import os
+
+'''
+Timing hooks, counters and histograms for finding out where the cycle time goes.
+
+Measurements are only taken while metrics are enabled (enable()). When disabled, timer() hands out a shared no-op
+context manager and the HTTP hooks skip timing altogether, so the cost is one attribute lookup per call.
+Metrics are exposed in the Prometheus text format, through a local HTTP endpoint (MetricsServer) and/or a snapshot
+file written periodically (writeSnapshot). Worker processes of the coordinator collect their own metrics, and send
+what they have collected to the parent process with every status report (Registry.takeDelta and merge).
+'''
+
+enabled = False
+
+# Upper bounds in seconds, chosen to cover everything from a fast local request to a full HTTP timeout
+defaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets=defaultBuckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last count is for values above the largest bucket
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+
+    def __init__(self):
+        '''
+        Holds all counters and histograms, keyed by metric name and a tuple of (label, value) pairs.
+        '''
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+
+    def increment(self, name, labels=(), amount=1):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            key = (name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+
+    def describe(self, name, helpText):
+        self.help[name] = helpText
+
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+    def takeDelta(self):
+        '''
+        Take all counters and histograms collected since the last call, and clear them. Worker processes hand these
+        to the parent process, which adds them to its own registry with merge().
+        Returns (counters, histograms), with each histogram as a tuple (buckets, counts, sum, count).
+        '''
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                          for key, histogram in self.histograms.items()}
+            self.counters.clear()
+            self.histograms.clear()
+        return counters, histograms
+
+
+    def merge(self, delta):
+        '''
+        Add counters and histograms taken from another registry with takeDelta().
+        '''
+        counters, histograms = delta
+        with self.lock:
+            for key, amount in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + amount
+            for key, (buckets, counts, total, count) in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(buckets)
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+
+
+    def render(self):
+        '''
+        Returns all metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+
+            lastName = None
+            for (name, labels), value in counters:
+                if name != lastName:
+                    lines.append("# HELP " + name + " " + self.help.get(name, name))
+                    lines.append("# TYPE " + name + " counter")
+                    lastName = name
+                lines.append(name + formatLabels(labels) + " " + str(value))
+
+            lastName = None
+            for (name, labels), histogram in histograms:
+                if name != lastName:
+                    lines.append("# HELP " + name + " " + self.help.get(name, name))
+                    lines.append("# TYPE " + name + " histogram")
+                    lastName = name
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(name + "_bucket" + formatLabels(labels + (("le", repr(bound)),)) + " " +
+                                 str(cumulative))
+                lines.append(name + "_bucket" + formatLabels(labels + (("le", "+Inf"),)) + " " +
+                             str(histogram.count))
+                lines.append(name + "_sum" + formatLabels(labels) + " " + repr(histogram.sum))
+                lines.append(name + "_count" + formatLabels(labels) + " " + str(histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(name + '="' + str(value).replace('"', '\\"') + '"' for name, value in labels) + "}"
+
+
+registry = Registry()
+registry.describe("opc_http_request_seconds", "Duration of HTTP requests to each Pi")
+registry.describe("opc_fleet_http_request_seconds", "Duration of HTTP requests to any Pi")
+registry.describe("opc_http_requests_total", "HTTP requests sent, by printer and outcome")
+registry.describe("opc_phase_seconds", "Duration of each phase of the main loop")
+registry.describe("opc_cycles_total", "Main loop cycles run")
+registry.describe("opc_connect_seconds", "Time from connect request until the printer is operational")
+registry.describe("opc_connects_total", "Printer connections, by outcome (ready or timeout)")
+registry.describe("opc_shard_cycle_seconds", "Duration of one poll cycle of each coordinator shard")
+registry.describe("opc_shard_restarts_total", "Coordinator shard workers restarted after failing")
+registry.describe("opc_cache_requests_total", "Cached response lookups, by endpoint and outcome")
+registry.describe("opc_jobs_total", "Print jobs queued without a target printer, by outcome")
+registry.describe("opc_job_wait_seconds", "Time from queueing a print job until it has started")
+
+
+class Timer:
+    '''
+    Context manager that observes its duration in a histogram.
+    '''
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        registry.observe(self.name, time.perf_counter() - self.startTime, self.labels)
+        return False
+
+
+class NullTimer:
+    '''
+    Does nothing. Handed out by timer() while metrics are disabled.
+    '''
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+nullTimer = NullTimer()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def timer(name, **labels):
+    '''
+    Returns a context manager that times the code it wraps, e.g.
+        with metrics.timer("opc_phase_seconds", phase="poll"):
+    '''
+    if not enabled:
+        return nullTimer
+    return Timer(name, tuple(sorted(labels.items())))
+
+
+def increment(name, amount=1, **labels):
+    if enabled:
+        registry.increment(name, tuple(sorted(labels.items())), amount)
+
+
+def endpointLabel(url):
+    '''
+    Reduce a request URL to its API endpoint (e.g. /api/files), so file names do not create new series.
+    '''
+    segments = urlsplit(url).path.split("/")
+    return "/".join(segments[:3])
+
+
+def observeRequest(ipAddress, method, url, seconds, outcome):
+    '''
+    Record one HTTP request to a Pi, both per printer and fleet-wide.
+    outcome is the response code, or "error" if no response was received.
+    '''
+    endpoint = endpointLabel(url)
+    registry.observe("opc_http_request_seconds", seconds,
+                     (("endpoint", endpoint), ("method", method), ("printer", ipAddress)))
+    registry.observe("opc_fleet_http_request_seconds", seconds, (("endpoint", endpoint), ("method", method)))
+    registry.increment("opc_http_requests_total", (("outcome", str(outcome)), ("printer", ipAddress)))
+
+
+def writeSnapshot(path_snapshot):
+    '''
+    Write all metrics to a file in the Prometheus text format. The file is replaced atomically.
+    '''
+    with open(str(path_snapshot) + ".tmp", 'w') as snapshotFile:
+        snapshotFile.write(registry.render())
+    os.replace(str(path_snapshot) + ".tmp", str(path_snapshot))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MetricsServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=9100):
+        '''
+        Initialize a local endpoint serving the metrics at /metrics.
+        '''
+        ThreadingHTTPServer.__init__(self, (host, port), MetricsHandler)
+
+
+    def start(self):
+        '''
+        Serve requests in a background thread.
+        '''
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
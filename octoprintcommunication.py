@@ -1,11 +1,19 @@
+from printerstatus import PrinterStatus
+from pushstream import PushStream
+
 import ipaddress
+import metrics
 import requests
 import logging
-import json
+import socket
+import uuid
+import time
+import os
 
 
-from requests.exceptions import ConnectionError
+from requests.exceptions import RequestException
 from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 '''
 This class contains the necessary commands to extract information from Raspberry Pis running Octoprint,
@@ -13,12 +21,103 @@ as well as commands to start print jobs. Communication between the script and Pi
 JSON objects. Methods primarily return JSON-formatted strings.
 '''
 
+class PooledHTTPAdapter(HTTPAdapter):
+    '''
+    A Requests HTTPAdapter that keeps connections to the Pi alive between requests,
+    and keeps track of how many connections were opened versus reused.
+    '''
+
+    def getConnectionStats(self):
+        '''
+        Count requests and new connections across all connection pools held by this adapter.
+        Returns a dictionary with the number of connections opened, connections reused and requests sent.
+        '''
+        opened = 0
+        requestCount = 0
+        for key in self.poolmanager.pools.keys():
+            pool = self.poolmanager.pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                requestCount += pool.num_requests
+        return {"opened": opened, "reused": max(0, requestCount - opened), "requests": requestCount}
+
+
+class MultipartFileStream:
+    '''
+    A multipart/form-data request body that streams a file from disk instead of loading it into memory.
+    Requests sends file-like bodies with a known length block by block, so only one block is held at a time.
+    '''
+
+    def __init__(self, path_file, fields=None, fieldName="file"):
+        '''
+        Prepare a body containing the form fields (dictionary of strings) followed by the file at path_file.
+        '''
+        self.boundary = uuid.uuid4().hex
+        self.contentType = "multipart/form-data; boundary=" + self.boundary
+
+        preamble = b""
+        for name, value in (fields or {}).items():
+            preamble += ("--" + self.boundary + "\r\n" +
+                         "Content-Disposition: form-data; name=\"" + name + "\"\r\n\r\n" +
+                         str(value) + "\r\n").encode("utf-8")
+        preamble += ("--" + self.boundary + "\r\n" +
+                     "Content-Disposition: form-data; name=\"" + fieldName + "\"; filename=\"" +
+                     os.path.basename(path_file) + "\"\r\n" +
+                     "Content-Type: application/octet-stream\r\n\r\n").encode("utf-8")
+        epilogue = ("\r\n--" + self.boundary + "--\r\n").encode("utf-8")
+
+        self.file = open(path_file, 'rb')
+        self.parts = [preamble, self.file, epilogue]
+        self.length = len(preamble) + os.path.getsize(path_file) + len(epilogue)
+        self.position = 0
+        self.partIndex = 0
+
+
+    def __len__(self):
+        return self.length
+
+
+    def read(self, size=-1):
+        '''
+        Read up to size bytes of the body (all remaining bytes if size is negative).
+        '''
+        if size is None or size < 0:
+            size = self.length
+        data = b""
+        while len(data) < size and self.partIndex < len(self.parts):
+            part = self.parts[self.partIndex]
+            if isinstance(part, bytes):
+                chunk = part[self.position:self.position + size - len(data)]
+                self.position += len(chunk)
+                if self.position >= len(part):
+                    self.partIndex += 1
+                    self.position = 0
+            else:
+                chunk = part.read(size - len(data))
+                if not chunk:
+                    self.partIndex += 1
+            data += chunk
+        return data
+
+
+    def close(self):
+        self.file.close()
+
+
 class OctoPrintClient:
 
     def __init__(self, ipAddress, apiKey, username, password,
-                 rackID=1, xPos=1, yPos=1, path_log='Log.txt', timeout=2, verbose=False):
+                 rackID=1, xPos=1, yPos=1, path_log='Log.txt', timeout=2, verbose=False,
+                 poolSize=2, retries=0, backoffFactor=0, jobRefreshInterval=10, responseCache=None, uploadTimeout=300,
+                 progressRefreshInterval=2):
         '''
         Initialize a "client". Each client handles one connection to one printer.
+        HTTP requests go through a keep-alive session, so the TCP connection to the Pi is reused between requests.
+        poolSize sets how many connections to the Pi are kept open, retries and backoffFactor set the retry policy.
+        jobRefreshInterval sets how many snapshots of a printer that is not printing may reuse the cached job info
+        before it is fetched again, and progressRefreshInterval the same for a printer that is printing.
+        responseCache is a ResponseCache shared by the fleet for file and profile data, or None to not cache it.
+        uploadTimeout is the HTTP timeout for file uploads, which take much longer than any other request.
         A logger object is initialized to write error logs as well.
         '''
         self.ipAddress = ipAddress      # Raspberry Pi IP Address
@@ -29,8 +128,29 @@ class OctoPrintClient:
         self.xPos = xPos                # X-position of printer in rack
         self.yPos = yPos                # Y-position of printer in rack
         self.timeout = timeout          # HTTP timeout threshold (seconds)
+        self.uploadTimeout = uploadTimeout  # HTTP timeout threshold for file uploads (seconds)
         self.printFinished = "false"    # Status to be used by external applications
         self.verbose = verbose          # Toggle whether to print responses to console
+        self.requestCount = 0           # Number of HTTP requests sent by this client
+        self.reachable = True           # False after a failed connection, until the Pi answers again
+
+        # Cached /api/job data for printers that are not printing. The job then rarely changes, so it is only
+        # refetched when the printer state changes, or when the cache has been used for jobRefreshInterval snapshots.
+        self.jobRefreshInterval = jobRefreshInterval
+        self.progressRefreshInterval = progressRefreshInterval
+        self.jobCache = None
+        self.jobCacheAge = 0
+        self.jobCacheETag = None
+        self.lastStateText = None
+        self.pushStream = None          # Set by subscribe() when push mode is used
+        self.responseCache = responseCache
+
+        # Keep-alive session with a pooled adapter. Retries only apply to failed connections and idempotent requests.
+        retryPolicy = Retry(total=retries, connect=retries, read=False, backoff_factor=backoffFactor)
+        self.adapter = PooledHTTPAdapter(pool_connections=1, pool_maxsize=poolSize, max_retries=retryPolicy)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
 
         logging.basicConfig(filename=path_log, level=logging.ERROR,
                             format='%(asctime)s %(levelname)s %(name)s %(message)s')
@@ -39,30 +159,149 @@ class OctoPrintClient:
 
     def get(self, url, headers=None):
         '''
-        Performs a HTTP get using the Requests library.
+        Performs a HTTP get using this client's keep-alive session.
         Handles some common exceptions.
         Returns a Requests response object.
         '''
+        self.requestCount += 1
+        startTime = time.perf_counter() if metrics.enabled else None
         try:
-            return requests.get(url, headers=headers, timeout=self.timeout)
-        except ConnectionError as e:
-            errorStr = self.ipAddress + " HTTP get: No connection to Pi"
-            self.logger.error(errorStr)
-            self.logger.error(e)
-
-
-    def post(self, url, headers=None, data=None, json=None):
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        except RequestException as e:
+            if startTime is not None:
+                metrics.observeRequest(self.ipAddress, "GET", url, time.perf_counter() - startTime, "error")
+            self.connectionFailed("HTTP get", e)
+            return None
+        if startTime is not None:
+            metrics.observeRequest(self.ipAddress, "GET", url, time.perf_counter() - startTime, r.status_code)
+        self.connectionRestored()
+        return r
+
+
+    def post(self, url, headers=None, data=None, json=None, timeout=None):
         '''
-        Performs a HTTP post using the Requests library.
+        Performs a HTTP post using this client's keep-alive session.
+        timeout overrides the client's HTTP timeout for this request.
         Handles some common exceptions.
         Returns a Requests response object.
         '''
+        self.requestCount += 1
+        startTime = time.perf_counter() if metrics.enabled else None
         try:
-            return requests.post(url, headers=headers, data=data, json=json, timeout=self.timeout)
-        except ConnectionError as e:
-            errorStr = self.ipAddress + " HTTP post: No connection to Pi"
-            self.logger.error(errorStr)
+            r = self.session.post(url, headers=headers, data=data, json=json,
+                                  timeout=self.timeout if timeout is None else timeout)
+        except RequestException as e:
+            if startTime is not None:
+                metrics.observeRequest(self.ipAddress, "POST", url, time.perf_counter() - startTime, "error")
+            self.connectionFailed("HTTP post", e)
+            return None
+        if startTime is not None:
+            metrics.observeRequest(self.ipAddress, "POST", url, time.perf_counter() - startTime, r.status_code)
+        self.connectionRestored()
+        return r
+
+
+    def getCached(self, url):
+        '''
+        Performs a HTTP get through the response cache, if any. A fresh cached response is returned without
+        a request, and a stale one is revalidated with a conditional request.
+        Returns the parsed JSON response, or None if the request failed or the response was not 200 OK.
+        '''
+        headers = {"X-Api-Key": self.apiKey}
+        if self.responseCache is None:
+            r = self.get(url, headers=headers)
+            return r.json() if r is not None and r.status_code == 200 else None
+
+        value, validators = self.responseCache.lookup(url)
+        if value is not None:
+            return value
+        headers.update(validators)
+        r = self.get(url, headers=headers)
+        if r is None:
+            return None
+        value = self.responseCache.store(url, r)
+        if value is None and r.status_code == 304:
+            # The entry was invalidated while the request was under way, so it has to be fetched in full
+            r = self.get(url, headers={"X-Api-Key": self.apiKey})
+            if r is not None:
+                value = self.responseCache.store(url, r)
+        return value
+
+
+    def invalidateCache(self):
+        '''
+        Forget cached data that a command may have changed: the file data in the response cache, and the job info.
+        '''
+        if self.responseCache is not None:
+            self.responseCache.invalidate("http://" + self.ipAddress + "/api/files")
+        self.jobCacheAge = max(self.jobRefreshInterval, self.progressRefreshInterval)
+
+
+    def connectionFailed(self, context, e):
+        '''
+        Log a failed connection to the Pi. Only the first failure after the Pi was last reachable is logged,
+        so an offline Pi does not flood the log every cycle.
+        '''
+        if self.reachable:
+            self.logger.error(self.ipAddress + " " + context + ": No connection to Pi")
             self.logger.error(e)
+        self.reachable = False
+
+
+    def connectionRestored(self):
+        '''
+        Log that the Pi is reachable again after a failed connection.
+        '''
+        if not self.reachable:
+            self.logger.info(self.ipAddress + ": connection to Pi restored")
+        self.reachable = True
+
+
+    def isReachable(self, timeout=0.5):
+        '''
+        Cheap reachability probe: try to open a TCP connection to the Pi, without sending a request.
+        Returns True if the Pi accepted the connection.
+        '''
+        host, separator, port = self.ipAddress.partition(":")
+        try:
+            socket.create_connection((host, int(port) if port else 80), timeout=timeout).close()
+            return True
+        except (OSError, ValueError):
+            return False
+
+
+    def getConnectionStats(self):
+        '''
+        Returns a dictionary with the number of TCP connections opened and reused by this client.
+        '''
+        return self.adapter.getConnectionStats()
+
+
+    def close(self):
+        '''
+        Close all pooled connections to the Pi, and the push stream if subscribed.
+        '''
+        self.unsubscribe()
+        self.session.close()
+
+
+    def subscribe(self, staleTimeout=60, reconnectDelay=5):
+        '''
+        Subscribe to OctoPrint's push API. While the stream is live, getSnapshot() returns the pushed status
+        without sending any requests. If the stream drops, getSnapshot() falls back to polling until it reconnects.
+        '''
+        if self.pushStream is None:
+            self.pushStream = PushStream(self, staleTimeout=staleTimeout, reconnectDelay=reconnectDelay)
+            self.pushStream.start()
+
+
+    def unsubscribe(self):
+        '''
+        Stop the push stream, if any.
+        '''
+        if self.pushStream is not None:
+            self.pushStream.stop()
+            self.pushStream = None
 
 
     def printDebugInfo(self):
@@ -87,7 +326,6 @@ class OctoPrintClient:
             return r.text
         else:
             errorStr = str(self.ipAddress) + " login response: No connection to Pi"
-            self.logger.error(errorStr)
             if self.verbose:
                 print(errorStr)
 
@@ -104,7 +342,6 @@ class OctoPrintClient:
             return r.text
         else:
             errorStr = str(self.ipAddress) + " logout response: No connection to Pi"
-            self.logger.error(errorStr)
             if self.verbose:
                 print(errorStr)
 
@@ -123,7 +360,6 @@ class OctoPrintClient:
             return r.status_code
         else:
             errorStr = str(self.ipAddress) + " connectToPrinter response: No connection to Pi"
-            self.logger.error(errorStr)
             if self.verbose:
                 print(errorStr)
 
@@ -140,7 +376,6 @@ class OctoPrintClient:
             return r.status_code
         else:
             errorStr = str(self.ipAddress) + " disconnectFromPrinter response: No connection to Pi"
-            self.logger.error(errorStr)
             if self.verbose:
                 print(errorStr)
 
@@ -155,17 +390,14 @@ class OctoPrintClient:
 
         r = self.get(url, headers=headers)
         if r is not None:
-            rJson = json.loads(r.text)
-
             # Check for responses
-            printerCurrentState = rJson["current"]["state"]
+            printerCurrentState = r.json()["current"]["state"]
             if printerCurrentState == "Operational" or printerCurrentState == "Printing":
                     return True
             else:
                     return False
         else:
             errorStr = str(self.ipAddress) + " isPrinterConnected response: No connection to Pi"
-            self.logger.error(errorStr)
             if self.verbose:
                 print(errorStr)
 
@@ -182,9 +414,9 @@ class OctoPrintClient:
 
         r = self.get(url, headers=headers)
         if r is not None:
-            rJson = json.loads(r.text)
-
-            if r.text == "Printer is not operational":
+            # The body is not parsed here. OctoPrint answers 409 with a plain text body when the printer is not
+            # connected, and callers that need the fields should use getSnapshot(), which parses it once.
+            if r.status_code == 409:
                 errorStr = "Printer " + self.ipAddress + " is not operational"
                 self.logger.error(errorStr)
                 if self.verbose:
@@ -194,7 +426,6 @@ class OctoPrintClient:
                 return r.text
         else:
             errorStr = str(self.ipAddress) + " getPrinterStatus response: No connection to Pi"
-            self.logger.error(errorStr)
             if self.verbose:
                 print(errorStr)
 
@@ -211,7 +442,6 @@ class OctoPrintClient:
             return r.text
         else:
             errorStr = str(self.ipAddress) + " getCurrentPrintJob response: No connection to Pi"
-            self.logger.error(errorStr)
             if self.verbose:
                 print(errorStr)
 
@@ -226,6 +456,7 @@ class OctoPrintClient:
         headers = {"Content-Type": "application/json", "X-Api-Key": self.apiKey}
         json = {"command": "select"}
         r = self.post(url, headers=headers, json=json)
+        self.invalidateCache()
         if r is not None:
             return r.text
 
@@ -241,6 +472,7 @@ class OctoPrintClient:
         headers = {"Content-Type": "application/json", "X-Api-Key": self.apiKey}
         json = {"command": "start"}
         r = self.post(url, headers=headers, json=json)
+        self.invalidateCache()
         if r is not None:
             return r.text
         else:
@@ -251,4 +483,159 @@ class OctoPrintClient:
                 errorStr = str(self.ipAddress) + " startPrintJob response: Could not start print job. No connection to Pi"
                 self.logger.error(errorStr)
             if self.verbose:
-                print(errorStr)
\ No newline at end of file
+                print(errorStr)
+
+    def getEmptyStatus(self):
+        '''
+        Returns a PrinterStatus record for this printer with nothing known but its position and finished flag,
+        for when the Pi could not be asked. The finished flag is kept until the print has been retrieved, not just
+        until the next failed poll.
+        '''
+        status = PrinterStatus(self.ipAddress, self.rackID, self.xPos, self.yPos)
+        status.printFinished = self.printFinished
+        return status
+
+
+    def getSnapshot(self):
+        '''
+        Build a PrinterStatus record for this printer using as few requests as possible.
+        /api/printer carries both the state flags and the connection state (it answers 409 when the printer is not
+        connected), so /api/connection is not needed. The job info is cached, and fetched again when the printer state
+        changes, or once it has been reused for progressRefreshInterval snapshots while printing (jobRefreshInterval
+        otherwise). OctoPrint sends no ETag for /api/job, so every refresh is a full request.
+        In push mode, the pushed status is returned as long as the stream is live.
+        Returns a PrinterStatus object.
+        '''
+        if self.pushStream is not None and self.pushStream.isLive():
+            return self.pushStream.getStatus()
+
+        status = self.getEmptyStatus()
+        url = "http://" + self.ipAddress + "/api/printer"
+        headers = {"X-Api-Key": self.apiKey}
+
+        r = self.get(url, headers=headers)
+        if r is None:
+            errorStr = str(self.ipAddress) + " getSnapshot response: No connection to Pi"
+            if self.verbose:
+                print(errorStr)
+            self.lastStateText = None
+            return status
+
+        if r.status_code == 409:
+            # Printer is not operational, i.e. the Pi is not connected to the printer
+            status.connected = False
+            self.lastStateText = None
+            return status
+
+        status.updateFromPrinterJson(r.json())
+
+        # The "finished"-status is a local variable in the client object.
+        # It is only set when "finishing" is true, at the end of each print job.
+        # It is reset by the printRetrieved command.
+        if status.finishing:
+            self.printFinished = "true"
+        status.printFinished = self.printFinished
+
+        # Progress moves while printing, so the job info is reused for fewer snapshots then
+        printing = status.printing or status.pausing or status.finishing
+        jobJson = self.getCachedPrintJob(status.stateText != self.lastStateText,
+                                         self.progressRefreshInterval if printing else self.jobRefreshInterval)
+        if jobJson is not None:
+            status.updateFromJobJson(jobJson)
+        self.lastStateText = status.stateText
+
+        return status
+
+
+    def getCachedPrintJob(self, forceRefresh=False, maxAge=None):
+        '''
+        Return the parsed /api/job response, from cache if it has been reused for fewer than maxAge snapshots
+        (default: jobRefreshInterval).
+        If the Pi sent an ETag, it is used for a conditional request, and a 304 response reuses the cached data.
+        Returns a dictionary, or None if no job info could be fetched.
+        '''
+        maxAge = self.jobRefreshInterval if maxAge is None else maxAge
+        if self.jobCache is not None and not forceRefresh and self.jobCacheAge < maxAge:
+            self.jobCacheAge += 1
+            return self.jobCache
+
+        url = "http://" + self.ipAddress + "/api/job"
+        headers = {"X-Api-Key": self.apiKey}
+        if self.jobCache is not None and self.jobCacheETag is not None:
+            headers["If-None-Match"] = self.jobCacheETag
+
+        r = self.get(url, headers=headers)
+        if r is None:
+            return self.jobCache
+
+        if r.status_code == 200:
+            self.jobCache = r.json()
+            self.jobCacheETag = r.headers.get("ETag")
+        elif r.status_code != 304:
+            return self.jobCache
+
+        self.jobCacheAge = 0
+        return self.jobCache
+
+
+    def getFileInfo(self, filename, location="local"):
+        '''
+        Request info about a file stored on the Pi, including its hash. Cached if a response cache is set.
+        Returns the parsed JSON response (dictionary), or None if the file does not exist or the Pi cannot be reached.
+        '''
+        return self.getCached("http://" + self.ipAddress + "/api/files/" + location + "/" + filename)
+
+
+    def getFileList(self, location="local", recursive=True):
+        '''
+        Request the list of files stored on the Pi. Cached if a response cache is set.
+        Returns the parsed JSON response (dictionary with a "files" list), or None if the Pi cannot be reached.
+        '''
+        url = "http://" + self.ipAddress + "/api/files/" + location
+        if recursive:
+            url += "?recursive=true"
+        return self.getCached(url)
+
+
+    def getPrinterProfiles(self):
+        '''
+        Request the printer profiles set up in Octoprint. Cached if a response cache is set.
+        Returns the parsed JSON response (dictionary with a "profiles" dictionary), or None if the Pi cannot be reached.
+        '''
+        return self.getCached("http://" + self.ipAddress + "/api/printerprofiles")
+
+
+    def getJobFileInfo(self):
+        '''
+        Request info about the file selected for the current print job, using the cached job info.
+        Returns the parsed JSON response (dictionary), or None if no file is selected or the Pi cannot be reached.
+        '''
+        jobJson = self.getCachedPrintJob()
+        fileInfo = ((jobJson or {}).get("job") or {}).get("file") or {}
+        if not fileInfo.get("path"):
+            return None
+        return self.getFileInfo(fileInfo["path"], fileInfo.get("origin") or "local")
+
+
+    def uploadFile(self, path_file, location="local", select=False, printAfterSelect=False):
+        '''
+        Upload a file (e.g. G-code) to the Pi. The file is streamed from disk, not loaded into memory.
+        If select is set, the file is selected for printing once uploaded, and if printAfterSelect is set too,
+        the print is started right away.
+        Returns the response code as integer (201 when the upload succeeded), or None if the Pi cannot be reached.
+        '''
+        url = "http://" + self.ipAddress + "/api/files/" + location
+        fields = {"select": str(select).lower(), "print": str(printAfterSelect).lower()}
+        body = MultipartFileStream(path_file, fields)
+        headers = {"Content-Type": body.contentType, "X-Api-Key": self.apiKey}
+        try:
+            r = self.post(url, headers=headers, data=body, timeout=self.uploadTimeout)
+        finally:
+            body.close()
+        self.invalidateCache()
+        if r is not None:
+            return r.status_code
+        else:
+            errorStr = str(self.ipAddress) + " uploadFile response: No connection to Pi"
+            if self.verbose:
+                print(errorStr)
@@ -0,0 +1,394 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.utils import formatdate
+
+import threading
+import argparse
+import hashlib
+import random
+import json
+import time
+
+'''
+A local stand-in for a farm of Octoprint instances, for testing and benchmarking without real Pis.
+
+One HTTP server simulates any number of printers. Each printer gets its own loopback address (127.0.0.1, 127.0.0.2,
+... 127.0.1.1 and so on), all on the same port, and requests are routed by the address in the Host header.
+Every address in 127.0.0.0/8 reaches the local machine, so clients can use them like the IPs of real Pis.
+
+Implemented endpoints: /api/login, /api/connection, /api/printer, /api/job, /api/files and /api/printerprofiles.
+File and profile responses carry ETag and Last-Modified headers, and conditional requests are answered with 304.
+Latency, failure rates and print duration are configurable. Prints progress in real time once started.
+
+Usage: python octoprintsimulator.py --printers 50 --port 5000 --list SimulatedPrinters.csv
+'''
+
+class SimulatedPrinter:
+
+    def __init__(self, ipAddress, apiKey, connected=True, printDuration=600, finishDuration=5, connectDuration=0):
+        '''
+        Initialize one simulated printer. A print takes printDuration seconds, after which the printer stays in the
+        Finishing state for finishDuration seconds, unless the file has its own duration in fileDurations.
+        After a connect request, the printer takes connectDuration seconds to become operational.
+        '''
+        self.ipAddress = ipAddress
+        self.apiKey = apiKey
+        self.connected = connected
+        self.printDuration = printDuration
+        self.finishDuration = finishDuration
+        self.connectDuration = connectDuration
+        self.readyAt = 0                # Time a connecting printer becomes operational
+        self.files = {}                 # Stored files: name -> (size, SHA1 hash)
+        self.fileDurations = {}         # Print duration of files that do not take printDuration, by name
+        self.filesModified = time.time()    # Time a file was last added, for the Last-Modified header
+        self.selected = None            # Name of the selected file
+        self.printStarted = None        # Time the current print was started
+        self.lock = threading.Lock()
+
+
+    def getPrintDuration(self):
+        return self.fileDurations.get(self.selected, self.printDuration)
+
+
+    def isOperational(self):
+        return self.connected and time.time() >= self.readyAt
+
+
+    def getStateText(self):
+        '''
+        Returns the Octoprint state text, updating the print progress first.
+        '''
+        if not self.connected:
+            return "Closed"
+        if not self.isOperational():
+            return "Connecting"
+        if self.printStarted is None:
+            return "Operational"
+        elapsed = time.time() - self.printStarted
+        if elapsed < self.getPrintDuration():
+            return "Printing"
+        if elapsed < self.getPrintDuration() + self.finishDuration:
+            return "Finishing"
+        self.printStarted = None
+        return "Operational"
+
+
+    def getPrinterJson(self):
+        stateText = self.getStateText()
+        operational = self.isOperational()
+        printing = stateText in ("Printing", "Finishing")
+        flags = {"operational": operational, "printing": printing, "finishing": stateText == "Finishing",
+                 "ready": operational and not printing, "pausing": False, "paused": False, "cancelling": False,
+                 "resuming": False, "error": False, "closedOrError": not self.connected, "sdReady": False}
+        return {"state": {"text": stateText, "flags": flags},
+                "temperature": {"bed": {"actual": 60.0 if printing else 23.5, "target": 60.0 if printing else 0},
+                                "tool0": {"actual": 210.0 if printing else 24.0, "target": 210.0 if printing else 0}}}
+
+
+    def getJobJson(self):
+        stateText = self.getStateText()
+        completion = None
+        if self.printStarted is not None:
+            completion = min(100.0, 100.0 * (time.time() - self.printStarted) / self.getPrintDuration())
+        fileInfo = {"name": self.selected, "origin": "local", "path": self.selected}
+        return {"job": {"file": fileInfo if self.selected else {"name": None}},
+                "progress": {"completion": completion}, "state": stateText}
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True      # Headers and body are written separately, don't delay the body
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+    def sendJson(self, code, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(code)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def sendCacheable(self, body, lastModified):
+        '''
+        Send a JSON response with validators, or 304 Not Modified if the client's copy is still current.
+        '''
+        data = json.dumps(body).encode("utf-8")
+        etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+        lastModifiedText = formatdate(int(lastModified), usegmt=True)
+        if self.headers.get("If-None-Match") == etag or (self.headers.get("If-None-Match") is None and
+                                                         self.headers.get("If-Modified-Since") == lastModifiedText):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", lastModifiedText)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def getPrinter(self):
+        '''
+        Find the simulated printer addressed by the request, simulating latency and failures on the way.
+        Returns the SimulatedPrinter, or None if a response has already been sent (or the connection dropped).
+        '''
+        server = self.server
+        self.server.countRequest()
+        if server.latency:
+            time.sleep(max(0.0, random.gauss(server.latency, server.latencyJitter)))
+
+        printer = server.printers.get(self.headers.get("Host", "").split(":")[0])
+        if printer is None:
+            self.sendJson(404, {"error": "Unknown printer"})
+            return None
+        if random.random() < server.dropRate:
+            # Simulate a Pi that goes away mid-request
+            self.close_connection = True
+            return None
+        if random.random() < server.failureRate:
+            self.sendJson(500, {"error": "Simulated failure"})
+            return None
+        if self.path != "/api/login" and self.headers.get("X-Api-Key") != printer.apiKey:
+            self.sendJson(403, {"error": "Invalid API key"})
+            return None
+        return printer
+
+
+    def readBody(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+
+    def readJson(self):
+        body = self.readBody()
+        return json.loads(body.decode("utf-8")) if body else {}
+
+
+    def do_GET(self):
+        printer = self.getPrinter()
+        if printer is None:
+            return
+        path = self.path.split("?")[0]
+        with printer.lock:
+            if path == "/api/connection":
+                self.sendJson(200, {"current": {"state": printer.getStateText(), "port": "/dev/ttyACM0",
+                                                "baudrate": 115200, "printerProfile": "_default"},
+                                    "options": {}})
+            elif path == "/api/printer":
+                if printer.isOperational():
+                    self.sendJson(200, printer.getPrinterJson())
+                else:
+                    self.sendJson(409, "Printer is not operational")
+            elif path == "/api/job":
+                self.sendJson(200, printer.getJobJson())
+            elif path in ("/api/files", "/api/files/local"):
+                self.sendCacheable({"files": [{"name": name, "path": name, "origin": "local", "size": size,
+                                               "hash": hashValue}
+                                              for name, (size, hashValue) in printer.files.items()]},
+                                   printer.filesModified)
+            elif path.startswith("/api/files/local/"):
+                name = path[len("/api/files/local/"):]
+                if name in printer.files:
+                    size, hashValue = printer.files[name]
+                    self.sendCacheable({"name": name, "path": name, "origin": "local", "size": size,
+                                        "hash": hashValue}, printer.filesModified)
+                else:
+                    self.sendJson(404, {"error": "File not found"})
+            elif path == "/api/printerprofiles":
+                self.sendCacheable({"profiles": {"_default": {"id": "_default", "name": "Simulated printer",
+                                                              "model": "Simulated", "default": True,
+                                                              "volume": {"width": 200, "depth": 200,
+                                                                         "height": 200}}}}, self.server.startTime)
+            else:
+                self.sendJson(404, {"error": "Not found"})
+
+
+    def do_POST(self):
+        printer = self.getPrinter()
+        if printer is None:
+            self.readBody()
+            return
+        path = self.path.split("?")[0]
+        if path == "/api/files/local":
+            self.upload(printer)
+            return
+
+        request = self.readJson()
+        command = request.get("command")
+        with printer.lock:
+            if path == "/api/login":
+                self.sendJson(200, {"name": "simulator", "session": "simulated", "active": True})
+            elif path == "/api/logout":
+                self.sendJson(204)
+            elif path == "/api/connection":
+                if command in ("connect", "disconnect"):
+                    if command == "connect" and not printer.connected:
+                        printer.readyAt = time.time() + printer.connectDuration
+                    printer.connected = command == "connect"
+                    self.sendJson(204)
+                else:
+                    self.sendJson(400, {"error": "Unknown command"})
+            elif path == "/api/job":
+                if command == "start" and printer.getStateText() == "Operational" and printer.selected:
+                    printer.printStarted = time.time()
+                    self.sendJson(204)
+                else:
+                    self.sendJson(409, {"error": "Printer is not operational or no file selected"})
+            elif path.startswith("/api/files/local/") and command == "select":
+                name = path[len("/api/files/local/"):]
+                if name not in printer.files:
+                    self.sendJson(404, {"error": "File not found"})
+                    return
+                printer.selected = name
+                if request.get("print") and printer.getStateText() == "Operational":
+                    printer.printStarted = time.time()
+                self.sendJson(204)
+            else:
+                self.sendJson(404, {"error": "Not found"})
+
+
+    def upload(self, printer):
+        '''
+        Accept a multipart file upload, and honour the select and print form fields.
+        '''
+        body = self.readBody()
+        boundary = self.headers.get("Content-Type", "").split("boundary=")[-1].encode("ascii")
+        fields = {}
+        for part in body.split(b"--" + boundary):
+            if b"\r\n\r\n" not in part:
+                continue
+            headers, content = part.split(b"\r\n\r\n", 1)
+            content = content[:-2] if content.endswith(b"\r\n") else content
+            headers = headers.decode("utf-8", "replace")
+            name = headers.split('name="')[1].split('"')[0] if 'name="' in headers else None
+            if 'filename="' in headers:
+                filename = headers.split('filename="')[1].split('"')[0]
+                fields["file"] = (filename, content)
+            elif name:
+                fields[name] = content.decode("utf-8")
+
+        if "file" not in fields:
+            self.sendJson(400, {"error": "No file included"})
+            return
+        filename, content = fields["file"]
+        with printer.lock:
+            printer.files[filename] = (len(content), hashlib.sha1(content).hexdigest())
+            printer.filesModified = time.time()
+            if fields.get("select") == "true" or fields.get("print") == "true":
+                printer.selected = filename
+            if fields.get("print") == "true" and printer.getStateText() == "Operational":
+                printer.printStarted = time.time()
+        self.sendJson(201, {"done": True, "files": {"local": {"name": filename, "origin": "local"}}})
+
+
+class OctoPrintSimulator(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, printerCount=1, host='', port=0, latency=0.0, latencyJitter=0.0,
+                 failureRate=0.0, dropRate=0.0, printDuration=600, finishDuration=5, disconnectedRate=0.0,
+                 connectDuration=0, verbose=False):
+        '''
+        Initialize a simulator for printerCount printers.
+        latency and latencyJitter (seconds) set the mean and standard deviation of the response delay.
+        failureRate is the fraction of requests answered with HTTP 500, dropRate the fraction of connections
+        closed without an answer. disconnectedRate is the fraction of printers that start out not connected to
+        their Pi, and connectDuration how long printers take to become operational after a connect request.
+        With port=0, a free port is picked. The default host listens on all interfaces, which is needed
+        for the extra loopback addresses to reach the server.
+        '''
+        ThreadingHTTPServer.__init__(self, (host, port), SimulatorHandler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.latencyJitter = latencyJitter
+        self.failureRate = failureRate
+        self.dropRate = dropRate
+        self.verbose = verbose
+        self.requestCount = 0
+        self.startTime = time.time()
+        self.requestCountLock = threading.Lock()
+        self.printers = {}              # SimulatedPrinter for each loopback address
+        for i in range(printerCount):
+            address = "127.0.%d.%d" % (i // 250, i % 250 + 1)
+            self.printers[address] = SimulatedPrinter(address, "SIMKEY%d" % i,
+                                                      random.random() >= disconnectedRate,
+                                                      printDuration, finishDuration, connectDuration)
+
+
+    def countRequest(self):
+        with self.requestCountLock:
+            self.requestCount += 1
+
+
+    def getPrinterList(self):
+        '''
+        Returns ListOfPrinters rows (dictionaries) for all simulated printers, addressed with the simulator's port.
+        Printers are spread over racks of 10, 5 wide and 2 high.
+        '''
+        printerList = []
+        for i, printer in enumerate(self.printers.values()):
+            printerList.append({"ipAddress": printer.ipAddress + ":" + str(self.port), "apiKey": printer.apiKey,
+                                "username": "simulator", "password": "simulator", "rackID": i // 10 + 1,
+                                "xPos": i % 5 + 1, "yPos": i % 10 // 5 + 1, "comment": "simulated"})
+        return printerList
+
+
+    def writePrinterList(self, path_list):
+        '''
+        Write a ListOfPrinters CSV for all simulated printers, for running the main script against the simulator.
+        '''
+        fields = ["ipAddress", "apiKey", "username", "password", "rackID", "xPos", "yPos", "comment"]
+        with open(path_list, 'w') as listFile:
+            listFile.write(",".join(fields) + "\n")
+            for printer in self.getPrinterList():
+                listFile.write(",".join(str(printer[field]) for field in fields) + "\n")
+
+
+    def start(self):
+        '''
+        Serve requests in a background thread.
+        '''
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a farm of Octoprint-connected printers")
+    parser.add_argument("--printers", type=int, default=10)
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="standard deviation of the response delay")
+    parser.add_argument("--failure-rate", dest="failureRate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", dest="dropRate", type=float, default=0.0)
+    parser.add_argument("--print-duration", dest="printDuration", type=float, default=600)
+    parser.add_argument("--disconnected-rate", dest="disconnectedRate", type=float, default=0.0,
+                        help="fraction of printers that start out not connected")
+    parser.add_argument("--connect-duration", dest="connectDuration", type=float, default=0.0,
+                        help="seconds a printer takes to become operational after connecting")
+    parser.add_argument("--list", help="write a ListOfPrinters CSV for the simulated printers to this path")
+    args = parser.parse_args()
+
+    simulator = OctoPrintSimulator(args.printers, port=args.port, latency=args.latency, latencyJitter=args.jitter,
+                                   failureRate=args.failureRate, dropRate=args.dropRate,
+                                   printDuration=args.printDuration, disconnectedRate=args.disconnectedRate,
+                                   connectDuration=args.connectDuration, verbose=True)
+    if args.list:
+        simulator.writePrinterList(args.list)
+    print("Simulating " + str(args.printers) + " printers on port " + str(simulator.port))
+    simulator.serve_forever()
@@ -0,0 +1,128 @@
+import heapq
+import time
+
+'''
+Decides when each printer is polled next, instead of polling every printer every cycle.
+Printers close to finishing a print are polled often, so finished prints are noticed quickly. Printers that are
+printing are polled at the normal cycle time, idle printers less often, and unreachable Pis are backed off
+exponentially. All due times are kept in a priority queue, so finding the printers to poll is cheap on large farms.
+'''
+
+class PollScheduler:
+
+    def __init__(self, fastInterval=1, normalInterval=4, idleInterval=15, maxBackoff=300, nearCompletion=90):
+        '''
+        Initialize the scheduler. Intervals are in seconds.
+        fastInterval:   printing, with progress at or above nearCompletion percent, or finishing
+        normalInterval: printing, pausing or paused
+        idleInterval:   connected but not printing, or the Pi is up but the printer is not connected
+        maxBackoff:     longest interval for unreachable Pis, which start at normalInterval and double per failure
+        '''
+        self.fastInterval = fastInterval
+        self.normalInterval = normalInterval
+        self.idleInterval = idleInterval
+        self.maxBackoff = maxBackoff
+        self.nearCompletion = nearCompletion
+        self.heap = []                  # (due time, sequence number, IP address)
+        self.clients = {}               # OctoPrintClient for each IP address
+        self.dueTimes = {}              # Current due time for each IP address. Heap entries that differ are stale.
+        self.failures = {}              # Consecutive failed polls for each IP address
+        self.sequence = 0
+
+
+    def setClients(self, opcs, now=None):
+        '''
+        Schedule new clients for an immediate poll, and forget clients that are no longer in opcs.
+        Clients that were already scheduled keep their due time and backoff.
+        '''
+        now = time.time() if now is None else now
+        self.clients = {opc.ipAddress: opc for opc in opcs}
+        for ipAddress in list(self.dueTimes):
+            if ipAddress not in self.clients:
+                del self.dueTimes[ipAddress]
+                self.failures.pop(ipAddress, None)
+        for ipAddress in self.clients:
+            if ipAddress not in self.dueTimes:
+                self.schedule(ipAddress, now)
+
+
+    def schedule(self, ipAddress, dueTime):
+        self.dueTimes[ipAddress] = dueTime
+        self.sequence += 1
+        heapq.heappush(self.heap, (dueTime, self.sequence, ipAddress))
+
+
+    def popDue(self, now=None):
+        '''
+        Take all clients that are due for a poll. They stay unscheduled until reschedule() is called for them.
+        Returns a list of OctoPrintClient objects.
+        '''
+        now = time.time() if now is None else now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            dueTime, sequence, ipAddress = heapq.heappop(self.heap)
+            if self.dueTimes.get(ipAddress) == dueTime:
+                del self.dueTimes[ipAddress]
+                due.append(self.clients[ipAddress])
+        return due
+
+
+    def nextDue(self):
+        '''
+        Returns the earliest due time of any scheduled client, or None if nothing is scheduled.
+        '''
+        while self.heap and self.dueTimes.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+
+    def isBackedOff(self, opc):
+        '''
+        Returns True if the last poll of this client failed, so a cheap reachability probe should come first.
+        '''
+        return self.failures.get(opc.ipAddress, 0) > 0
+
+
+    def getInterval(self, opc, status):
+        '''
+        Pick the poll interval for a client based on its latest status, and update its failure count.
+        '''
+        if status is None or status.connected is None:
+            failures = self.failures.get(opc.ipAddress, 0) + 1
+            self.failures[opc.ipAddress] = failures
+            return min(self.normalInterval * 2 ** failures, self.maxBackoff)
+
+        self.failures[opc.ipAddress] = 0
+        if status.finishing or (status.printing and (status.progress or 0) >= self.nearCompletion):
+            return self.fastInterval
+        if status.printing or status.pausing or status.paused:
+            return self.normalInterval
+        return self.idleInterval
+
+
+    def reschedule(self, opc, status, now=None):
+        '''
+        Schedule the next poll of a client after it has been polled, based on the status it returned.
+        '''
+        if opc.ipAddress not in self.clients:
+            return
+        now = time.time() if now is None else now
+        self.schedule(opc.ipAddress, now + self.getInterval(opc, status))
+
+
+    def rescheduleFailed(self, opcs, now=None):
+        '''
+        Schedule the next poll of clients taken by popDue() that were not rescheduled, e.g. because their poll raised
+        an exception. Each of them counts as a failed poll, so it is backed off like an unreachable Pi.
+        '''
+        for opc in opcs:
+            if opc.ipAddress not in self.dueTimes:
+                self.reschedule(opc, None, now)
+
+
+    def pollNow(self, opc, now=None):
+        '''
+        Move a client's next poll forward to now, e.g. after a command has been sent to it.
+        '''
+        if opc.ipAddress in self.clients:
+            self.schedule(opc.ipAddress, time.time() if now is None else now)
@@ -0,0 +1,114 @@
+from octoprintcommunication import OctoPrintClient
+from responsecache import ResponseCache
+from csvreader import readCsvRecords
+
+import logging
+
+'''
+Creates OctoPrintClient objects from the rows of ListOfPrinters.csv, with client settings taken from config.ini.
+Shared by the main script and the command-line tools, so every entry point builds its clients the same way.
+'''
+
+def getClientSettings(config):
+    '''
+    Read the settings that apply to every OctoPrintClient from a ConfigParser object.
+    Returns a dictionary of keyword arguments for OctoPrintClient.
+    '''
+    return {
+        "path_log": config.get('Paths', 'Log', fallback='Log.txt'),
+        "timeout": config.getint('Settings', 'HTTP_timeout', fallback=2),
+        "poolSize": config.getint('HTTP', 'PoolSize', fallback=2),
+        "retries": config.getint('HTTP', 'Retries', fallback=0),
+        "backoffFactor": config.getfloat('HTTP', 'BackoffFactor', fallback=0),
+        "jobRefreshInterval": config.getint('HTTP', 'JobRefreshInterval', fallback=10),
+        "progressRefreshInterval": config.getint('HTTP', 'ProgressRefreshInterval', fallback=2),
+        "uploadTimeout": config.getfloat('Upload', 'Timeout', fallback=300),
+    }
+
+
+def getCacheSettings(config):
+    '''
+    Read the response cache settings from a ConfigParser object.
+    Returns a dictionary of keyword arguments for ResponseCache, or None if the cache is disabled.
+    '''
+    if not config.getboolean('Cache', 'Enabled', fallback=False):
+        return None
+    return {
+        "maxEntries": config.getint('Cache', 'MaxEntries', fallback=2048),
+        "maxBytes": config.getint('Cache', 'MaxBytes', fallback=16777216),
+        "ttls": {"/api/files": config.getfloat('Cache', 'FilesTTL', fallback=60),
+                 "/api/printerprofiles": config.getfloat('Cache', 'ProfilesTTL', fallback=3600)},
+    }
+
+
+def createResponseCache(cacheSettings):
+    '''
+    Create the response cache shared by all clients from getCacheSettings(), or return None if it is disabled.
+    '''
+    return ResponseCache(**cacheSettings) if cacheSettings is not None else None
+
+
+# Columns every row of ListOfPrinters.csv must have, and the ones that must not be empty
+printerColumns = ("ipAddress", "apiKey", "username", "password", "rackID", "xPos", "yPos")
+requiredValues = ("ipAddress", "apiKey")
+
+
+def checkPrinter(printer):
+    '''
+    Check one row of ListOfPrinters.csv.
+    Returns a description of what is wrong with it, or None if a client can be created from it.
+    '''
+    missing = [column for column in printerColumns if column not in printer]
+    if missing:
+        return "missing column " + ", ".join(missing)
+    # pandas reads empty cells as NaN, which is not equal to itself
+    empty = [column for column in requiredValues
+             if printer[column] is None or printer[column] != printer[column] or not str(printer[column]).strip()]
+    if empty:
+        return "empty " + ", ".join(empty)
+    return None
+
+
+def loadPrinterList(path_ListOfPrinters, engine='builtin', strict=False):
+    '''
+    Read ListOfPrinters.csv.
+    Rows a client cannot be created from (missing columns, no IP address or API key) are logged and left out,
+    or if strict is set, a ValueError is raised for the first of them.
+    Returns a list of dictionaries, one per printer, keyed by column header.
+    '''
+    printerList = []
+    for number, printer in enumerate(readCsvRecords(path_ListOfPrinters, engine), 1):
+        error = checkPrinter(printer)
+        if error is None:
+            printerList.append(printer)
+            continue
+        errorStr = (str(path_ListOfPrinters) + ", printer " + str(number) + " (" + str(printer.get("ipAddress")) +
+                    "): " + error)
+        if strict:
+            raise ValueError(errorStr)
+        logging.getLogger(__name__).error(errorStr + ", printer left out")
+    return printerList
+
+
+def createClient(printer, clientSettings, verbose=True, responseCache=None):
+    '''
+    Create an OctoPrintClient from one row of ListOfPrinters.csv.
+    '''
+    return OctoPrintClient(printer['ipAddress'], printer['apiKey'], printer['username'], printer['password'],
+                           printer['rackID'], printer['xPos'], printer['yPos'], verbose=verbose,
+                           responseCache=responseCache, **clientSettings)
+
+
+def updateClient(opc, printer):
+    '''
+    Apply an edited row of ListOfPrinters.csv to an existing OctoPrintClient with the same IP address.
+    The client keeps its session, cached job info and finished flag.
+    Returns True if anything was changed.
+    '''
+    changed = False
+    for attribute, column in (("apiKey", "apiKey"), ("username", "username"), ("password", "password"),
+                              ("rackID", "rackID"), ("xPos", "xPos"), ("yPos", "yPos")):
+        if getattr(opc, attribute) != printer[column]:
+            setattr(opc, attribute, printer[column])
+            changed = True
+    return changed
@@ -0,0 +1,103 @@
+'''
+A typed status record for one printer, as seen by the script during one cycle.
+Records are built by OctoPrintClient.getSnapshot() and consumed by the status export.
+'''
+
+# Row header structure:
+# [IP]; [connected]; [printing]; [ready]; [operational]; [pausing]; [paused]; [finished]; [nozzle temp]; [bed temp]; [print job]; [rack ID]; [X pos]; [Y pos]
+opcStatusFields = "IP;Connected;Printing;Ready;Operational;Pausing;Paused;Finished;NozzleTemp;BedTemp;PrintJob;RackID;Xpos;Ypos"
+
+# Rows are formatted in one step, instead of concatenating a string per field
+csvRowFormat = ";".join(["%s"] * 14)
+
+
+class PrinterStatus:
+
+    # A record is created for every printer on every poll, so fixed slots keep them small and quick to fill
+    __slots__ = ("ipAddress", "rackID", "xPos", "yPos", "connected", "stateText", "printing", "ready", "operational",
+                 "pausing", "paused", "finishing", "printFinished", "bedTemp", "toolTemp", "jobName", "progress")
+
+    def __init__(self, ipAddress, rackID=None, xPos=None, yPos=None):
+        '''
+        Create an empty status record. connected is None until the Pi has answered,
+        False if the Pi answered but the printer is not operational, and True otherwise.
+        '''
+        self.ipAddress = ipAddress
+        self.rackID = rackID
+        self.xPos = xPos
+        self.yPos = yPos
+        self.connected = None
+        self.stateText = None
+        self.printing = None
+        self.ready = None
+        self.operational = None
+        self.pausing = None
+        self.paused = None
+        self.finishing = None
+        self.printFinished = "false"
+        self.bedTemp = None
+        self.toolTemp = None
+        self.jobName = None
+        self.progress = None
+
+
+    def updateFromPrinterJson(self, printerJson):
+        '''
+        Fill in state flags and temperatures from a parsed /api/printer response.
+        '''
+        state = printerJson.get("state", {})
+        flags = state.get("flags", {})
+        self.stateText = state.get("text")
+        self.printing = flags.get("printing")
+        self.ready = flags.get("ready")
+        self.operational = flags.get("operational")
+        self.pausing = flags.get("pausing")
+        self.paused = flags.get("paused")
+        self.finishing = flags.get("finishing")
+        self.connected = bool(self.operational)
+
+        temperature = printerJson.get("temperature")
+        if temperature is not None:
+            self.bedTemp = temperature.get("bed", {}).get("actual")
+            self.toolTemp = temperature.get("tool0", {}).get("actual")
+
+
+    def updateFromJobJson(self, jobJson):
+        '''
+        Fill in the job file name and progress from a parsed /api/job response.
+        '''
+        job = jobJson.get("job") or {}
+        self.jobName = (job.get("file") or {}).get("name")
+        self.progress = (jobJson.get("progress") or {}).get("completion")
+
+
+    def toDict(self):
+        '''
+        Returns the status as a dictionary of all fields, e.g. for storing it as JSON.
+        '''
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+    @classmethod
+    def fromDict(cls, values):
+        '''
+        Create a status record from a dictionary made by toDict(). Unknown fields are ignored.
+        '''
+        status = cls(values.get("ipAddress"))
+        for field in cls.__slots__:
+            if field in values:
+                setattr(status, field, values[field])
+        return status
+
+
+    def toCsvRow(self):
+        '''
+        Returns the status as a row for the status CSV (string, without line break).
+        Printers that are not connected only report their IP and connection state.
+        '''
+        if not self.connected:
+            return str(self.ipAddress) + ";" + str(self.connected) + ";" * 12
+
+        return csvRowFormat % (self.ipAddress, self.connected, self.printing, self.ready, self.operational,
+                               self.pausing, self.paused, self.printFinished, self.bedTemp, self.toolTemp,
+                               self.jobName, self.rackID, self.xPos, self.yPos)
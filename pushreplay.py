@@ -0,0 +1,168 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import argparse
+import threading
+import json
+import time
+
+'''
+A local stand-in for an OctoPrint instance, which replays recorded push messages to anyone subscribing to its
+SockJS xhr_streaming endpoint. Used for testing push mode without a printer.
+
+Recordings are JSON lines files, one push message per line:
+    {"delay": 0.5, "message": {"current": {...}}}
+delay is the number of seconds to wait before sending the message.
+The server also answers /api/printer and /api/job from the last replayed state, so polling fallback can be tested.
+
+Usage: python pushreplay.py pushrecording.jsonl --port 5000
+Then point a client at 127.0.0.1:5000 with any API key.
+'''
+
+def loadRecording(path_recording):
+    '''
+    Read a recording file.
+    Returns a list of (delay, message) tuples.
+    '''
+    recording = []
+    with open(path_recording, 'r') as recordingFile:
+        for line in recordingFile:
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                recording.append((float(entry.get("delay", 0)), entry["message"]))
+    return recording
+
+
+class PushReplayHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+    def sendJson(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def sendChunk(self, data):
+        self.wfile.write(("%x\r\n" % len(data)).encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+    def do_GET(self):
+        current = self.server.current
+        if self.path == "/api/printer":
+            if not current or not current["state"]["flags"].get("operational"):
+                self.sendJson(409, "Printer is not operational")
+            else:
+                temps = current.get("temps") or [{}]
+                self.sendJson(200, {"state": current["state"],
+                                    "temperature": {key: value for key, value in temps[-1].items() if key != "time"}})
+        elif self.path == "/api/job":
+            self.sendJson(200, {"job": current.get("job", {}), "progress": current.get("progress", {}),
+                                "state": current.get("state", {}).get("text")})
+        elif self.path == "/api/connection":
+            stateText = current.get("state", {}).get("text", "Closed") if current else "Closed"
+            self.sendJson(200, {"current": {"state": stateText}})
+        else:
+            self.sendJson(404, {"error": "Not found"})
+
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        if self.path == "/api/login":
+            self.sendJson(200, {"name": "replay", "session": "replaysession"})
+        elif self.path.endswith("/xhr_send"):
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path.endswith("/xhr_streaming"):
+            self.replay()
+        else:
+            self.sendJson(404, {"error": "Not found"})
+
+
+    def replay(self):
+        '''
+        Stream the recording as SockJS frames, sending heartbeats while waiting between messages.
+        The stream is kept open with heartbeats after the last message, unless the server was told to close it.
+        '''
+        self.send_response(200)
+        self.send_header("Content-Type", "application/javascript; charset=UTF-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.close_connection = True
+
+        self.sendChunk(b"h" * 2048 + b"\n")
+        self.sendChunk(b"o\n")
+        for delay, message in self.server.recording:
+            time.sleep(delay)
+            if "current" in message or "history" in message:
+                self.server.current = message.get("current") or message.get("history")
+            frame = "a" + json.dumps([json.dumps(message)]) + "\n"
+            self.sendChunk(frame.encode("utf-8"))
+
+        if self.server.closeAfterReplay:
+            self.sendChunk(b'c[3000,"Go away!"]\n')
+            self.sendChunk(b"")
+            return
+        while not self.server.stopEvent.wait(self.server.heartbeatInterval):
+            self.sendChunk(b"h\n")
+
+
+class PushReplayServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, recording, host='127.0.0.1', port=5000, heartbeatInterval=25,
+                 closeAfterReplay=False, verbose=False):
+        '''
+        Initialize a replay server for a list of (delay, message) tuples, as returned by loadRecording.
+        If closeAfterReplay is set, the stream is closed once the recording has been sent, to test reconnection.
+        '''
+        ThreadingHTTPServer.__init__(self, (host, port), PushReplayHandler)
+        self.recording = recording
+        self.heartbeatInterval = heartbeatInterval
+        self.closeAfterReplay = closeAfterReplay
+        self.verbose = verbose
+        self.current = {}
+        self.stopEvent = threading.Event()
+
+
+    def start(self):
+        '''
+        Serve requests in a background thread.
+        '''
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+    def stop(self):
+        self.stopEvent.set()
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded OctoPrint push messages")
+    parser.add_argument("recording", help="JSON lines file with recorded push messages")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--close", action="store_true", help="close the stream after the last message")
+    args = parser.parse_args()
+
+    server = PushReplayServer(loadRecording(args.recording), args.host, args.port,
+                              closeAfterReplay=args.close, verbose=True)
+    print("Replaying " + args.recording + " on " + args.host + ":" + str(args.port))
+    server.serve_forever()
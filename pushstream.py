@@ -0,0 +1,191 @@
+from printerstatus import PrinterStatus
+
+import threading
+import requests
+import logging
+import random
+import string
+import copy
+import json
+import time
+
+'''
+Subscribes to the OctoPrint push API, so that a client's status is kept up to date as OctoPrint reports changes,
+instead of being polled every cycle.
+
+OctoPrint serves its push API over SockJS. The xhr_streaming transport is used here, as it is plain HTTP and works
+with the Requests library: the server keeps a POST response open and writes one frame per line.
+    o           connection opened
+    h           heartbeat
+    a[...]      array of JSON-encoded messages
+    c[...]      connection closed
+Messages are sent to the server by posting a JSON array of strings to the session's xhr_send URL.
+'''
+
+class PushStream(threading.Thread):
+
+    def __init__(self, opc, staleTimeout=60, reconnectDelay=5):
+        '''
+        Initialize a push stream for one OctoPrintClient.
+        If nothing (not even a heartbeat) is received for staleTimeout seconds, the stream is considered dropped.
+        After a dropped stream, a new connection is attempted after reconnectDelay seconds.
+        '''
+        threading.Thread.__init__(self, name="PushStream " + str(opc.ipAddress), daemon=True)
+        self.opc = opc
+        self.staleTimeout = staleTimeout
+        self.reconnectDelay = reconnectDelay
+        self.baseUrl = "http://" + opc.ipAddress + "/sockjs"
+        self.status = PrinterStatus(opc.ipAddress, opc.rackID, opc.xPos, opc.yPos)
+        self.lock = threading.Lock()
+        self.live = False               # True while the stream is open and the status has been received
+        self.lastReceived = 0           # Time of the last frame, heartbeats included
+        self.version = 0                # Incremented every time the status changes
+        self.stopEvent = threading.Event()
+        self.session = None
+        self.logger = logging.getLogger(__name__)
+
+
+    def isLive(self):
+        '''
+        Returns True if the stream is open and has delivered data recently enough to be trusted.
+        '''
+        return self.live and (time.time() - self.lastReceived) < self.staleTimeout
+
+
+    def getStatus(self):
+        '''
+        Returns a copy of the latest pushed status, so the caller never sees a half-updated record.
+        '''
+        with self.lock:
+            status = copy.copy(self.status)
+        status.printFinished = self.opc.printFinished
+        return status
+
+
+    def stop(self):
+        '''
+        Stop the stream and close its connection.
+        '''
+        self.stopEvent.set()
+        self.live = False
+        if self.session is not None:
+            self.session.close()
+
+
+    def run(self):
+        '''
+        Keep a stream open until stop() is called. Reconnects whenever the stream drops.
+        '''
+        while not self.stopEvent.is_set():
+            try:
+                self.stream()
+            except Exception as e:
+                errorStr = str(self.opc.ipAddress) + " push stream dropped: " + str(e)
+                self.logger.error(errorStr)
+                if self.opc.verbose:
+                    print(errorStr)
+            self.live = False
+            self.stopEvent.wait(self.reconnectDelay)
+
+
+    def stream(self):
+        '''
+        Open one SockJS session, authenticate it and process frames until the connection closes.
+        '''
+        sessionKey = self.passiveLogin()
+        if sessionKey is None:
+            return
+
+        serverId = str(random.randint(0, 999))
+        sessionId = "".join(random.choice(string.ascii_lowercase + string.digits) for i in range(8))
+        sessionUrl = self.baseUrl + "/" + serverId + "/" + sessionId
+
+        self.session = requests.Session()
+        r = self.session.post(sessionUrl + "/xhr_streaming", stream=True,
+                              timeout=(self.opc.timeout, self.staleTimeout))
+        r.raise_for_status()
+
+        buffer = b""
+        for chunk in r.iter_content(chunk_size=None):
+            if self.stopEvent.is_set():
+                break
+            self.lastReceived = time.time()
+            buffer += chunk
+            while b"\n" in buffer:
+                frame, buffer = buffer.split(b"\n", 1)
+                if not self.handleFrame(frame.decode("utf-8"), sessionUrl, sessionKey):
+                    r.close()
+                    return
+        r.close()
+
+
+    def passiveLogin(self):
+        '''
+        Log in with the API key to get a session key for authenticating the push stream.
+        Returns "user:session" as string, or None if the Pi could not be reached.
+        '''
+        url = "http://" + self.opc.ipAddress + "/api/login"
+        headers = {"Content-Type": "application/json", "X-Api-Key": self.opc.apiKey}
+        r = self.opc.post(url, headers=headers, json={"passive": True})
+        if r is None or r.status_code != 200:
+            return None
+        rJson = r.json()
+        return str(rJson["name"]) + ":" + str(rJson["session"])
+
+
+    def handleFrame(self, frame, sessionUrl, sessionKey):
+        '''
+        Handle one SockJS frame.
+        Returns False when the server has closed the session, True otherwise.
+        '''
+        if frame == "o":
+            # Session opened. Authenticate, so OctoPrint starts sending status messages.
+            self.session.post(sessionUrl + "/xhr_send", data=json.dumps([json.dumps({"auth": sessionKey})]),
+                              headers={"Content-Type": "text/plain"}, timeout=self.opc.timeout)
+        elif frame.startswith("a"):
+            for message in json.loads(frame[1:]):
+                self.handleMessage(json.loads(message))
+        elif frame.startswith("c"):
+            return False
+        return True
+
+
+    def handleMessage(self, message):
+        '''
+        Apply one OctoPrint push message to the status.
+        "current" and "history" messages carry state, job, progress and temperatures.
+        "event" messages are used to catch finished prints that might be too short-lived to see in the state flags.
+        '''
+        current = message.get("current") or message.get("history")
+        if current is not None:
+            with self.lock:
+                before = self.status.toCsvRow()
+                self.updateStatus(current)
+                if self.status.toCsvRow() != before:
+                    self.version += 1
+            self.live = True
+
+        event = message.get("event")
+        if event is not None and event.get("type") == "PrintDone":
+            self.opc.printFinished = "true"
+            self.version += 1
+
+
+    def updateStatus(self, current):
+        '''
+        Fill in the status from a "current" or "history" message.
+        Temperatures are sent as a list of samples, and only the latest one is used.
+        '''
+        status = self.status
+        if "state" in current:
+            status.updateFromPrinterJson({"state": current["state"]})
+            if status.finishing:
+                self.opc.printFinished = "true"
+        if "job" in current or "progress" in current:
+            status.updateFromJobJson(current)
+        temps = current.get("temps")
+        if temps:
+            latest = temps[-1]
+            status.bedTemp = (latest.get("bed") or {}).get("actual")
+            status.toolTemp = (latest.get("tool0") or {}).get("actual")
+        status.printFinished = self.opc.printFinished
@@ -0,0 +1,188 @@
+from urllib.parse import urlsplit
+from collections import OrderedDict
+
+import threading
+import metrics
+import time
+
+'''
+Caches OctoPrint responses that rarely change, such as file listings, file info and printer profiles, so they can be
+asked for every cycle without a request to the Pi each time.
+
+One cache is shared by all clients, so its size limit applies to the whole fleet: the least recently used responses
+are dropped once it holds more than maxEntries responses or maxBytes of response bodies. Each endpoint has its own
+time to live (ttls, by path prefix). Endpoints without one are not cached. A response is used as is while it is
+fresh. After that it is revalidated with If-None-Match / If-Modified-Since if the Pi sent an ETag or Last-Modified
+header, so an unchanged response costs an empty 304 answer instead of the full body.
+
+The Cache-Control header of the response is followed: no-store responses are not cached, no-cache responses are
+revalidated every time, and max-age shortens the time to live. Commands that change what the Pi would answer
+(selecting, starting or uploading a file) invalidate the affected entries of that printer right away.
+'''
+
+defaultTTLs = {"/api/files": 60, "/api/printerprofiles": 3600}
+
+
+class CacheEntry:
+
+    __slots__ = ("value", "etag", "lastModified", "expires", "size")
+
+    def __init__(self, value, etag, lastModified, expires, size):
+        self.value = value              # Parsed JSON body
+        self.etag = etag
+        self.lastModified = lastModified
+        self.expires = expires          # Time the entry must be revalidated
+        self.size = size                # Length of the response body in bytes
+
+
+class ResponseCache:
+
+    def __init__(self, maxEntries=2048, maxBytes=16777216, ttls=None):
+        '''
+        Initialize an empty cache. ttls maps path prefixes (e.g. /api/files) to seconds a response stays fresh.
+        The longest matching prefix applies.
+        '''
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttls = dict(defaultTTLs if ttls is None else ttls)
+        self.entries = OrderedDict()    # CacheEntry for each URL, least recently used first
+        self.size = 0                   # Total size of the cached bodies in bytes
+        self.lock = threading.Lock()    # Clients are polled from several threads at once
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+
+
+    def getTTL(self, url):
+        '''
+        Returns the time to live of responses from url in seconds, or None if the endpoint is not cached.
+        '''
+        path = urlsplit(url).path
+        matches = [prefix for prefix in self.ttls if path == prefix or path.startswith(prefix.rstrip("/") + "/")]
+        if not matches:
+            return None
+        return self.ttls[max(matches, key=len)]
+
+
+    def lookup(self, url):
+        '''
+        Find the cached response for url.
+        Returns (value, validators), where value is the cached value if it is still fresh (else None), and validators
+        the conditional request headers to revalidate a stale entry with (empty if there is nothing to revalidate).
+        '''
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None, {}
+            self.entries.move_to_end(url)
+            if time.time() < entry.expires:
+                self.count("hits", url)
+                return entry.value, {}
+            validators = {}
+            if entry.etag is not None:
+                validators["If-None-Match"] = entry.etag
+            if entry.lastModified is not None:
+                validators["If-Modified-Since"] = entry.lastModified
+            return None, validators
+
+
+    def store(self, url, response):
+        '''
+        Cache a response (a Requests response object) for url, following its Cache-Control header.
+        A 304 response refreshes the stale entry instead. Returns the cached value, or None if nothing was cached.
+        '''
+        ttl = self.getTTL(url)
+        cacheControl = self.parseCacheControl(response.headers.get("Cache-Control", ""))
+        if ttl is None or "no-store" in cacheControl:
+            self.invalidate(url)
+            return None
+        if "no-cache" in cacheControl:
+            ttl = 0
+        elif "max-age" in cacheControl:
+            ttl = min(ttl, cacheControl["max-age"])
+        expires = time.time() + ttl
+
+        with self.lock:
+            if response.status_code == 304:
+                entry = self.entries.get(url)
+                if entry is None:
+                    return None
+                entry.expires = expires
+                self.count("revalidated", url)
+                return entry.value
+
+            self.count("misses", url)
+            previous = self.entries.pop(url, None)
+            if previous is not None:
+                self.size -= previous.size
+            if response.status_code != 200:
+                return None
+            value = response.json()
+            size = len(response.content)
+            if size > self.maxBytes:
+                return value
+            self.entries[url] = CacheEntry(value, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                                           expires, size)
+            self.size += size
+            self.stats["stores"] += 1
+            while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+                evictedURL, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+                self.stats["evictions"] += 1
+            return value
+
+
+    def parseCacheControl(self, header):
+        '''
+        Returns the directives of a Cache-Control header as a dictionary. max-age is converted to seconds.
+        '''
+        directives = {}
+        for directive in header.lower().split(","):
+            name, separator, value = directive.strip().partition("=")
+            if not name:
+                continue
+            if name == "max-age":
+                try:
+                    directives[name] = max(0, int(value.strip('"')))
+                except ValueError:
+                    directives["no-cache"] = True
+            else:
+                directives[name] = value
+        return directives
+
+
+    def invalidate(self, urlPrefix):
+        '''
+        Drop every entry whose URL starts with urlPrefix, e.g. all file entries of one printer.
+        Returns the number of entries dropped.
+        '''
+        with self.lock:
+            urls = [url for url in self.entries if url.startswith(urlPrefix)]
+            for url in urls:
+                self.size -= self.entries.pop(url).size
+            self.stats["invalidations"] += len(urls)
+            return len(urls)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+    def count(self, outcome, url):
+        self.stats[outcome] += 1
+        metrics.increment("opc_cache_requests_total", outcome=outcome, endpoint=metrics.endpointLabel(url))
+
+
+    def getStats(self):
+        '''
+        Returns a dictionary with the number of hits, misses, revalidations (304 answers), stores, evictions and
+        invalidations so far, the number of entries and bytes held, and the hit rate. Revalidations count as hits,
+        as the body did not have to be sent again.
+        '''
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.size
+        lookups = stats["hits"] + stats["revalidated"] + stats["misses"]
+        stats["hitRate"] = (stats["hits"] + stats["revalidated"]) / lookups if lookups else 0.0
+        return stats
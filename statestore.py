@@ -0,0 +1,122 @@
+from printerstatus import PrinterStatus
+
+import logging
+import sqlite3
+import json
+import time
+
+'''
+Keeps what the script knows about each printer across restarts: the last status, the finished flag, when the Pi
+last answered and how many polls in a row have failed.
+
+State is stored in a small SQLite database in write-ahead-log mode, so every update is one short append and a crash
+at any point leaves the last committed state intact. Only printers whose state has changed are written, all in one
+transaction per cycle. Every checkpointInterval seconds the log is folded back into the database and rows of
+printers that are no longer in the list are deleted, which keeps both files small.
+'''
+
+class StateStore:
+
+    def __init__(self, path_store, checkpointInterval=300):
+        '''
+        Open (or create) the state database at path_store.
+        '''
+        self.path_store = str(path_store)
+        self.checkpointInterval = checkpointInterval
+        self.saved = {}                 # Last written (status JSON, finished flag, last seen, failures), by IP
+        self.savedStatus = {}           # Status object the saved JSON was made from, by IP address
+        self.pending = {}               # Rows to write on the next commit, by IP address
+        self.lastCheckpoint = time.time()
+        self.logger = logging.getLogger(__name__)
+
+        self.connection = sqlite3.connect(self.path_store, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS printers (ipAddress TEXT PRIMARY KEY, status TEXT, "
+                                "printFinished TEXT, lastSeen REAL, failures INTEGER)")
+        self.connection.commit()
+
+
+    def load(self):
+        '''
+        Read the stored state of every printer.
+        Returns a dictionary by IP address of dictionaries with status (PrinterStatus or None), printFinished,
+        lastSeen (Unix time, or None if the Pi never answered) and failures.
+        '''
+        state = {}
+        for ipAddress, statusJson, printFinished, lastSeen, failures in self.connection.execute(
+                "SELECT ipAddress, status, printFinished, lastSeen, failures FROM printers"):
+            try:
+                status = PrinterStatus.fromDict(json.loads(statusJson)) if statusJson else None
+            except ValueError as e:
+                self.logger.error(self.path_store + ": stored status of " + ipAddress + " is invalid: " + str(e))
+                status = None
+            state[ipAddress] = {"status": status, "printFinished": printFinished or "false",
+                                "lastSeen": lastSeen, "failures": failures or 0}
+            self.saved[ipAddress] = (statusJson, printFinished, lastSeen, failures)
+            self.savedStatus[ipAddress] = status
+        return state
+
+
+    def update(self, ipAddress, status, printFinished, failures=None, now=None):
+        '''
+        Stage the current state of one printer. Nothing is staged if it has not changed since the last commit.
+        status is the latest PrinterStatus (or None), failures the number of failed polls in a row, if known.
+        '''
+        saved = self.saved.get(ipAddress, (None, None, None, None))
+        statusJson, lastSeen = saved[0], saved[2]
+        if status is not None and status is not self.savedStatus.get(ipAddress):
+            # Only serialize status records that have not been seen before
+            statusJson = json.dumps(status.toDict())
+            if status.connected is not None:
+                lastSeen = time.time() if now is None else now
+            self.savedStatus[ipAddress] = status
+        row = (statusJson, printFinished, lastSeen, saved[3] if failures is None else failures)
+
+        # The last seen time alone changes every poll. It is only written along with other changes, or once a minute.
+        if row[:2] != saved[:2] or row[3] != saved[3] or (lastSeen or 0) - (saved[2] or 0) >= 60:
+            self.pending[ipAddress] = row
+            self.saved[ipAddress] = row
+
+
+    def commit(self, ipAddresses=None):
+        '''
+        Write all staged changes in one transaction. Returns the number of printers written.
+        If ipAddresses (the printers currently in the list) is given, the periodic checkpoint also deletes the
+        rows of all other printers.
+        '''
+        written = len(self.pending)
+        if self.pending:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO printers (ipAddress, status, printFinished, lastSeen, failures) "
+                    "VALUES (?, ?, ?, ?, ?)", [(ipAddress,) + row for ipAddress, row in self.pending.items()])
+            self.pending.clear()
+
+        if time.time() - self.lastCheckpoint >= self.checkpointInterval:
+            self.compact(ipAddresses)
+        return written
+
+
+    def compact(self, ipAddresses=None):
+        '''
+        Delete the rows of printers that are not in ipAddresses (if given), and fold the write-ahead log back into
+        the database.
+        '''
+        if ipAddresses is not None:
+            keep = set(ipAddresses)
+            removed = [(ipAddress,) for ipAddress in self.saved if ipAddress not in keep]
+            if removed:
+                with self.connection:
+                    self.connection.executemany("DELETE FROM printers WHERE ipAddress = ?", removed)
+                for (ipAddress,) in removed:
+                    del self.saved[ipAddress]
+                    self.savedStatus.pop(ipAddress, None)
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.lastCheckpoint = time.time()
+
+
+    def close(self):
+        self.commit()
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.connection.close()
@@ -0,0 +1,331 @@
+from printerstatus import opcStatusFields
+
+import logging
+import struct
+import heapq
+import math
+import mmap
+import time
+import os
+
+'''
+Exports printer status to the IPC. Each export backend is a StatusWriter, and several can be used side by side.
+
+CsvStatusWriter publishes the status CSV atomically: rows are written to a temporary file next to the status file,
+which is then renamed over it. Readers therefore see either the old or the new file, never a partially written one.
+
+MmapStatusWriter publishes the same fields as fixed-layout binary records in a memory-mapped file, so the IPC can
+read a printer's status without parsing text. The layout (little-endian) is:
+    Header, 16 bytes:   magic "OPCS", version (uint16), record size (uint16), slot count (uint32), used slots (uint32)
+    Record, 128 bytes:  sequence (uint32), flags (uint16), 2 padding bytes, nozzle temp (float32), bed temp (float32),
+                        progress (float32), rack ID (int32), X pos (int32), Y pos (int32),
+                        IP address (32 bytes, UTF-8, zero-padded), print job (64 bytes, UTF-8, zero-padded)
+Unknown temperatures and progress are NaN, unknown positions are -1.
+The sequence counter is odd while a record is being written. A reader should read the sequence, then the record,
+then the sequence again, and retry if the two differ or are odd.
+A printer keeps its slot while it is in the printer list. The slot of a removed printer is cleared (valid flag off),
+and may be given to a printer added later, from the next export on. Readers that keep slot numbers should check the
+IP address in the record.
+'''
+
+mmapHeaderFormat = struct.Struct("<4sHHII")
+mmapRecordFormat = struct.Struct("<IHxxfffiii32s64s")
+mmapMagic = b"OPCS"
+mmapVersion = 1
+
+# Bits in the record flags field
+flagValid = 1 << 0
+flagReachable = 1 << 1
+flagConnected = 1 << 2
+flagPrinting = 1 << 3
+flagReady = 1 << 4
+flagOperational = 1 << 5
+flagPausing = 1 << 6
+flagPaused = 1 << 7
+flagFinished = 1 << 8
+
+
+class StatusWriter:
+    '''
+    Base class for status export backends.
+    '''
+
+    def write(self, statuses):
+        '''
+        Export a list of PrinterStatus objects.
+        Returns True if anything was written, False if the export was skipped.
+        '''
+        raise NotImplementedError
+
+
+    def close(self):
+        '''
+        Release any files held by the backend.
+        '''
+        pass
+
+
+class CsvStatusWriter(StatusWriter):
+
+    def __init__(self, path_status, replaceAttempts=5, replaceDelay=0.05):
+        '''
+        Initialize a writer for the status CSV at path_status.
+        On Windows the rename fails while a reader has the file open, so it is retried replaceAttempts times,
+        replaceDelay seconds apart.
+        '''
+        self.path_status = str(path_status)
+        self.path_temp = self.path_status + ".tmp"
+        self.replaceAttempts = replaceAttempts
+        self.replaceDelay = replaceDelay
+        self.lastRows = {}              # Last exported row for each printer, by IP address
+        self.lastOrder = []             # IP addresses in the order they were last exported
+        self.lastWriteLatency = 0.0     # Seconds spent writing in the last cycle (0 if skipped)
+        self.lastBytesWritten = 0       # Bytes written in the last cycle (0 if skipped)
+        self.writeCount = 0             # Number of times the file has been published
+        self.skipCount = 0              # Number of cycles skipped because nothing changed
+        self.logger = logging.getLogger(__name__)
+
+
+    def write(self, statuses):
+        '''
+        Export a list of PrinterStatus objects, one row per printer.
+        Nothing is written if no row has changed since the last export.
+        Returns True if the file was written, False if the write was skipped.
+        '''
+        order = [status.ipAddress for status in statuses]
+        rows = {status.ipAddress: status.toCsvRow() for status in statuses}
+
+        if order == self.lastOrder and rows == self.lastRows:
+            self.lastWriteLatency = 0.0
+            self.lastBytesWritten = 0
+            self.skipCount += 1
+            return False
+
+        startTime = time.perf_counter()
+        data = opcStatusFields + "\n" + "".join(rows[ipAddress] + "\n" for ipAddress in order)
+        with open(self.path_temp, 'w') as tempFile:
+            tempFile.write(data)
+            tempFile.flush()
+            os.fsync(tempFile.fileno())
+        bytesWritten = os.path.getsize(self.path_temp)
+        self.replace()
+
+        self.lastRows = rows
+        self.lastOrder = order
+        self.lastWriteLatency = time.perf_counter() - startTime
+        self.lastBytesWritten = bytesWritten
+        self.writeCount += 1
+        return True
+
+
+    def replace(self):
+        '''
+        Rename the temporary file over the status file, retrying while the status file is locked by a reader.
+        '''
+        for attempt in range(self.replaceAttempts):
+            try:
+                os.replace(self.path_temp, self.path_status)
+                return
+            except PermissionError:
+                if attempt == self.replaceAttempts - 1:
+                    raise
+                time.sleep(self.replaceDelay)
+
+
+class MmapStatusWriter(StatusWriter):
+
+    def __init__(self, path_status, slotCount=64):
+        '''
+        Initialize a writer for the binary status file at path_status, with room for slotCount printers.
+        Every printer keeps its slot while it is in the list, so the IPC can index records directly.
+        '''
+        self.path_status = str(path_status)
+        self.slotCount = slotCount
+        self.slots = {}                 # Slot number for each printer, by IP address
+        self.freeSlots = []             # Heap of slots given up by removed printers, to be reused lowest first
+        self.usedSlots = 0              # Slots handed out so far, which readers have to scan
+        self.lastRecords = {}           # Last record written to each slot, without the sequence counter
+        self.warnedFull = set()         # IP addresses already logged as having no slot, so they are logged once
+        self.lastWriteLatency = 0.0
+        self.lastBytesWritten = 0
+        self.logger = logging.getLogger(__name__)
+
+        size = mmapHeaderFormat.size + slotCount * mmapRecordFormat.size
+        with open(self.path_status, 'wb') as statusFile:
+            statusFile.write(b"\0" * size)
+        self.file = open(self.path_status, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), size)
+        mmapHeaderFormat.pack_into(self.map, 0, mmapMagic, mmapVersion, mmapRecordFormat.size, slotCount, 0)
+
+
+    def write(self, statuses):
+        '''
+        Update the records of all printers whose status has changed. Unchanged records are not touched.
+        Printers that are no longer in the list have their record cleared, and their slot is freed for reuse.
+        Returns True if any record was written.
+        '''
+        startTime = time.perf_counter()
+        written = 0
+        present = set()
+
+        for status in statuses:
+            slot = self.getSlot(status.ipAddress)
+            if slot is None:
+                continue
+            present.add(status.ipAddress)
+            if self.writeRecord(slot, self.packRecord(status)):
+                written += 1
+
+        for ipAddress in [ipAddress for ipAddress in self.slots if ipAddress not in present]:
+            slot = self.slots.pop(ipAddress)
+            if self.writeRecord(slot, self.emptyRecord()):
+                written += 1
+            heapq.heappush(self.freeSlots, slot)
+        self.warnedFull.intersection_update(status.ipAddress for status in statuses)
+
+        self.lastWriteLatency = time.perf_counter() - startTime
+        self.lastBytesWritten = written * mmapRecordFormat.size
+        return written > 0
+
+
+    def getSlot(self, ipAddress):
+        '''
+        Returns the slot number for a printer, assigning the lowest free slot to new printers.
+        Returns None if all slots are taken. This is logged once for each printer until it gets a slot.
+        '''
+        slot = self.slots.get(ipAddress)
+        if slot is None:
+            if self.freeSlots:
+                slot = heapq.heappop(self.freeSlots)
+            elif self.usedSlots < self.slotCount:
+                slot = self.usedSlots
+                self.usedSlots += 1
+                mmapHeaderFormat.pack_into(self.map, 0, mmapMagic, mmapVersion, mmapRecordFormat.size,
+                                           self.slotCount, self.usedSlots)
+            else:
+                if ipAddress not in self.warnedFull:
+                    self.logger.error("Binary status file is full, no slot for " + str(ipAddress))
+                    self.warnedFull.add(ipAddress)
+                return None
+            self.slots[ipAddress] = slot
+            self.warnedFull.discard(ipAddress)
+        return slot
+
+
+    def writeRecord(self, slot, record):
+        '''
+        Write one record to its slot, bracketed by the sequence counter so readers can detect torn reads.
+        Returns False if the record was unchanged and nothing was written.
+        '''
+        if self.lastRecords.get(slot) == record:
+            return False
+        offset = mmapHeaderFormat.size + slot * mmapRecordFormat.size
+        sequence = struct.unpack_from("<I", self.map, offset)[0]
+        struct.pack_into("<I", self.map, offset, (sequence + 1) & 0xFFFFFFFF)
+        self.map[offset + 4:offset + mmapRecordFormat.size] = record
+        struct.pack_into("<I", self.map, offset, (sequence + 2) & 0xFFFFFFFF)
+        self.lastRecords[slot] = record
+        return True
+
+
+    def packRecord(self, status):
+        '''
+        Pack a PrinterStatus into the binary record layout, without the leading sequence counter.
+        '''
+        flags = flagValid
+        if status.connected is not None:
+            flags |= flagReachable
+        if status.connected:
+            flags |= flagConnected
+            for value, flag in ((status.printing, flagPrinting), (status.ready, flagReady),
+                                (status.operational, flagOperational), (status.pausing, flagPausing),
+                                (status.paused, flagPaused)):
+                if value:
+                    flags |= flag
+            if status.printFinished == "true":
+                flags |= flagFinished
+
+        return mmapRecordFormat.pack(0, flags,
+                                     toFloat(status.toolTemp), toFloat(status.bedTemp), toFloat(status.progress),
+                                     toInt(status.rackID), toInt(status.xPos), toInt(status.yPos),
+                                     str(status.ipAddress).encode("utf-8")[:32],
+                                     str(status.jobName or "").encode("utf-8")[:64])[4:]
+
+
+    def emptyRecord(self):
+        return bytes(mmapRecordFormat.size - 4)
+
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+def toFloat(value):
+    '''
+    Convert a status value to float, using NaN for unknown values.
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def toInt(value):
+    '''
+    Convert a status value to int, using -1 for unknown values.
+    '''
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+def readMmapStatus(path_status, retries=10):
+    '''
+    Read all valid records from a binary status file, the same way the IPC is expected to.
+    Returns a list of dictionaries, one per printer.
+    '''
+    with open(path_status, 'rb') as statusFile:
+        statusMap = mmap.mmap(statusFile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, recordSize, slotCount, usedSlots = mmapHeaderFormat.unpack_from(statusMap, 0)
+            if magic != mmapMagic or recordSize != mmapRecordFormat.size:
+                raise ValueError(str(path_status) + " is not a version " + str(mmapVersion) + " status file")
+
+            records = []
+            for slot in range(usedSlots):
+                offset = mmapHeaderFormat.size + slot * recordSize
+                for attempt in range(retries):
+                    fields = mmapRecordFormat.unpack_from(statusMap, offset)
+                    sequence = struct.unpack_from("<I", statusMap, offset)[0]
+                    if fields[0] == sequence and sequence % 2 == 0:
+                        break
+                else:
+                    continue
+
+                flags = fields[1]
+                if not flags & flagValid:
+                    continue
+                records.append({
+                    "ipAddress": fields[8].rstrip(b"\0").decode("utf-8", "ignore"),
+                    "reachable": bool(flags & flagReachable),
+                    "connected": bool(flags & flagConnected),
+                    "printing": bool(flags & flagPrinting),
+                    "ready": bool(flags & flagReady),
+                    "operational": bool(flags & flagOperational),
+                    "pausing": bool(flags & flagPausing),
+                    "paused": bool(flags & flagPaused),
+                    "finished": bool(flags & flagFinished),
+                    "nozzleTemp": fields[2],
+                    "bedTemp": fields[3],
+                    "progress": fields[4],
+                    "rackID": fields[5],
+                    "xPos": fields[6],
+                    "yPos": fields[7],
+                    "printJob": fields[9].rstrip(b"\0").decode("utf-8", "ignore"),
+                })
+            return records
+        finally:
+            statusMap.close()
@@ -1,16 +1,344 @@
+from commandingestion import Command, adminAddresses
+from jobdispatcher import isJobTarget
+from printerstatus import opcStatusFields
+
+import collections
+import threading
+import selectors
+import logging
 import socket
+import queue
 
 '''
-A work in progress. Currently debating whether to use it or not.
-It does what it says on the tin: handles transfer of data over TCP
+Handles transfer of data over TCP: a local command and status server for the IPC, SCADA software and other clients,
+as a faster alternative to the command and status files.
+
+The server runs in a background thread on a selectors event loop, so any number of clients can be connected at the
+same time without a thread each. The protocol is line based (UTF-8, one message per line, ending in a line break):
+
+    Client to server                    Server to client
+    <IP>;<command>;<argument>           ACK <number>, or ERR <reason>. "," may be used as delimiter as well.
+                                        Print jobs may be sent to any or rack:<ID> instead of an IP address.
+    SUBSCRIBE                           OK, then STATUS <row> for every printer, and after that a STATUS <row>
+                                        for every printer whose status changes (REMOVED <IP> if it is removed)
+    UNSUBSCRIBE                         OK
+    STATUS                              HEADER <fields>, STATUS <row> for every printer, then END
+    PING                                PONG
+
+Commands are the same as in PrinterCommands.csv, and status rows the same as in the status CSV. A command is
+acknowledged as soon as it has been queued. The main loop is woken up right away to carry it out, instead of
+picking it up at the end of its cycle.
 '''
 
 def createServerSocket(hostname='127.0.0.1', port=80):
     '''
     Create a server socket from hostname/IP address & port number.
     If no arguments are passed, a local server socket will be established.
+    Returns the listening socket, in non-blocking mode.
     '''
     serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     serversocket.bind((hostname, port))
     # Start listening
-    serversocket.listen()
\ No newline at end of file
+    serversocket.listen()
+    serversocket.setblocking(False)
+    return serversocket
+
+
+class ClientConnection:
+
+    def __init__(self, clientSocket, address):
+        '''
+        State of one connected client: unparsed input, unsent output and whether it is subscribed to status.
+        '''
+        self.socket = clientSocket
+        self.address = address
+        self.inBuffer = b""
+        self.outBuffer = bytearray()
+        self.subscribed = False
+
+
+class CommandServer:
+
+    def __init__(self, host='127.0.0.1', port=5050, maxClients=64, maxLineLength=4096, maxOutBuffer=1048576):
+        '''
+        Initialize a server listening on host:port. Connections beyond maxClients are refused.
+        Clients sending lines longer than maxLineLength bytes, or not reading their output until more than
+        maxOutBuffer bytes are waiting, are disconnected.
+        '''
+        self.serverSocket = createServerSocket(host, port)
+        self.port = self.serverSocket.getsockname()[1]
+        self.maxClients = maxClients
+        self.maxLineLength = maxLineLength
+        self.maxOutBuffer = maxOutBuffer
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.serverSocket, selectors.EVENT_READ, None)
+        # Other threads wake the event loop by writing a byte to this socket pair
+        self.wakeReceiver, self.wakeSender = socket.socketpair()
+        self.wakeReceiver.setblocking(False)
+        self.wakeSender.setblocking(False)
+        self.selector.register(self.wakeReceiver, selectors.EVENT_READ, None)
+
+        self.clients = {}               # ClientConnection for each client socket
+        self.commands = queue.Queue()   # Commands received, for the main loop to pick up
+        self.commandEvent = threading.Event()   # Set when commands are waiting
+        self.statusUpdates = queue.Queue()      # Changed status rows from the main loop, to send to subscribers
+        self.rows = collections.OrderedDict()   # Latest status row of each printer, by IP address (server thread)
+        self.publishedRows = {}         # Latest status row of each printer, by IP address (main thread)
+        self.addresses = frozenset()    # IP addresses that commands may be sent to
+        self.commandCount = 0
+        self.running = False
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+
+    def start(self):
+        '''
+        Run the event loop in a background thread.
+        '''
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name="CommandServer", daemon=True)
+        self.thread.start()
+        return self.thread
+
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread is not None:
+            self.thread.join(2)
+        for connection in list(self.clients.values()):
+            self.disconnect(connection)
+        self.selector.close()
+        self.serverSocket.close()
+        self.wakeReceiver.close()
+        self.wakeSender.close()
+
+
+    def wake(self):
+        try:
+            self.wakeSender.send(b"\0")
+        except OSError:
+            pass                        # The wake buffer is full, so the loop is about to wake up anyway
+
+
+    def setAddresses(self, ipAddresses):
+        '''
+        Set the IP addresses of the printers that commands may be sent to. Called from the main loop.
+        '''
+        self.addresses = frozenset(ipAddresses)
+
+
+    def popCommands(self):
+        '''
+        Take all commands received since the last call. Called from the main loop.
+        Returns a list of Command tuples, in the order they were received.
+        '''
+        self.commandEvent.clear()
+        commands = []
+        while True:
+            try:
+                commands.append(self.commands.get_nowait())
+            except queue.Empty:
+                return commands
+
+
+    def waitForCommands(self, timeout):
+        '''
+        Sleep for up to timeout seconds, waking up early when a command arrives. Called from the main loop.
+        Returns True if commands are waiting.
+        '''
+        return self.commandEvent.wait(max(0, timeout))
+
+
+    def publishStatus(self, statuses):
+        '''
+        Send the rows of all printers whose status changed since the last call to every subscriber.
+        Called from the main loop with the PrinterStatus records of every printer.
+        '''
+        changed = []
+        for status in statuses:
+            row = status.toCsvRow()
+            if self.publishedRows.get(status.ipAddress) != row:
+                self.publishedRows[status.ipAddress] = row
+                changed.append((status.ipAddress, row))
+        for ipAddress in set(self.publishedRows) - {status.ipAddress for status in statuses}:
+            del self.publishedRows[ipAddress]
+            changed.append((ipAddress, None))
+        if changed:
+            self.statusUpdates.put(changed)
+            self.wake()
+
+
+    def serve(self):
+        '''
+        The event loop: accept clients, read and answer their messages, and send status updates to subscribers.
+        '''
+        while self.running:
+            try:
+                events = self.selector.select(timeout=1)
+            except OSError as e:
+                self.logger.error("Command server: " + str(e))
+                continue
+            for key, mask in events:
+                if key.fileobj is self.serverSocket:
+                    self.accept()
+                elif key.fileobj is self.wakeReceiver:
+                    try:
+                        while self.wakeReceiver.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    connection = key.data
+                    if mask & selectors.EVENT_READ:
+                        self.receive(connection)
+                    if mask & selectors.EVENT_WRITE and connection.socket in self.clients:
+                        self.send(connection)
+            self.broadcastStatus()
+
+
+    def accept(self):
+        try:
+            clientSocket, address = self.serverSocket.accept()
+        except OSError:
+            return
+        if len(self.clients) >= self.maxClients:
+            self.logger.error("Command server: too many clients, refusing " + str(address))
+            clientSocket.close()
+            return
+        clientSocket.setblocking(False)
+        clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = ClientConnection(clientSocket, address)
+        self.clients[clientSocket] = connection
+        self.selector.register(clientSocket, selectors.EVENT_READ, connection)
+
+
+    def disconnect(self, connection):
+        self.clients.pop(connection.socket, None)
+        try:
+            self.selector.unregister(connection.socket)
+        except (KeyError, ValueError):
+            pass
+        connection.socket.close()
+
+
+    def receive(self, connection):
+        '''
+        Read what the client has sent, and handle every complete line.
+        '''
+        try:
+            data = connection.socket.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.disconnect(connection)
+            return
+
+        connection.inBuffer += data
+        *lines, connection.inBuffer = connection.inBuffer.split(b"\n")
+        if len(connection.inBuffer) > self.maxLineLength:
+            self.logger.error("Command server: line too long from " + str(connection.address))
+            self.disconnect(connection)
+            return
+        for line in lines:
+            self.handleLine(connection, line.decode("utf-8", "replace").strip())
+        if connection.outBuffer:
+            self.send(connection)
+
+
+    def handleLine(self, connection, line):
+        '''
+        Answer one message from a client.
+        '''
+        if not line:
+            return
+        keyword = line.upper()
+        if keyword == "PING":
+            self.reply(connection, "PONG")
+        elif keyword == "SUBSCRIBE":
+            connection.subscribed = True
+            self.reply(connection, "OK")
+            for row in self.rows.values():
+                self.reply(connection, "STATUS " + row)
+        elif keyword == "UNSUBSCRIBE":
+            connection.subscribed = False
+            self.reply(connection, "OK")
+        elif keyword == "STATUS":
+            self.reply(connection, "HEADER " + opcStatusFields)
+            for row in self.rows.values():
+                self.reply(connection, "STATUS " + row)
+            self.reply(connection, "END")
+        else:
+            self.handleCommand(connection, line)
+
+
+    def handleCommand(self, connection, line):
+        '''
+        Queue a command line (IP;command;argument) for the main loop, and acknowledge it.
+        '''
+        delimiter = ";" if ";" in line else ","
+        fields = [field.strip() for field in line.split(delimiter, 2)]
+        if len(fields) < 2:
+            self.reply(connection, "ERR expected <IP>;<command>;<argument>")
+            return
+        command = Command(fields[0], fields[1], fields[2] if len(fields) > 2 else "")
+        connectAll = command.command.lower() == "connect" and command.argument.lower() == "all"
+        if (command.ipAddress not in self.addresses and command.ipAddress.lower() not in adminAddresses and
+                not connectAll and not isJobTarget(command.ipAddress)):
+            self.reply(connection, "ERR unknown printer " + command.ipAddress)
+            return
+        self.commandCount += 1
+        self.commands.put(command)
+        self.commandEvent.set()
+        self.reply(connection, "ACK " + str(self.commandCount))
+
+
+    def reply(self, connection, message):
+        connection.outBuffer += (message + "\n").encode("utf-8")
+
+
+    def send(self, connection):
+        '''
+        Send as much of the client's output as the socket takes, and wait for it to become writable if any is left.
+        '''
+        try:
+            sent = connection.socket.send(connection.outBuffer)
+            del connection.outBuffer[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.disconnect(connection)
+            return
+        if len(connection.outBuffer) > self.maxOutBuffer:
+            self.logger.error("Command server: " + str(connection.address) + " is not reading, disconnecting")
+            self.disconnect(connection)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if connection.outBuffer else 0)
+        self.selector.modify(connection.socket, events, connection)
+
+
+    def broadcastStatus(self):
+        '''
+        Send the status updates published by the main loop to all subscribers.
+        '''
+        while True:
+            try:
+                changed = self.statusUpdates.get_nowait()
+            except queue.Empty:
+                return
+            for ipAddress, row in changed:
+                if row is None:
+                    self.rows.pop(ipAddress, None)
+                else:
+                    self.rows[ipAddress] = row
+            subscribers = [connection for connection in self.clients.values() if connection.subscribed]
+            if not subscribers:
+                continue
+            message = "".join("REMOVED " + ipAddress + "\n" if row is None else "STATUS " + row + "\n"
+                              for ipAddress, row in changed).encode("utf-8")
+            for connection in subscribers:
+                connection.outBuffer += message
+                self.send(connection)
@@ -0,0 +1,81 @@
+from pathlib import Path
+
+import importlib.util
+import configparser
+import logging
+import pytest
+import sys
+
+'''
+Shared fixtures. The modules live in the repository root, next to __main__.py, so it is put on the import path.
+Every OctoPrintClient sets up the log file on its own with logging.basicConfig(), so the root logger is configured
+here first, and the tests do not write Log.txt into the working directory.
+'''
+
+repoRoot = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repoRoot))
+logging.basicConfig(level=logging.INFO, handlers=[logging.NullHandler()])
+
+from octoprintsimulator import OctoPrintSimulator
+
+
+@pytest.fixture
+def simulator():
+    '''
+    A simulated farm of 4 printers, in one rack, served in a background thread.
+    '''
+    simulator = OctoPrintSimulator(4, printDuration=600, finishDuration=1)
+    simulator.start()
+    yield simulator
+    simulator.stop()
+
+
+@pytest.fixture
+def communicatorSettings():
+    '''
+    config.ini sections for the communicator fixture. Everything not given here falls back to the code defaults, so
+    the tests do not depend on the repository's config.ini. Override this fixture in a test module to change them.
+    '''
+    return {
+        "Paths": {"ListOfPrinters": "ListOfPrinters.csv", "PrinterStatus": "PrinterStatus.csv",
+                  "PrinterCommands": "PrinterCommands.csv", "Log": "Log.txt"},
+        "Settings": {"StartupAutoConnect": "False", "Verbose": "False", "HTTP_timeout": "2", "CycleTime": "4",
+                     "PollWorkers": "4"},
+        "Scheduler": {"Enabled": "True"},
+        "Dispatcher": {"Enabled": "True"},
+    }
+
+
+@pytest.fixture
+def communicator(simulator, communicatorSettings, tmp_path, monkeypatch):
+    '''
+    The main script, loaded as a module in a scratch directory holding a config.ini built from communicatorSettings
+    and a ListOfPrinters.csv for the simulated printers, with setup() run and the printers imported.
+    The main loop itself is not started.
+    '''
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read_dict(communicatorSettings)
+    with open(str(tmp_path / "config.ini"), 'w') as configFile:
+        config.write(configFile)
+    simulator.writePrinterList(str(tmp_path / "ListOfPrinters.csv"))
+    monkeypatch.chdir(tmp_path)
+
+    spec = importlib.util.spec_from_file_location("communicator", str(repoRoot / "__main__.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.setup()
+    module.importPrinterList()
+    module.router.setClients(module.opcs)
+    if module.scheduler is not None:
+        module.scheduler.setClients(module.opcs)
+    yield module
+
+    for opc in module.opcs:
+        opc.close()
+    for statusWriter in module.statusWriters:
+        statusWriter.close()
+    if module.stateStore is not None:
+        module.stateStore.close()
+    module.poller.shutdown()
+    module.connectionManager.shutdown()
@@ -0,0 +1,129 @@
+from commandingestion import Command, CommandIngestor, CommandRouter
+from types import SimpleNamespace
+
+import logging
+import os
+
+
+header = "IP_Address,Command,Argument\n"
+
+
+def append(path, text):
+    with open(path, 'a') as commandFile:
+        commandFile.write(text)
+
+
+def test_only_new_lines_are_read(tmp_path):
+    path_commands = tmp_path / "PrinterCommands.csv"
+    append(path_commands, header + "10.0.0.1,home,\n")
+    ingestor = CommandIngestor(path_commands, truncateWhenDrained=False)
+    assert ingestor.poll() == [Command("10.0.0.1", "home", "")]
+    assert ingestor.poll() == []
+
+    append(path_commands, "10.0.0.2,print,/api/files/local/part.gcode\n")
+    assert ingestor.poll() == [Command("10.0.0.2", "print", "/api/files/local/part.gcode")]
+
+
+def test_partial_line_waits_until_complete(tmp_path):
+    path_commands = tmp_path / "PrinterCommands.csv"
+    append(path_commands, header + "10.0.0.1,home,\n10.0.0.2,pri")
+    ingestor = CommandIngestor(path_commands, truncateWhenDrained=False)
+    assert ingestor.poll() == [Command("10.0.0.1", "home", "")]
+
+    append(path_commands, "nt,/api/files/local/part.gcode\n")
+    assert ingestor.poll() == [Command("10.0.0.2", "print", "/api/files/local/part.gcode")]
+
+
+def test_restart_does_not_replay_commands(tmp_path):
+    path_commands = tmp_path / "PrinterCommands.csv"
+    append(path_commands, header + "10.0.0.1,home,\n")
+    assert len(CommandIngestor(path_commands, truncateWhenDrained=False).poll()) == 1
+
+    append(path_commands, "10.0.0.1,cancel,\n")
+    restarted = CommandIngestor(path_commands, truncateWhenDrained=False)
+    assert restarted.poll() == [Command("10.0.0.1", "cancel", "")]
+
+
+def test_file_replaced_while_stopped_is_read_from_the_start(tmp_path):
+    path_commands = tmp_path / "PrinterCommands.csv"
+    append(path_commands, header + "10.0.0.1,home,\n")
+    assert len(CommandIngestor(path_commands, truncateWhenDrained=False).poll()) == 1
+
+    # The IPC deleted the file and wrote a new one, longer than the old offset, before the script restarted
+    os.remove(path_commands)
+    append(path_commands, header + "10.0.0.2,cancel,\n10.0.0.3,home,\n")
+    restarted = CommandIngestor(path_commands, truncateWhenDrained=False)
+    assert restarted.poll() == [Command("10.0.0.2", "cancel", ""), Command("10.0.0.3", "home", "")]
+
+    # Lines appended to the new file are still read from the journal offset
+    append(path_commands, "10.0.0.1,cancel,\n")
+    assert CommandIngestor(path_commands, truncateWhenDrained=False).poll() == [Command("10.0.0.1", "cancel", "")]
+
+
+def test_drained_file_is_renamed_and_read_on(tmp_path):
+    path_commands = tmp_path / "PrinterCommands.csv"
+    ingestor = CommandIngestor(path_commands)
+    # The IPC keeps the file open while the ingestor renames it
+    with open(path_commands, 'a') as writer:
+        writer.write(header + "10.0.0.1,home,\n")
+        writer.flush()
+        assert ingestor.poll() == [Command("10.0.0.1", "home", "")]
+        assert not path_commands.exists()
+        assert os.path.exists(ingestor.path_drained)
+
+        writer.write("10.0.0.1,cancel,\n")
+        writer.flush()
+        assert ingestor.poll() == [Command("10.0.0.1", "cancel", "")]
+
+    # The IPC starts a new file with its next command, which has its own header
+    append(path_commands, header + "10.0.0.2,home,\n")
+    assert ingestor.poll() == [Command("10.0.0.2", "home", "")]
+    ingestor.poll()
+    assert not os.path.exists(ingestor.path_drained)
+
+
+def test_restart_while_drained_file_is_open(tmp_path):
+    path_commands = tmp_path / "PrinterCommands.csv"
+    append(path_commands, header + "10.0.0.1,home,\n")
+    ingestor = CommandIngestor(path_commands)
+    ingestor.poll()
+    append(ingestor.path_drained, "10.0.0.1,cancel,\n")
+
+    restarted = CommandIngestor(path_commands)
+    assert restarted.poll() == [Command("10.0.0.1", "cancel", "")]
+
+
+def test_spool_files_are_read_and_deleted(tmp_path):
+    path_spool = tmp_path / "Spool"
+    path_spool.mkdir()
+    (path_spool / "first.csv").write_text(header + "10.0.0.1,home,\n")
+    (path_spool / "ignored.tmp").write_text(header + "10.0.0.1,cancel,\n")
+    ingestor = CommandIngestor(tmp_path / "PrinterCommands.csv", path_spool=path_spool)
+
+    assert ingestor.poll() == [Command("10.0.0.1", "home", "")]
+    assert sorted(os.listdir(path_spool)) == ["ignored.tmp"]
+
+
+def test_semicolon_delimiter_and_sep_line(tmp_path):
+    path_commands = tmp_path / "PrinterCommands.csv"
+    append(path_commands, "sep=;\nCommand;IP_Address;Argument\nprint;10.0.0.1;/api/files/local/a,b.gcode\n")
+    ingestor = CommandIngestor(path_commands, truncateWhenDrained=False)
+    assert ingestor.poll() == [Command("10.0.0.1", "print", "/api/files/local/a,b.gcode")]
+
+    # The delimiter and column order are kept in the journal for lines appended after a restart
+    append(path_commands, "home;10.0.0.2;\n")
+    assert CommandIngestor(path_commands, truncateWhenDrained=False).poll() == [Command("10.0.0.2", "home", "")]
+
+
+def test_connect_all_and_shutdown_are_not_queued_for_one_printer(caplog):
+    router = CommandRouter([SimpleNamespace(ipAddress="10.0.0.1"), SimpleNamespace(ipAddress="10.0.0.2")])
+    commands = [Command("10.0.0.1", "connect", "all"), Command("10.0.0.2", "connect", ""),
+                Command("shutdown", "", ""), Command("10.0.0.9", "connect", ""), Command("10.0.0.9", "home", "")]
+    with caplog.at_level(logging.ERROR, logger="commandingestion"):
+        adminCommands = router.route(commands)
+
+    assert adminCommands == [Command("10.0.0.1", "connect", "all"), Command("shutdown", "", "")]
+    assert router.popCommands("10.0.0.1") == []
+    assert router.popCommands("10.0.0.2") == [Command("10.0.0.2", "connect", "")]
+    assert [record.getMessage() for record in caplog.records] == \
+        ["Command for unknown printer 10.0.0.9 dropped: connect", "Command for unknown printer 10.0.0.9 dropped: home"]
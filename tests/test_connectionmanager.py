@@ -0,0 +1,86 @@
+from connectionmanager import ConnectionManager
+from printerlist import createClient
+
+import time
+
+
+def makeClients(printers, tmp_path):
+    return [createClient(printer, {"timeout": 0.5, "path_log": str(tmp_path / "Log.txt")}, verbose=False)
+            for printer in printers]
+
+
+def updateUntilReleased(manager, opcs, timeout=10):
+    '''
+    Collect the clients released by the manager until all of opcs are, in the order they were released.
+    '''
+    released = []
+    endTime = time.time() + timeout
+    while len(released) < len(opcs) and time.time() < endTime:
+        released.extend(manager.update())
+        time.sleep(0.02)
+    return released
+
+
+def test_only_connecting_printers_are_held_back(simulator, tmp_path):
+    simulatedPrinters = list(simulator.printers.values())
+    for printer in simulatedPrinters[1:]:
+        printer.connected = False
+        printer.connectDuration = 0.5
+    opcs = makeClients(simulator.getPrinterList(), tmp_path)
+    manager = ConnectionManager(maxWorkers=4, deadline=10, checkInterval=0.1)
+    try:
+        startTime = time.time()
+        manager.connect(opcs)
+        # connect() returns right away, before any printer has become operational
+        assert time.time() - startTime < 0.5
+        assert all(manager.isHeldBack(opc) for opc in opcs)
+        assert manager.getDeadline(opcs[0]) == manager.startTimes[opcs[0].ipAddress] + 10
+
+        released = updateUntilReleased(manager, opcs)
+        assert released[0] is opcs[0]
+        assert set(released) == set(opcs)
+        assert not any(manager.isHeldBack(opc) for opc in opcs)
+        assert all(printer.isOperational() for printer in simulatedPrinters)
+        assert manager.getDeadline(opcs[1]) is None
+    finally:
+        manager.shutdown()
+        for opc in opcs:
+            opc.close()
+
+
+def test_printer_is_given_up_on_after_its_deadline(simulator, tmp_path):
+    printer = list(simulator.printers.values())[0]
+    printer.connected = False
+    printer.connectDuration = 60
+    opcs = makeClients(simulator.getPrinterList()[:1], tmp_path)
+    manager = ConnectionManager(deadline=0.3, checkInterval=0.05)
+    try:
+        manager.connect(opcs)
+        assert updateUntilReleased(manager, opcs) == opcs
+        assert not printer.isOperational()
+        assert not manager.isHeldBack(opcs[0])
+    finally:
+        manager.shutdown()
+        opcs[0].close()
+
+
+def test_tracked_printer_is_checked_without_a_connect_request(simulator, tmp_path):
+    printer = list(simulator.printers.values())[0]
+    printer.connected = False
+    opcs = makeClients(simulator.getPrinterList()[:1], tmp_path)
+    manager = ConnectionManager(deadline=10, checkInterval=0.05)
+    try:
+        # A connect command sent from the command file is tracked, but not sent again
+        manager.track(opcs[0])
+        assert manager.isHeldBack(opcs[0])
+        assert manager.update() == []
+        printer.connected = True
+        assert updateUntilReleased(manager, opcs) == opcs
+
+        manager.track(opcs[0])
+        manager.forget(opcs[0])
+        assert not manager.isHeldBack(opcs[0])
+        assert manager.update() == []
+    finally:
+        manager.shutdown()
+        opcs[0].close()
@@ -0,0 +1,69 @@
+from coordinator import runShard, shardPrinters
+
+import metrics
+
+import threading
+import queue
+
+
+def makePrinter(ipAddress, rackID):
+    return {"ipAddress": ipAddress, "apiKey": "KEY", "username": "user", "password": "password", "rackID": rackID,
+            "xPos": 1, "yPos": 1}
+
+
+def runOneCycle(printers, settings):
+    '''
+    Run a shard worker in a thread until its first report, and return the report.
+    '''
+    commandQueue, statusQueue = queue.Queue(), queue.Queue()
+    worker = threading.Thread(target=runShard, args=(0, printers, settings, commandQueue, statusQueue))
+    worker.start()
+    try:
+        return statusQueue.get(timeout=10)
+    finally:
+        commandQueue.put(None)
+        worker.join(10)
+
+
+def makeSettings(tmp_path, printFinished):
+    return {"clientSettings": {"timeout": 0.5, "path_log": str(tmp_path / "Log.txt")}, "pollWorkers": 2,
+            "cycleTime": 0.2, "scheduler": None, "pushEnabled": False, "pushStaleTimeout": 60,
+            "pushReconnectDelay": 5, "startupAutoConnect": False, "connectDeadline": 30, "cacheSettings": None,
+            "verbose": False, "printFinished": printFinished}
+
+
+def test_racks_stay_in_one_shard():
+    printers = [makePrinter("10.0.0." + str(i), i % 3) for i in range(1, 10)]
+    shards = shardPrinters(printers, 2)
+    assert len(shards) == 2
+    assert sorted(len(shard) for shard in shards) == [3, 6]
+    for shard in shards:
+        racks = {printer["rackID"] for printer in shard}
+        assert all(printer["rackID"] not in racks for other in shards if other is not shard for printer in other)
+
+
+def test_shard_keeps_finished_flag_of_unreachable_printer(tmp_path):
+    # Nothing listens on port 1, so every poll fails
+    printer = makePrinter("127.0.0.1:1", 1)
+    settings = makeSettings(tmp_path, {"127.0.0.1:1": "true"})
+    shardIndex, changed, polled, cycleSeconds, connecting, metricsDelta = runOneCycle([printer], settings)
+
+    assert polled == 1
+    assert changed[0].connected is None
+    assert changed[0].printFinished == "true"
+
+
+def test_shard_metrics_are_merged_by_the_parent(simulator, tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "registry", metrics.Registry())
+    monkeypatch.setattr(metrics, "enabled", False)
+    printer = simulator.getPrinterList()[0]
+    settings = dict(makeSettings(tmp_path, {}), metricsEnabled=True)
+    report = runOneCycle([printer], settings)
+
+    parentRegistry = metrics.Registry()
+    parentRegistry.merge(report[5])
+    parentRegistry.merge(report[5])
+    text = parentRegistry.render()
+    assert ('opc_http_request_seconds_count{endpoint="/api/printer",method="GET",printer="' + printer["ipAddress"] +
+            '"} 2') in text
+    assert 'opc_phase_seconds_count{phase="poll"} 2' in text
@@ -0,0 +1,32 @@
+from csvreader import readCsv, readCsvRecords, sniffDelimiter
+
+import pytest
+
+
+def test_delimiter_is_inferred_from_the_first_line():
+    assert sniffDelimiter("ipAddress;apiKey;rackID") == ";"
+    assert sniffDelimiter("ipAddress,apiKey,rackID") == ","
+    assert sniffDelimiter("ipAddress", default=";") == ";"
+
+
+def test_semicolon_file_with_blank_lines_and_quotes(tmp_path):
+    path_csv = tmp_path / "ListOfPrinters.csv"
+    path_csv.write_text('ipAddress ; apiKey;comment\n10.0.0.1;KEY1;"rack 1; left"\n\n ; ;\n10.0.0.2;KEY2;\n')
+    header, rows = readCsv(path_csv)
+    assert header == ["ipAddress", "apiKey", "comment"]
+    assert rows == [["10.0.0.1", "KEY1", "rack 1; left"], ["10.0.0.2", "KEY2", ""]]
+
+
+def test_excel_sep_line(tmp_path):
+    path_csv = tmp_path / "ListOfPrinters.csv"
+    path_csv.write_text("sep=,\nipAddress,apiKey\n10.0.0.1,KEY1\n")
+    assert readCsvRecords(path_csv) == [{"ipAddress": "10.0.0.1", "apiKey": "KEY1"}]
+
+
+def test_builtin_and_pandas_read_the_same_values(tmp_path):
+    pytest.importorskip("pandas")
+    path_csv = tmp_path / "ListOfPrinters.csv"
+    path_csv.write_text("sep=;\nipAddress;apiKey;rackID\n10.0.0.1;KEY1;1\n10.0.0.2;KEY2;2\n")
+    builtin = readCsvRecords(path_csv)
+    pandas = readCsvRecords(path_csv, engine='pandas')
+    assert [{key: str(value) for key, value in record.items()} for record in pandas] == builtin
@@ -0,0 +1,49 @@
+from fleetoperations import fileHash, uploadToFleet
+from printerlist import createClient
+
+import hashlib
+
+
+def makeClients(printers, tmp_path):
+    return [createClient(printer, {"timeout": 0.5, "path_log": str(tmp_path / "Log.txt")}, verbose=False)
+            for printer in printers]
+
+
+def test_upload_and_print_on_every_printer(simulator, tmp_path):
+    path_file = tmp_path / "part.gcode"
+    path_file.write_bytes(b"G28\nG1 X10 Y10\n" * 100)
+    assert fileHash(path_file) == hashlib.sha1(path_file.read_bytes()).hexdigest()
+    unreachable = {"ipAddress": "127.0.0.1:1", "apiKey": "KEY", "username": "user", "password": "password",
+                   "rackID": 1, "xPos": 1, "yPos": 1}
+    opcs = makeClients(simulator.getPrinterList()[:2] + [unreachable], tmp_path)
+    try:
+        results = uploadToFleet(opcs, str(path_file), printAfterSelect=True)
+        assert [result["ipAddress"] for result in results] == [opc.ipAddress for opc in opcs]
+        assert [(result["uploaded"], result["started"]) for result in results] == \
+            [(True, True), (True, True), (False, False)]
+        assert results[2]["error"] is not None
+        for printer in list(simulator.printers.values())[:2]:
+            assert printer.files["part.gcode"][1] == fileHash(path_file)
+            assert printer.getStateText() == "Printing"
+    finally:
+        for opc in opcs:
+            opc.close()
+
+
+def test_identical_files_are_not_uploaded_again(simulator, tmp_path):
+    path_file = tmp_path / "part.gcode"
+    path_file.write_bytes(b"G28\n")
+    opcs = makeClients(simulator.getPrinterList()[:2], tmp_path)
+    try:
+        uploadToFleet(opcs[:1], str(path_file))
+        path_file.write_bytes(b"G28\n" * 2)
+        uploadToFleet(opcs[1:], str(path_file))
+        path_file.write_bytes(b"G28\n")
+
+        results = uploadToFleet(opcs, str(path_file), select=True, skipIdentical=True)
+        assert [(result["skipped"], result["uploaded"], result["selected"]) for result in results] == \
+            [(True, False, True), (False, True, True)]
+        assert [printer.selected for printer in list(simulator.printers.values())[:2]] == ["part.gcode"] * 2
+    finally:
+        for opc in opcs:
+            opc.close()
@@ -0,0 +1,156 @@
+from commandingestion import Command
+from jobdispatcher import JobDispatcher, parseJobTarget
+from printerstatus import PrinterStatus
+
+
+def makeStatus(ipAddress, rackID=1, free=True, printing=False):
+    status = PrinterStatus(ipAddress, rackID, 1, 1)
+    status.connected = True
+    status.ready = free
+    status.printing = printing
+    status.paused = status.pausing = False
+    return status
+
+
+def printCommand(target, gcodePath):
+    return Command(target, "print", "/api/files/local/" + gcodePath)
+
+
+def test_parseJobTarget():
+    assert parseJobTarget("any") == (None, 0)
+    assert parseJobTarget("ANY:10") == (None, 10)
+    assert parseJobTarget("rack:2") == ("2", 0)
+    assert parseJobTarget("rack:2:-1") == ("2", -1)
+    assert parseJobTarget("10.0.0.1") is None
+    assert parseJobTarget("rack:") is None
+    assert parseJobTarget("any:high") is None
+
+
+def test_other_commands_are_passed_through():
+    dispatcher = JobDispatcher()
+    home = Command("10.0.0.1", "home", "")
+    assert dispatcher.submit([home, printCommand("any", "a.gcode")]) == [home]
+    assert dispatcher.getStats()["waiting"] == 1
+
+
+def test_higher_priority_first_then_in_order():
+    dispatcher = JobDispatcher()
+    dispatcher.submit([printCommand("any", "first.gcode"), printCommand("any", "second.gcode"),
+                       printCommand("any:5", "urgent.gcode")])
+    statuses = [makeStatus("10.0.0.1"), makeStatus("10.0.0.2")]
+
+    commands = dispatcher.dispatch(statuses, now=0)
+    assert [command.argument for command in commands] == ["/api/files/local/urgent.gcode",
+                                                          "/api/files/local/first.gcode"]
+    assert dispatcher.getStats()["waiting"] == 1
+
+
+def test_rack_jobs_only_go_to_their_rack():
+    dispatcher = JobDispatcher()
+    dispatcher.submit([printCommand("rack:2", "part.gcode"), printCommand("any", "other.gcode")])
+    statuses = [makeStatus("10.0.0.1", rackID=1), makeStatus("10.0.0.2", rackID=2)]
+
+    commands = dispatcher.dispatch(statuses, now=0)
+    assert sorted(commands) == [Command("10.0.0.1", "print", "/api/files/local/other.gcode"),
+                                Command("10.0.0.2", "print", "/api/files/local/part.gcode")]
+
+
+def test_busy_and_unavailable_printers_get_no_job():
+    dispatcher = JobDispatcher()
+    dispatcher.submit([printCommand("any", "part.gcode")])
+    statuses = [makeStatus("10.0.0.1", free=False, printing=True), makeStatus("10.0.0.2")]
+
+    assert dispatcher.dispatch(statuses, unavailable={"10.0.0.2"}, now=0) == []
+    assert dispatcher.dispatch(statuses, now=1) == [Command("10.0.0.2", "print", "/api/files/local/part.gcode")]
+
+
+def test_job_for_rack_without_printers_is_given_up_at_submit():
+    dispatcher = JobDispatcher()
+    printers = [makeStatus("10.0.0.1", rackID=1)]
+    assert dispatcher.submit([printCommand("rack:99", "part.gcode")], printers) == []
+
+    stats = dispatcher.getStats()
+    assert stats["waiting"] == 0
+    assert stats["failed"] == 1
+
+
+def test_waiting_job_is_given_up_when_its_rack_is_removed():
+    dispatcher = JobDispatcher()
+    dispatcher.submit([printCommand("rack:2", "part.gcode")])
+    busy = makeStatus("10.0.0.2", rackID=2, free=False, printing=True)
+    assert dispatcher.dispatch([busy], now=0) == []
+    assert dispatcher.getStats()["waiting"] == 1
+
+    assert dispatcher.dispatch([makeStatus("10.0.0.1", rackID=1, free=False)], now=1) == []
+    stats = dispatcher.getStats()
+    assert stats["waiting"] == 0
+    assert stats["failed"] == 1
+
+
+def test_job_that_does_not_start_is_requeued_then_given_up():
+    dispatcher = JobDispatcher(startTimeout=10, maxAttempts=2)
+    dispatcher.submit([printCommand("any", "part.gcode")])
+    statuses = [makeStatus("10.0.0.1"), makeStatus("10.0.0.2")]
+
+    first = dispatcher.dispatch(statuses, now=0)
+    assert len(first) == 1
+    assert dispatcher.dispatch(statuses, now=5) == []
+
+    # The first printer never started the job, so it goes to the other one
+    second = dispatcher.dispatch(statuses, now=11)
+    assert len(second) == 1
+    assert second[0].ipAddress != first[0].ipAddress
+    assert dispatcher.getStats()["requeued"] == 1
+
+    assert dispatcher.dispatch(statuses, now=22) == []
+    stats = dispatcher.getStats()
+    assert stats["failed"] == 1
+    assert stats["waiting"] == stats["starting"] == 0
+
+
+def test_started_job_releases_the_printer():
+    dispatcher = JobDispatcher(startTimeout=10)
+    dispatcher.submit([printCommand("any", "part.gcode")])
+    commands = dispatcher.dispatch([makeStatus("10.0.0.1")], now=0)
+    assert len(commands) == 1
+
+    dispatcher.dispatch([makeStatus("10.0.0.1", free=False, printing=True)], now=2)
+    stats = dispatcher.getStats()
+    assert stats["started"] == 1
+    assert stats["starting"] == 0
+
+
+def test_waiting_jobs_survive_a_restart(tmp_path):
+    path_queue = str(tmp_path / "JobQueue.json")
+    dispatcher = JobDispatcher(path_queue)
+    dispatcher.submit([printCommand("any", "low.gcode"), printCommand("rack:2:3", "high.gcode")])
+    dispatcher.save()
+
+    restarted = JobDispatcher(path_queue)
+    assert restarted.getStats()["waiting"] == 2
+    commands = restarted.dispatch([makeStatus("10.0.0.2", rackID=2)], now=0)
+    assert commands == [Command("10.0.0.2", "print", "/api/files/local/high.gcode")]
+
+
+def test_queued_job_is_printed_on_a_free_printer(communicator, simulator):
+    for printer in simulator.printers.values():
+        printer.files["part.gcode"] = (1024, "0" * 40)
+    # One printer is already busy with another print
+    busy = simulator.printers[communicator.opcs[0].ipAddress.split(":")[0]]
+    busy.selected = "other.gcode"
+    busy.printStarted = simulator.startTime
+
+    with open(communicator.path_PrinterCommands, 'w') as commandFile:
+        commandFile.write("IP_Address,Command,Argument\nany,print,/api/files/local/part.gcode\n")
+    communicator.updatePrinterStatus()
+    communicator.processCommands()
+
+    started = [printer for printer in simulator.printers.values() if printer.selected == "part.gcode"]
+    assert len(started) == 1
+    assert started[0].printStarted is not None
+    assert communicator.jobDispatcher.getStats()["dispatched"] == 1
+
+    # Once the print shows up in its status, the printer is no longer reserved
+    communicator.updatePrinterStatus()
+    communicator.processCommands()
+    assert communicator.jobDispatcher.getStats()["started"] == 1
@@ -0,0 +1,86 @@
+import metrics
+
+import urllib.request
+import urllib.error
+import pytest
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    '''
+    A fresh module registry, with metrics disabled, so the tests do not see each other's measurements.
+    '''
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, "registry", registry)
+    monkeypatch.setattr(metrics, "enabled", False)
+    return registry
+
+
+def test_render_in_prometheus_text_format(registry):
+    registry.describe("opc_cycles_total", "Main loop cycles run")
+    registry.increment("opc_cycles_total", amount=3)
+    registry.increment("opc_http_requests_total", (("outcome", "200"), ("printer", 'a"b')))
+    for value in (0.003, 0.2, 20):
+        registry.observe("opc_phase_seconds", value, (("phase", "poll"),))
+
+    lines = registry.render().splitlines()
+    assert lines[:3] == ["# HELP opc_cycles_total Main loop cycles run", "# TYPE opc_cycles_total counter",
+                         "opc_cycles_total 3"]
+    assert 'opc_http_requests_total{outcome="200",printer="a\\"b"} 1' in lines
+    assert 'opc_phase_seconds_bucket{phase="poll",le="0.005"} 1' in lines
+    assert 'opc_phase_seconds_bucket{phase="poll",le="0.25"} 2' in lines
+    assert 'opc_phase_seconds_bucket{phase="poll",le="10.0"} 2' in lines
+    assert 'opc_phase_seconds_bucket{phase="poll",le="+Inf"} 3' in lines
+    assert 'opc_phase_seconds_count{phase="poll"} 3' in lines
+
+
+def test_hooks_only_measure_while_enabled(registry):
+    assert metrics.timer("opc_phase_seconds", phase="poll") is metrics.nullTimer
+    with metrics.timer("opc_phase_seconds", phase="poll"):
+        metrics.increment("opc_cycles_total")
+    assert (registry.counters, registry.histograms) == ({}, {})
+
+    metrics.enable()
+    with metrics.timer("opc_phase_seconds", phase="poll"):
+        metrics.increment("opc_cycles_total")
+    assert registry.counters == {("opc_cycles_total", ()): 1}
+    assert registry.histograms[("opc_phase_seconds", (("phase", "poll"),))].count == 1
+
+
+def test_delta_is_taken_once_and_merged(registry):
+    registry.increment("opc_cycles_total")
+    registry.observe("opc_phase_seconds", 0.2, (("phase", "poll"),))
+    delta = registry.takeDelta()
+    assert registry.takeDelta() == ({}, {})
+
+    parent = metrics.Registry()
+    parent.increment("opc_cycles_total", amount=2)
+    parent.observe("opc_phase_seconds", 0.003, (("phase", "poll"),))
+    parent.merge(delta)
+    assert parent.counters[("opc_cycles_total", ())] == 3
+    histogram = parent.histograms[("opc_phase_seconds", (("phase", "poll"),))]
+    assert (histogram.count, histogram.sum) == (2, pytest.approx(0.203))
+    assert histogram.counts[0] == 1 and histogram.counts[metrics.defaultBuckets.index(0.25)] == 1
+
+
+def test_endpoint_label_leaves_out_file_names():
+    assert metrics.endpointLabel("http://10.0.0.1/api/files/local/part.gcode") == "/api/files"
+    assert metrics.endpointLabel("http://10.0.0.1/api/job") == "/api/job"
+
+
+def test_metrics_endpoint_and_snapshot_file(registry, tmp_path):
+    registry.increment("opc_cycles_total")
+    metrics.writeSnapshot(tmp_path / "metrics.prom")
+    assert (tmp_path / "metrics.prom").read_text() == registry.render()
+
+    server = metrics.MetricsServer(port=0)
+    server.start()
+    try:
+        url = "http://127.0.0.1:" + str(server.server_address[1])
+        with urllib.request.urlopen(url + "/metrics", timeout=5) as response:
+            assert response.read().decode("utf-8") == registry.render()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/other", timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
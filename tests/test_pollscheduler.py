@@ -0,0 +1,133 @@
+from types import SimpleNamespace
+
+from pollscheduler import PollScheduler
+from printerlist import createClient
+from printerstatus import PrinterStatus
+
+
+def makeClient(ipAddress):
+    return SimpleNamespace(ipAddress=ipAddress)
+
+
+def test_unreachable_backoff_doubles_up_to_maxBackoff():
+    scheduler = PollScheduler(normalInterval=4, maxBackoff=30)
+    opc = makeClient("10.0.0.1")
+    scheduler.setClients([opc], now=0)
+    assert scheduler.popDue(now=0) == [opc]
+
+    intervals = []
+    now = 0
+    for _ in range(5):
+        scheduler.reschedule(opc, PrinterStatus(opc.ipAddress, 1, 1, 1), now=now)
+        dueTime = scheduler.nextDue()
+        intervals.append(dueTime - now)
+        now = dueTime
+        assert scheduler.popDue(now=now) == [opc]
+    assert intervals == [8, 16, 30, 30, 30]
+    assert scheduler.isBackedOff(opc)
+
+
+def test_successful_poll_clears_backoff():
+    scheduler = PollScheduler(idleInterval=15)
+    opc = makeClient("10.0.0.1")
+    scheduler.setClients([opc], now=0)
+    scheduler.popDue(now=0)
+    scheduler.reschedule(opc, None, now=0)
+    assert scheduler.isBackedOff(opc)
+
+    scheduler.popDue(now=100)
+    status = PrinterStatus(opc.ipAddress, 1, 1, 1)
+    status.connected = True
+    scheduler.reschedule(opc, status, now=100)
+    assert not scheduler.isBackedOff(opc)
+    assert scheduler.nextDue() == 115
+
+
+def test_rescheduleFailed_only_touches_clients_left_unscheduled():
+    scheduler = PollScheduler(normalInterval=4, idleInterval=15)
+    polled, failed = makeClient("10.0.0.1"), makeClient("10.0.0.2")
+    scheduler.setClients([polled, failed], now=0)
+    due = scheduler.popDue(now=0)
+    assert due == [polled, failed]
+
+    status = PrinterStatus(polled.ipAddress, 1, 1, 1)
+    status.connected = True
+    scheduler.reschedule(polled, status, now=0)
+    scheduler.rescheduleFailed(due, now=0)
+
+    assert scheduler.dueTimes == {polled.ipAddress: 15, failed.ipAddress: 8}
+    assert not scheduler.isBackedOff(polled)
+    assert scheduler.isBackedOff(failed)
+
+
+def test_setClients_forgets_removed_clients():
+    scheduler = PollScheduler()
+    kept, removed = makeClient("10.0.0.1"), makeClient("10.0.0.2")
+    scheduler.setClients([kept, removed], now=0)
+    scheduler.popDue(now=0)
+    scheduler.reschedule(removed, None, now=0)
+
+    scheduler.setClients([kept], now=0)
+    assert removed.ipAddress not in scheduler.dueTimes
+    assert not scheduler.isBackedOff(removed)
+    # A late result for a removed client must not schedule it again
+    scheduler.reschedule(removed, None, now=0)
+    assert removed not in scheduler.popDue(now=1000)
+
+
+def test_read_timeout_marks_printer_unreachable(simulator, tmp_path):
+    simulator.latency = 0.5
+    # The simulator answers after the client has given up, which it would report as a broken pipe. The simulator is
+    # only used by this test, and its handler threads may outlive it, so this is not undone.
+    simulator.handle_error = lambda request, clientAddress: None
+    printer = simulator.getPrinterList()[0]
+    opc = createClient(printer, {"timeout": 0.1, "path_log": str(tmp_path / "Log.txt")}, verbose=False)
+    try:
+        snapshot = opc.getSnapshot()
+        assert snapshot.connected is None
+        assert not opc.reachable
+    finally:
+        opc.close()
+
+
+def test_closed_port_gives_empty_status(tmp_path):
+    printer = {"ipAddress": "127.0.0.1:1", "apiKey": "KEY", "username": "user", "password": "password",
+               "rackID": 1, "xPos": 1, "yPos": 1}
+    opc = createClient(printer, {"timeout": 0.5, "path_log": str(tmp_path / "Log.txt")}, verbose=False)
+    try:
+        snapshot = opc.getSnapshot()
+        assert snapshot.ipAddress == "127.0.0.1:1"
+        assert snapshot.connected is None
+        assert not opc.isReachable()
+    finally:
+        opc.close()
+
+
+def test_failed_snapshot_keeps_printer_scheduled(communicator, monkeypatch):
+    broken = communicator.opcs[0]
+
+    def getSnapshot():
+        raise RuntimeError("simulated bug")
+
+    monkeypatch.setattr(broken, "getSnapshot", getSnapshot)
+    due = communicator.scheduler.popDue()
+    assert len(due) == len(communicator.opcs)
+    communicator.updatePrinterStatus(due)
+
+    assert set(communicator.scheduler.dueTimes) == {opc.ipAddress for opc in communicator.opcs}
+    assert communicator.scheduler.isBackedOff(broken)
+    assert communicator.latestStatus[broken.ipAddress].connected is None
+    for opc in communicator.opcs[1:]:
+        assert communicator.latestStatus[opc.ipAddress].connected is True
+
+
+def test_failed_poll_cycle_keeps_every_printer_scheduled(communicator, monkeypatch):
+    def poll(opcs, pollFunction):
+        raise RuntimeError("simulated bug")
+
+    monkeypatch.setattr(communicator.poller, "poll", poll)
+    due = communicator.scheduler.popDue()
+    communicator.updatePrinterStatus(due)
+
+    assert set(communicator.scheduler.dueTimes) == {opc.ipAddress for opc in communicator.opcs}
+    assert all(communicator.scheduler.isBackedOff(opc) for opc in communicator.opcs)
@@ -0,0 +1,89 @@
+from pushreplay import PushReplayServer, loadRecording
+from printerlist import createClient
+from pushstream import PushStream
+
+import pytest
+import time
+import os
+
+
+path_recording = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pushrecording.jsonl")
+
+
+@pytest.fixture
+def recording():
+    '''
+    The recorded print from the repository, replayed without the pauses between messages.
+    '''
+    return [(min(delay, 0.05), message) for delay, message in loadRecording(path_recording)]
+
+
+def makeClient(port, tmp_path):
+    printer = {"ipAddress": "127.0.0.1:" + str(port), "apiKey": "KEY", "username": "user", "password": "password",
+               "rackID": 1, "xPos": 1, "yPos": 1}
+    return createClient(printer, {"timeout": 2, "path_log": str(tmp_path / "Log.txt")}, verbose=False)
+
+
+def waitFor(condition, timeout=10):
+    endTime = time.time() + timeout
+    while not condition() and time.time() < endTime:
+        time.sleep(0.02)
+    return condition()
+
+
+def test_pushed_status_replaces_polling(recording, tmp_path):
+    server = PushReplayServer(recording, port=0)
+    server.start()
+    opc = makeClient(server.server_address[1], tmp_path)
+    try:
+        opc.subscribe(staleTimeout=60, reconnectDelay=60)
+        assert waitFor(lambda: opc.pushStream.isLive() and opc.pushStream.getStatus().stateText == "Operational" and
+                       opc.pushStream.getStatus().progress == 100.0)
+
+        requestCount = opc.requestCount
+        status = opc.getSnapshot()
+        assert opc.requestCount == requestCount
+        assert (status.connected, status.printing, status.jobName) == (True, False, "example.gcode")
+        assert status.toolTemp is not None
+        # The print finished between two messages, which a poll could have missed
+        assert status.printFinished == "true"
+    finally:
+        opc.close()
+        server.stop()
+
+
+def test_closed_stream_falls_back_to_polling(recording, tmp_path):
+    server = PushReplayServer(recording, port=0, closeAfterReplay=True)
+    server.start()
+    opc = makeClient(server.server_address[1], tmp_path)
+    try:
+        opc.subscribe(staleTimeout=60, reconnectDelay=60)
+        assert waitFor(lambda: opc.pushStream.isLive())
+        assert waitFor(lambda: not opc.pushStream.isLive())
+
+        requestCount = opc.requestCount
+        status = opc.getSnapshot()
+        assert opc.requestCount > requestCount
+        assert status.stateText == "Operational"
+    finally:
+        opc.close()
+        server.stop()
+
+
+def test_status_version_only_changes_with_the_status(recording, tmp_path):
+    opc = makeClient(1, tmp_path)
+    stream = PushStream(opc)
+    printing = [message for delay, message in recording if "current" in message][0]
+    try:
+        stream.handleMessage(printing)
+        assert stream.live and stream.version == 1
+        assert stream.getStatus().printing
+        stream.handleMessage(printing)
+        assert stream.version == 1
+
+        stream.handleMessage({"event": {"type": "PrintDone", "payload": {}}})
+        assert opc.printFinished == "true"
+        assert stream.version == 2
+        assert stream.getStatus().printFinished == "true"
+    finally:
+        opc.close()
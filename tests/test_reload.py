@@ -0,0 +1,89 @@
+from printerlist import loadPrinterList
+
+import configparser
+import pytest
+
+
+fields = ["ipAddress", "apiKey", "username", "password", "rackID", "xPos", "yPos", "comment"]
+
+
+def writePrinterList(path_list, printers):
+    with open(path_list, 'w') as listFile:
+        listFile.write(",".join(fields) + "\n")
+        for printer in printers:
+            listFile.write(",".join(str(printer.get(field, "")) for field in fields) + "\n")
+
+
+def test_reload_adds_removes_and_updates_printers(communicator, simulator):
+    printers = simulator.getPrinterList()
+    communicator.updatePrinterStatus()
+    kept, removed, edited = communicator.opcs[0], communicator.opcs[1], communicator.opcs[2]
+    assert removed.ipAddress in communicator.latestStatus
+
+    printers[2]["rackID"] = 7
+    newPrinter = dict(printers[0], ipAddress="127.0.0.1:1", apiKey="NEWKEY")
+    writePrinterList(communicator.path_ListOfPrinters, [printers[0], printers[2], printers[3], newPrinter])
+    communicator.reloadPrinterList()
+
+    addresses = [opc.ipAddress for opc in communicator.opcs]
+    assert addresses == [printers[0]["ipAddress"], printers[2]["ipAddress"], printers[3]["ipAddress"],
+                         "127.0.0.1:1"]
+    # Unchanged and edited printers keep their client
+    assert communicator.opcs[0] is kept
+    assert communicator.opcs[1] is edited
+    assert edited.rackID == "7"
+    assert removed.ipAddress not in communicator.latestStatus
+    assert edited.ipAddress not in communicator.latestStatus
+    assert set(communicator.router.clients) == set(addresses)
+    assert set(communicator.scheduler.clients) == set(addresses)
+
+
+def test_bad_reload_keeps_the_current_printers(communicator, simulator):
+    printers = simulator.getPrinterList()
+    clients = list(communicator.opcs)
+
+    # An editor that has only written part of the file leaves the API key of the last row empty
+    printers[3]["apiKey"] = ""
+    writePrinterList(communicator.path_ListOfPrinters, printers[:2] + printers[3:])
+    communicator.reloadPrinterList()
+    assert communicator.opcs == clients
+
+    writePrinterList(communicator.path_ListOfPrinters, [])
+    communicator.reloadPrinterList()
+    assert communicator.opcs == clients
+
+
+def test_loadPrinterList_leaves_out_bad_rows_unless_strict(tmp_path):
+    path_list = tmp_path / "ListOfPrinters.csv"
+    writePrinterList(path_list, [
+        {"ipAddress": "10.0.0.1", "apiKey": "KEY1", "username": "user", "password": "pw", "rackID": 1, "xPos": 1,
+         "yPos": 1},
+        {"ipAddress": "10.0.0.2", "apiKey": "", "username": "user", "password": "pw", "rackID": 1, "xPos": 2,
+         "yPos": 1},
+    ])
+
+    assert [printer["ipAddress"] for printer in loadPrinterList(path_list)] == ["10.0.0.1"]
+    with pytest.raises(ValueError, match="printer 2 \\(10.0.0.2\\): empty apiKey"):
+        loadPrinterList(path_list, strict=True)
+
+
+def test_reload_resizes_poll_and_connect_workers(communicator, communicatorSettings):
+    oldPoller, oldExecutor = communicator.poller, communicator.connectionManager.executor
+
+    communicatorSettings["Settings"]["PollWorkers"] = "2"
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read_dict(communicatorSettings)
+    with open("config.ini", 'w') as configFile:
+        config.write(configFile)
+    communicator.reloadConfig()
+
+    assert communicator.pollWorkers == 2
+    assert communicator.poller is not oldPoller
+    assert communicator.connectionManager.maxWorkers == 2
+    assert communicator.connectionManager.executor is not oldExecutor
+    assert communicator.connectionManager.executor._max_workers == 2
+
+    # Connect requests still go through after the executor has been replaced
+    communicator.connectionManager.connect(communicator.opcs[:1])
+    communicator.connectionManager.futures[communicator.opcs[0].ipAddress].result(timeout=10)
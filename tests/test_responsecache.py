@@ -0,0 +1,81 @@
+from printerlist import createClient
+from responsecache import ResponseCache
+
+import json
+import time
+
+
+class FakeResponse:
+
+    def __init__(self, body, status_code=200, headers=None):
+        self.content = json.dumps(body).encode("utf-8")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ResponseCache(maxEntries=2, ttls={"/api/files": 60})
+    for name in ("a", "b"):
+        cache.store("http://10.0.0.1/api/files/local/" + name, FakeResponse({"name": name}))
+    # Looking an entry up makes it the most recently used
+    assert cache.lookup("http://10.0.0.1/api/files/local/a")[0] == {"name": "a"}
+    cache.store("http://10.0.0.1/api/files/local/c", FakeResponse({"name": "c"}))
+
+    assert list(cache.entries) == ["http://10.0.0.1/api/files/local/a", "http://10.0.0.1/api/files/local/c"]
+    assert cache.getStats()["evictions"] == 1
+
+
+def test_size_limit_applies_to_the_bodies_held():
+    body = {"name": "x" * 100}
+    size = len(FakeResponse(body).content)
+    cache = ResponseCache(maxBytes=size * 2, ttls={"/api/files": 60})
+    for name in ("a", "b", "c"):
+        cache.store("http://10.0.0.1/api/files/local/" + name, FakeResponse(body))
+    assert (len(cache.entries), cache.size) == (2, size * 2)
+
+    # A body larger than the whole cache is returned, but not kept
+    assert cache.store("http://10.0.0.1/api/files/local/big", FakeResponse({"name": "x" * 1000})) is not None
+    assert "http://10.0.0.1/api/files/local/big" not in cache.entries
+
+
+def test_cache_control_is_followed():
+    cache = ResponseCache(ttls={"/api/files": 60})
+    url = "http://10.0.0.1/api/files/local"
+    cache.store(url, FakeResponse({"files": []}, headers={"Cache-Control": "no-store"}))
+    assert url not in cache.entries
+
+    cache.store(url, FakeResponse({"files": []}, headers={"Cache-Control": "max-age=0", "ETag": '"1"'}))
+    assert cache.lookup(url) == (None, {"If-None-Match": '"1"'})
+
+    # Endpoints without a time to live are not cached at all
+    assert cache.store("http://10.0.0.1/api/job", FakeResponse({})) is None
+    assert cache.getStats()["entries"] == 1
+
+
+def test_stale_response_is_revalidated_with_the_pi(simulator, tmp_path):
+    printer = simulator.getPrinterList()[0]
+    cache = ResponseCache(ttls={"/api/files": 0.2})
+    opc = createClient(printer, {"timeout": 2, "path_log": str(tmp_path / "Log.txt")}, verbose=False,
+                       responseCache=cache)
+    try:
+        files = opc.getFileList()
+        assert files is not None
+        assert opc.getFileList() == files
+        assert opc.requestCount == 1
+
+        time.sleep(0.3)
+        assert opc.getFileList() == files
+        assert opc.requestCount == 2
+        stats = cache.getStats()
+        assert (stats["hits"], stats["revalidated"], stats["misses"]) == (1, 1, 1)
+
+        # Selecting a file invalidates the file data of that printer, so it is fetched in full again
+        opc.invalidateCache()
+        assert cache.getStats()["entries"] == 0
+        assert opc.getFileList() == files
+        assert cache.getStats()["misses"] == 2
+    finally:
+        opc.close()
@@ -0,0 +1,58 @@
+from printerlist import createClient
+
+import time
+
+
+def makeClient(simulator, tmp_path, **settings):
+    printer = simulator.getPrinterList()[0]
+    return createClient(printer, dict({"timeout": 2, "path_log": str(tmp_path / "Log.txt")}, **settings),
+                        verbose=False)
+
+
+def startPrint(simulator, printDuration=600):
+    printer = list(simulator.printers.values())[0]
+    printer.selected = "part.gcode"
+    printer.printDuration = printDuration
+    printer.printStarted = time.time()
+    return printer
+
+
+def test_printing_printer_takes_at_most_half_the_requests(simulator, tmp_path):
+    startPrint(simulator)
+    opc = makeClient(simulator, tmp_path, progressRefreshInterval=2)
+    try:
+        for i in range(12):
+            opc.getSnapshot()
+        # The old path took /api/connection, /api/printer and /api/job for every snapshot: 36 requests
+        assert opc.requestCount == 12 + 4
+    finally:
+        opc.close()
+
+
+def test_progress_is_refetched_every_interval_while_printing(simulator, tmp_path):
+    printer = startPrint(simulator, printDuration=10)
+    opc = makeClient(simulator, tmp_path, progressRefreshInterval=1)
+    try:
+        progress = []
+        for i in range(4):
+            progress.append(opc.getSnapshot().progress)
+            printer.printStarted -= 1           # One second of printing per snapshot
+        assert progress[0] == progress[1] < progress[2] == progress[3]
+    finally:
+        opc.close()
+
+
+def test_job_info_is_refetched_when_the_state_changes(simulator, tmp_path):
+    opc = makeClient(simulator, tmp_path, jobRefreshInterval=10)
+    try:
+        assert opc.getSnapshot().jobName is None
+        requestsBefore = opc.requestCount
+        opc.getSnapshot()
+        assert opc.requestCount == requestsBefore + 1
+
+        startPrint(simulator)
+        status = opc.getSnapshot()
+        assert status.printing
+        assert status.jobName == "part.gcode"
+    finally:
+        opc.close()
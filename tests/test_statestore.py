@@ -0,0 +1,102 @@
+from coordinator import Coordinator
+from printerlist import createClient
+from printerstatus import PrinterStatus
+from statestore import StateStore
+
+import pytest
+
+
+def makeStatus(ipAddress):
+    status = PrinterStatus(ipAddress, 1, 2, 1)
+    status.connected = True
+    status.printing = True
+    status.toolTemp = 210.0
+    status.jobName = "part.gcode"
+    status.progress = 42.0
+    return status
+
+
+def test_state_round_trip(tmp_path):
+    path_store = tmp_path / "PrinterState.db"
+    store = StateStore(path_store)
+    store.update("10.0.0.1", makeStatus("10.0.0.1"), "true", failures=0, now=1000)
+    store.update("10.0.0.2", None, "false", failures=3)
+    assert store.commit() == 2
+    store.close()
+
+    store = StateStore(path_store)
+    state = store.load()
+    assert state["10.0.0.1"]["printFinished"] == "true"
+    assert state["10.0.0.1"]["lastSeen"] == 1000
+    status = state["10.0.0.1"]["status"]
+    assert (status.connected, status.printing, status.toolTemp, status.jobName, status.progress) == \
+        (True, True, 210.0, "part.gcode", 42.0)
+    assert state["10.0.0.2"] == {"status": None, "printFinished": "false", "lastSeen": None, "failures": 3}
+
+    # Nothing is written for printers whose state has not changed
+    store.update("10.0.0.1", status, "true", failures=0)
+    assert store.commit() == 0
+    store.close()
+
+
+def test_compact_deletes_removed_printers(tmp_path):
+    path_store = tmp_path / "PrinterState.db"
+    store = StateStore(path_store)
+    store.update("10.0.0.1", None, "true")
+    store.update("10.0.0.2", None, "true")
+    store.commit()
+    store.compact(["10.0.0.1"])
+    store.close()
+
+    store = StateStore(path_store)
+    assert list(store.load()) == ["10.0.0.1"]
+    store.close()
+
+
+@pytest.fixture
+def communicatorSettings(communicatorSettings):
+    communicatorSettings["State"] = {"Enabled": "True", "File": "PrinterState.db"}
+    return communicatorSettings
+
+
+def test_failed_snapshot_keeps_stored_finished_flag(communicator, monkeypatch):
+    finished = communicator.opcs[0]
+    finished.printFinished = "true"
+
+    def getSnapshot():
+        raise RuntimeError("simulated bug")
+
+    monkeypatch.setattr(finished, "getSnapshot", getSnapshot)
+    communicator.updatePrinterStatus()
+    communicator.saveState()
+    assert communicator.latestStatus[finished.ipAddress].printFinished == "true"
+
+    store = StateStore("PrinterState.db")
+    assert store.load()[finished.ipAddress]["printFinished"] == "true"
+    store.close()
+
+
+def test_coordinator_keeps_stored_finished_flag(tmp_path):
+    path_store = tmp_path / "PrinterState.db"
+    store = StateStore(path_store)
+    store.update("127.0.0.1:1", None, "true")
+    store.close()
+
+    printer = {"ipAddress": "127.0.0.1:1", "apiKey": "KEY", "username": "user", "password": "password",
+               "rackID": 1, "xPos": 1, "yPos": 1}
+    store = StateStore(path_store)
+    coordinator = Coordinator([printer], 1, {}, stateStore=store)
+    assert coordinator.printFinished == {"127.0.0.1:1": "true"}
+
+    # A worker reports a snapshot of the printer after its Pi has gone away
+    opc = createClient(printer, {"timeout": 0.5, "path_log": str(tmp_path / "Log.txt")}, verbose=False)
+    opc.printFinished = coordinator.printFinished["127.0.0.1:1"]
+    coordinator.statusQueue.put((0, [opc.getSnapshot()], 1, 0.1, [], None))
+    opc.close()
+    coordinator.receive(0.5)
+    coordinator.export()
+    store.close()
+
+    store = StateStore(path_store)
+    assert store.load()["127.0.0.1:1"]["printFinished"] == "true"
+    store.close()
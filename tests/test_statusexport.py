@@ -0,0 +1,160 @@
+from printerstatus import PrinterStatus, opcStatusFields
+from statusexport import CsvStatusWriter, MmapStatusWriter, mmapHeaderFormat, readMmapStatus
+
+import logging
+import pytest
+import struct
+import math
+import os
+
+
+def makeStatus(ipAddress, toolTemp=210.0):
+    status = PrinterStatus(ipAddress, 1, 2, 3)
+    status.connected = True
+    status.printing = True
+    status.toolTemp = toolTemp
+    status.bedTemp = 60.0
+    status.jobName = "part.gcode"
+    status.progress = 42.0
+    return status
+
+
+def test_csv_is_only_written_when_a_row_changes(tmp_path):
+    path_status = tmp_path / "PrinterStatus.csv"
+    writer = CsvStatusWriter(path_status)
+    statuses = [makeStatus("10.0.0.1"), PrinterStatus("10.0.0.2")]
+
+    assert writer.write(statuses)
+    lines = path_status.read_text().splitlines()
+    assert lines[0] == opcStatusFields
+    assert lines[1:] == [status.toCsvRow() for status in statuses]
+    inode = os.stat(path_status).st_ino
+
+    assert not writer.write([makeStatus("10.0.0.1"), PrinterStatus("10.0.0.2")])
+    assert (writer.writeCount, writer.skipCount, writer.lastBytesWritten) == (1, 1, 0)
+    assert os.stat(path_status).st_ino == inode
+
+    # A new order of the same rows is a change
+    assert writer.write(list(reversed(statuses)))
+    assert path_status.read_text().splitlines()[1] == "10.0.0.2;None;;;;;;;;;;;;"
+    assert not os.path.exists(writer.path_temp)
+
+
+def test_failed_write_leaves_the_last_csv_in_place(tmp_path, monkeypatch):
+    path_status = tmp_path / "PrinterStatus.csv"
+    writer = CsvStatusWriter(path_status)
+    writer.write([makeStatus("10.0.0.1")])
+    published = path_status.read_text()
+
+    def fsync(fileDescriptor):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "fsync", fsync)
+    with pytest.raises(OSError):
+        writer.write([makeStatus("10.0.0.1", toolTemp=215.0)])
+    assert path_status.read_text() == published
+
+    # The rows were not published, so the next cycle writes them again
+    monkeypatch.undo()
+    assert writer.write([makeStatus("10.0.0.1", toolTemp=215.0)])
+    assert "215.0" in path_status.read_text()
+
+
+def test_replace_is_retried_while_the_csv_is_locked(tmp_path, monkeypatch):
+    path_status = tmp_path / "PrinterStatus.csv"
+    writer = CsvStatusWriter(path_status, replaceAttempts=3, replaceDelay=0)
+    replace = os.replace
+    attempts = []
+
+    def lockedReplace(source, destination):
+        attempts.append(destination)
+        if len(attempts) < 3:
+            raise PermissionError("file is open in the IPC")
+        replace(source, destination)
+
+    monkeypatch.setattr(os, "replace", lockedReplace)
+    assert writer.write([makeStatus("10.0.0.1")])
+    assert len(attempts) == 3
+    assert path_status.read_text().splitlines()[1] == makeStatus("10.0.0.1").toCsvRow()
+
+
+def test_binary_status_round_trip(tmp_path):
+    path_status = tmp_path / "PrinterStatus.bin"
+    writer = MmapStatusWriter(path_status, slotCount=4)
+    finished = makeStatus("10.0.0.1")
+    finished.printing = False
+    finished.printFinished = "true"
+    try:
+        assert writer.write([finished, PrinterStatus("10.0.0.2")])
+        records = readMmapStatus(path_status)
+    finally:
+        writer.close()
+
+    assert [record["ipAddress"] for record in records] == ["10.0.0.1", "10.0.0.2"]
+    assert records[0]["reachable"] and records[0]["connected"] and records[0]["finished"]
+    assert not records[0]["printing"]
+    assert (records[0]["nozzleTemp"], records[0]["bedTemp"], records[0]["progress"]) == (210.0, 60.0, 42.0)
+    assert (records[0]["rackID"], records[0]["xPos"], records[0]["yPos"]) == (1, 2, 3)
+    assert records[0]["printJob"] == "part.gcode"
+    assert not records[1]["reachable"]
+    assert math.isnan(records[1]["nozzleTemp"])
+    assert records[1]["rackID"] == -1
+
+
+def test_record_being_written_is_not_read(tmp_path):
+    path_status = tmp_path / "PrinterStatus.bin"
+    writer = MmapStatusWriter(path_status, slotCount=2)
+    try:
+        writer.write([makeStatus("10.0.0.1"), makeStatus("10.0.0.2")])
+        offset = mmapHeaderFormat.size
+        sequence = struct.unpack_from("<I", writer.map, offset)[0]
+        assert sequence == 2
+
+        # The writer stopped between the two sequence updates of the first record
+        struct.pack_into("<I", writer.map, offset, sequence + 1)
+        writer.map.flush()
+        assert [record["ipAddress"] for record in readMmapStatus(path_status, retries=3)] == ["10.0.0.2"]
+
+        # Unchanged records are not written, so their sequence stays the same
+        struct.pack_into("<I", writer.map, offset, sequence)
+        assert not writer.write([makeStatus("10.0.0.1"), makeStatus("10.0.0.2")])
+        assert struct.unpack_from("<I", writer.map, offset)[0] == sequence
+    finally:
+        writer.close()
+
+
+def test_slot_of_removed_printer_is_reused(tmp_path):
+    path_status = tmp_path / "PrinterStatus.bin"
+    writer = MmapStatusWriter(path_status, slotCount=3)
+    try:
+        writer.write([makeStatus("10.0.0.1"), makeStatus("10.0.0.2"), makeStatus("10.0.0.3")])
+        writer.write([makeStatus("10.0.0.1"), makeStatus("10.0.0.3")])
+        assert [record["ipAddress"] for record in readMmapStatus(path_status)] == ["10.0.0.1", "10.0.0.3"]
+
+        writer.write([makeStatus("10.0.0.1"), makeStatus("10.0.0.3"), makeStatus("10.0.0.4")])
+        assert writer.slots == {"10.0.0.1": 0, "10.0.0.3": 2, "10.0.0.4": 1}
+        assert writer.usedSlots == 3
+        assert [record["ipAddress"] for record in readMmapStatus(path_status)] == \
+            ["10.0.0.1", "10.0.0.4", "10.0.0.3"]
+    finally:
+        writer.close()
+
+
+def test_full_binary_status_file_is_logged_once_per_printer(tmp_path, caplog):
+    path_status = tmp_path / "PrinterStatus.bin"
+    writer = MmapStatusWriter(path_status, slotCount=1)
+    statuses = [makeStatus("10.0.0.1"), makeStatus("10.0.0.2")]
+    try:
+        with caplog.at_level(logging.ERROR, logger="statusexport"):
+            for cycle in range(3):
+                writer.write(statuses)
+            assert [record.getMessage() for record in caplog.records] == \
+                ["Binary status file is full, no slot for 10.0.0.2"]
+
+            # A printer that left the list and was added again is logged again
+            writer.write(statuses[:1])
+            writer.write(statuses)
+            assert [record.getMessage() for record in caplog.records] == \
+                ["Binary status file is full, no slot for 10.0.0.2"] * 2
+    finally:
+        writer.close()
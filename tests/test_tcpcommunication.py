@@ -0,0 +1,111 @@
+from commandingestion import Command
+from printerstatus import PrinterStatus, opcStatusFields
+from tcpcommunication import CommandServer
+
+import threading
+import socket
+import pytest
+import time
+
+
+@pytest.fixture
+def server():
+    server = CommandServer(port=0)
+    server.setAddresses(["10.0.0.1"])
+    server.start()
+    yield server
+    server.stop()
+
+
+class Client:
+
+    def __init__(self, server):
+        self.socket = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+        self.file = self.socket.makefile('r', encoding="utf-8")
+
+    def send(self, line):
+        self.socket.sendall((line + "\n").encode("utf-8"))
+
+    def readLine(self):
+        return self.file.readline().rstrip("\n")
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def makeStatus(ipAddress, toolTemp):
+    status = PrinterStatus(ipAddress, 1, 1, 1)
+    status.connected = True
+    status.toolTemp = toolTemp
+    return status
+
+
+def test_commands_are_acknowledged_and_queued(server):
+    client = Client(server)
+    try:
+        client.send("PING")
+        assert client.readLine() == "PONG"
+        client.send("10.0.0.1;print;/api/files/local/part.gcode")
+        assert client.readLine() == "ACK 1"
+        client.send("10.0.0.9,connect,all")
+        assert client.readLine() == "ACK 2"
+        client.send("rack:2;print;part.gcode")
+        assert client.readLine() == "ACK 3"
+        # Only connect with "all" may name a printer that is not in the list
+        client.send("10.0.0.9;connect;")
+        assert client.readLine() == "ERR unknown printer 10.0.0.9"
+        client.send("10.0.0.1")
+        assert client.readLine().startswith("ERR")
+
+        assert server.waitForCommands(1)
+        assert server.popCommands() == [Command("10.0.0.1", "print", "/api/files/local/part.gcode"),
+                                        Command("10.0.0.9", "connect", "all"),
+                                        Command("rack:2", "print", "part.gcode")]
+        assert not server.commandEvent.is_set()
+    finally:
+        client.close()
+
+
+def test_waiting_main_loop_is_woken_by_a_command(server):
+    client = Client(server)
+    try:
+        sender = threading.Timer(0.1, client.send, ["10.0.0.1;home;"])
+        sender.start()
+        startTime = time.time()
+        assert server.waitForCommands(5)
+        assert time.time() - startTime < 2
+        sender.join()
+    finally:
+        client.close()
+
+
+def test_subscribers_get_changed_rows_only(server):
+    server.publishStatus([makeStatus("10.0.0.1", 200.0), makeStatus("10.0.0.2", 210.0)])
+    subscriber, other = Client(server), Client(server)
+    try:
+        subscriber.send("SUBSCRIBE")
+        assert subscriber.readLine() == "OK"
+        assert [subscriber.readLine(), subscriber.readLine()] == \
+            ["STATUS " + makeStatus("10.0.0.1", 200.0).toCsvRow(), "STATUS " + makeStatus("10.0.0.2", 210.0).toCsvRow()]
+
+        server.publishStatus([makeStatus("10.0.0.1", 200.0), makeStatus("10.0.0.2", 215.0)])
+        assert subscriber.readLine() == "STATUS " + makeStatus("10.0.0.2", 215.0).toCsvRow()
+        server.publishStatus([makeStatus("10.0.0.2", 215.0)])
+        assert subscriber.readLine() == "REMOVED 10.0.0.1"
+
+        other.send("STATUS")
+        assert [other.readLine() for i in range(3)] == \
+            ["HEADER " + opcStatusFields, "STATUS " + makeStatus("10.0.0.2", 215.0).toCsvRow(), "END"]
+    finally:
+        subscriber.close()
+        other.close()
+
+
+def test_client_sending_too_long_a_line_is_disconnected(server):
+    client = Client(server)
+    try:
+        client.socket.sendall(b"x" * (server.maxLineLength + 1))
+        assert client.file.readline() == ""
+    finally:
+        client.close()
@@ -0,0 +1,69 @@
+from printerstatus import PrinterStatus
+from timeseries import SeriesRecorder, blockMagic, readSegment
+
+import os
+
+
+def makeStatus(toolTemp, progress):
+    status = PrinterStatus("10.0.0.1", 1, 1, 1)
+    status.connected = True
+    status.printing = True
+    status.bedTemp = 60.0
+    status.toolTemp = toolTemp
+    status.progress = progress
+    return status
+
+
+def recordBlock(recorder, startTime, count):
+    for i in range(count):
+        recorder.record(makeStatus(200.0 + i, i), timestamp=startTime + i * 10)
+    recorder.flush()
+
+
+def getSegment(recorder):
+    segments = recorder.getSeries("10.0.0.1").getSegments()
+    assert len(segments) == 1
+    return segments[0]
+
+
+def test_samples_round_trip(tmp_path):
+    recorder = SeriesRecorder(tmp_path, sampleInterval=10, flushInterval=3600)
+    recordBlock(recorder, 1000000, 5)
+    recorder.record(makeStatus(210.5, 50), timestamp=1000050)
+    # Unreachable printers are not sampled
+    recorder.record(PrinterStatus("10.0.0.1"), timestamp=1000060)
+
+    samples = recorder.query("10.0.0.1")
+    assert samples["time"] == [1000000, 1000010, 1000020, 1000030, 1000040, 1000050]
+    assert samples["toolTemp"] == [200.0, 201.0, 202.0, 203.0, 204.0, 210.5]
+    assert samples["bedTemp"] == [60.0] * 6
+    assert samples["progress"] == [0, 1, 2, 3, 4, 50]
+    assert recorder.query("10.0.0.1", 1000020, 1000040)["time"] == [1000020, 1000030]
+
+
+def test_torn_block_is_skipped(tmp_path):
+    recorder = SeriesRecorder(tmp_path, sampleInterval=10, flushInterval=3600)
+    recordBlock(recorder, 1000000, 3)
+    path_segment = getSegment(recorder)
+    intactSize = os.path.getsize(path_segment)
+    recordBlock(recorder, 2000000, 3)
+
+    # Power loss during the second flush: only part of its block reached the disk, then the next run appended more
+    with open(path_segment, 'r+b') as segmentFile:
+        segmentFile.truncate(intactSize + 20)
+    recordBlock(recorder, 3000000, 2)
+
+    assert list(readSegment(path_segment)[0]) == [1000000, 1000010, 1000020, 3000000, 3000010]
+
+
+def test_header_bytes_in_column_data_are_not_read_as_a_block(tmp_path):
+    recorder = SeriesRecorder(tmp_path, sampleInterval=10, flushInterval=3600)
+    recordBlock(recorder, 1000000, 3)
+    path_segment = getSegment(recorder)
+
+    # A damaged header, followed by column data that happens to contain the block magic
+    with open(path_segment, 'ab') as segmentFile:
+        segmentFile.write(b"\0" * 5 + blockMagic + b"\x05\x00" + b"\xff" * 60)
+    recordBlock(recorder, 2000000, 1)
+
+    assert list(readSegment(path_segment)[0]) == [1000000, 1000010, 1000020, 2000000]
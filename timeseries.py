@@ -0,0 +1,336 @@
+from array import array
+
+import argparse
+import struct
+import time
+import zlib
+import sys
+import os
+
+'''
+Records temperatures, progress and state flags of every printer as compact time series on disk.
+
+Samples are buffered per printer in column arrays and appended to the printer's current segment file as one block
+per flush. A block holds a small header followed by each column stored contiguously:
+    Header:     magic "OPC2", sample count (uint16), base time (uint32, Unix seconds), CRC32 of the columns (uint32)
+    Columns:    time offset from base (uint16), bed temp (int16, 0.1 degC), nozzle temp (int16, 0.1 degC),
+                flags (uint8), progress (uint8, percent)
+That is 8 bytes per sample. Unknown temperatures are stored as -32768 and unknown progress as 255.
+A block that was only partly written (e.g. power loss during a flush) fails its checksum, and the reader skips ahead
+to the next block header, so the blocks appended after it can still be read. Only blocks that pass their checksum
+are read, so header bytes that happen to occur inside column data are never taken for a block.
+Segment files are rotated at a fixed size, and only the newest segments are kept for each printer.
+'''
+
+blockHeaderFormat = struct.Struct("<4sHII")
+blockMagic = b"OPC2"
+unknownTemp = -32768
+unknownProgress = 255
+bytesPerSample = 8
+
+# Bits in the flags column
+flagConnected = 1 << 0
+flagPrinting = 1 << 1
+flagReady = 1 << 2
+flagOperational = 1 << 3
+flagPausing = 1 << 4
+flagPaused = 1 << 5
+flagFinishing = 1 << 6
+flagFinished = 1 << 7
+
+
+def encodeTemp(value):
+    try:
+        return max(-32767, min(32767, int(round(float(value) * 10))))
+    except (TypeError, ValueError):
+        return unknownTemp
+
+
+def decodeTemp(value):
+    return None if value == unknownTemp else value / 10.0
+
+
+class PrinterSeries:
+
+    def __init__(self, path_series):
+        '''
+        Initialize the series of one printer, stored in the directory path_series.
+        '''
+        self.path_series = path_series
+        self.times = array('I')         # Buffered samples, not flushed yet
+        self.bedTemps = array('h')
+        self.toolTemps = array('h')
+        self.flags = array('B')
+        self.progress = array('B')
+        self.lastSampleTime = 0
+
+
+    def append(self, timestamp, status):
+        flags = 0
+        for value, flag in ((status.connected, flagConnected), (status.printing, flagPrinting),
+                            (status.ready, flagReady), (status.operational, flagOperational),
+                            (status.pausing, flagPausing), (status.paused, flagPaused),
+                            (status.finishing, flagFinishing), (status.printFinished == "true", flagFinished)):
+            if value:
+                flags |= flag
+        self.times.append(int(timestamp))
+        self.bedTemps.append(encodeTemp(status.bedTemp))
+        self.toolTemps.append(encodeTemp(status.toolTemp))
+        self.flags.append(flags)
+        self.progress.append(unknownProgress if status.progress is None else max(0, min(100, int(status.progress))))
+        self.lastSampleTime = timestamp
+
+
+    def getSegments(self):
+        '''
+        Returns the paths of this printer's segment files, oldest first.
+        '''
+        try:
+            names = sorted(name for name in os.listdir(self.path_series) if name.endswith(".seg"))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.path_series, name) for name in names]
+
+
+    def flush(self, segmentSize, maxSegments):
+        '''
+        Append the buffered samples to the current segment as blocks, rotating and pruning segments as needed.
+        Returns the number of bytes written.
+        '''
+        if not self.times:
+            return 0
+        os.makedirs(self.path_series, exist_ok=True)
+        segments = self.getSegments()
+        if not segments or os.path.getsize(segments[-1]) >= segmentSize:
+            segments.append(os.path.join(self.path_series, "%010d.seg" % self.times[0]))
+
+        written = 0
+        with open(segments[-1], 'ab') as segmentFile:
+            start = 0
+            while start < len(self.times):
+                # A block covers at most 65535 samples and 65535 seconds, as counts and offsets are 16 bit
+                baseTime = self.times[start]
+                end = start
+                while end < len(self.times) and end - start < 65535 and self.times[end] - baseTime <= 65535:
+                    end += 1
+                columns = [array('H', (t - baseTime for t in self.times[start:end])), self.bedTemps[start:end],
+                           self.toolTemps[start:end], self.flags[start:end], self.progress[start:end]]
+                for column in columns:
+                    if sys.byteorder == "big":
+                        column.byteswap()
+                block = b"".join(column.tobytes() for column in columns)
+                segmentFile.write(blockHeaderFormat.pack(blockMagic, end - start, baseTime, zlib.crc32(block)) + block)
+                written += blockHeaderFormat.size + (end - start) * bytesPerSample
+                start = end
+
+        for path_old in segments[:-maxSegments] if len(segments) > maxSegments else []:
+            os.remove(path_old)
+
+        self.times = array('I')
+        self.bedTemps = array('h')
+        self.toolTemps = array('h')
+        self.flags = array('B')
+        self.progress = array('B')
+        return written
+
+
+def checkBlock(data, position):
+    '''
+    Check the block starting at position.
+    Returns its sample count, base time and the position of its first column, or None if there is no intact block.
+    '''
+    if position + blockHeaderFormat.size > len(data):
+        return None
+    magic, count, baseTime, checksum = blockHeaderFormat.unpack_from(data, position)
+    columnStart = position + blockHeaderFormat.size
+    columnEnd = columnStart + count * bytesPerSample
+    if magic != blockMagic or columnEnd > len(data) or zlib.crc32(data[columnStart:columnEnd]) != checksum:
+        return None
+    return count, baseTime, columnStart
+
+
+def findNextBlock(data, position):
+    '''
+    Returns the position of the next block header at or after position, or the end of data if there is none.
+    '''
+    found = data.find(blockMagic, position)
+    return found if found >= 0 else len(data)
+
+
+def readSegment(path_segment, start=0, end=None):
+    '''
+    Read all samples in a segment file with start <= time < end.
+    Returns column arrays: times (uint32), bed temps, nozzle temps, flags, progress.
+    '''
+    times, bedTemps, toolTemps, flags, progress = array('I'), array('h'), array('h'), array('B'), array('B')
+    with open(path_segment, 'rb') as segmentFile:
+        data = segmentFile.read()
+
+    position = 0
+    while position < len(data):
+        block = checkBlock(data, position)
+        if block is None:
+            # Torn or damaged block: carry on at the next block header
+            position = findNextBlock(data, position + 1)
+            continue
+        count, baseTime, position = block
+        columns = []
+        for typecode in ('H', 'h', 'h', 'B', 'B'):
+            column = array(typecode)
+            column.frombytes(data[position:position + count * column.itemsize])
+            if sys.byteorder == "big":
+                column.byteswap()
+            position += count * column.itemsize
+            columns.append(column)
+
+        if (end is not None and baseTime >= end) or baseTime + 65535 < start:
+            continue
+        for i in range(count):
+            timestamp = baseTime + columns[0][i]
+            if timestamp >= start and (end is None or timestamp < end):
+                times.append(timestamp)
+                bedTemps.append(columns[1][i])
+                toolTemps.append(columns[2][i])
+                flags.append(columns[3][i])
+                progress.append(columns[4][i])
+    return times, bedTemps, toolTemps, flags, progress
+
+
+class SeriesRecorder:
+
+    def __init__(self, path_directory, sampleInterval=10, flushInterval=60, segmentSize=262144, maxSegments=8):
+        '''
+        Initialize a recorder storing one series per printer under path_directory.
+        At most one sample per printer is kept every sampleInterval seconds, and buffered samples are written to
+        disk every flushInterval seconds. Segments are rotated at segmentSize bytes, and the newest maxSegments
+        segments of each printer are kept. At the defaults, that is about 30 days of history per printer.
+        '''
+        self.path_directory = str(path_directory)
+        self.sampleInterval = sampleInterval
+        self.flushInterval = flushInterval
+        self.segmentSize = segmentSize
+        self.maxSegments = maxSegments
+        self.series = {}                # PrinterSeries for each IP address
+        self.lastFlush = time.time()
+        self.lastBytesWritten = 0
+
+
+    def getSeries(self, ipAddress):
+        series = self.series.get(ipAddress)
+        if series is None:
+            safeName = "".join(c if c.isalnum() or c in ".-" else "_" for c in str(ipAddress))
+            series = self.series[ipAddress] = PrinterSeries(os.path.join(self.path_directory, safeName))
+        return series
+
+
+    def record(self, status, timestamp=None):
+        '''
+        Add a sample from a PrinterStatus, unless the printer was sampled less than sampleInterval seconds ago.
+        Printers whose Pi could not be reached are not sampled.
+        '''
+        if status.connected is None:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        series = self.getSeries(status.ipAddress)
+        if timestamp - series.lastSampleTime >= self.sampleInterval:
+            series.append(timestamp, status)
+        if timestamp - self.lastFlush >= self.flushInterval:
+            self.flush()
+
+
+    def flush(self):
+        '''
+        Write all buffered samples to disk.
+        '''
+        self.lastBytesWritten = sum(series.flush(self.segmentSize, self.maxSegments)
+                                    for series in self.series.values())
+        self.lastFlush = time.time()
+
+
+    def query(self, ipAddress, start=0, end=None):
+        '''
+        Read the samples of one printer with start <= time < end (Unix seconds), buffered samples included.
+        Returns a dictionary of lists: time, bedTemp, toolTemp (degC or None), flags, progress (percent or None).
+        '''
+        series = self.getSeries(ipAddress)
+        columns = [array('I'), array('h'), array('h'), array('B'), array('B')]
+        for path_segment in series.getSegments():
+            for column, segmentColumn in zip(columns, readSegment(path_segment, start, end)):
+                column.extend(segmentColumn)
+        for i in range(len(series.times)):
+            if series.times[i] >= start and (end is None or series.times[i] < end):
+                for column, bufferColumn in zip(columns, (series.times, series.bedTemps, series.toolTemps,
+                                                          series.flags, series.progress)):
+                    column.append(bufferColumn[i])
+
+        return {"time": list(columns[0]),
+                "bedTemp": [decodeTemp(value) for value in columns[1]],
+                "toolTemp": [decodeTemp(value) for value in columns[2]],
+                "flags": list(columns[3]),
+                "progress": [None if value == unknownProgress else value for value in columns[4]]}
+
+
+    def queryRecent(self, ipAddress, seconds):
+        '''
+        Read the samples of one printer from the last given number of seconds.
+        '''
+        return self.query(ipAddress, time.time() - seconds)
+
+
+    def downsample(self, ipAddress, start, end, bucketSeconds):
+        '''
+        Aggregate the samples of one printer into buckets of bucketSeconds.
+        Returns a list of dictionaries, one per non-empty bucket, with the bucket start time, sample count,
+        min/mean/max of both temperatures, the max progress and the fraction of samples spent printing.
+        '''
+        samples = self.query(ipAddress, start, end)
+        buckets = []
+        current = None
+        for i, timestamp in enumerate(samples["time"]):
+            bucketStart = timestamp - (timestamp - start) % bucketSeconds
+            if current is None or current["time"] != bucketStart:
+                current = {"time": bucketStart, "samples": 0, "bed": [], "tool": [], "progress": None, "printing": 0}
+                buckets.append(current)
+            current["samples"] += 1
+            if samples["bedTemp"][i] is not None:
+                current["bed"].append(samples["bedTemp"][i])
+            if samples["toolTemp"][i] is not None:
+                current["tool"].append(samples["toolTemp"][i])
+            if samples["progress"][i] is not None:
+                current["progress"] = max(current["progress"] or 0, samples["progress"][i])
+            if samples["flags"][i] & flagPrinting:
+                current["printing"] += 1
+
+        aggregates = []
+        for bucket in buckets:
+            aggregate = {"time": bucket["time"], "samples": bucket["samples"], "progressMax": bucket["progress"],
+                         "printingFraction": bucket["printing"] / bucket["samples"]}
+            for name in ("bed", "tool"):
+                values = bucket[name]
+                aggregate[name + "Min"] = min(values) if values else None
+                aggregate[name + "Mean"] = sum(values) / len(values) if values else None
+                aggregate[name + "Max"] = max(values) if values else None
+            aggregates.append(aggregate)
+        return aggregates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query recorded printer time series")
+    parser.add_argument("directory", help="recorder directory (Directory under [Recorder] in config.ini)")
+    parser.add_argument("ipAddress", help="printer IP address, as in ListOfPrinters")
+    parser.add_argument("--hours", type=float, default=6, help="how far back to look")
+    parser.add_argument("--bucket", type=int, default=300, help="bucket size in seconds")
+    args = parser.parse_args()
+
+    recorder = SeriesRecorder(args.directory)
+    end = time.time()
+    print("%-20s %7s %7s %7s %7s %7s %9s" % ("Time", "Bed", "BedMax", "Nozzle", "NozMax", "Prog%", "Printing"))
+    for row in recorder.downsample(args.ipAddress, end - args.hours * 3600, end, args.bucket):
+        print("%-20s %7s %7s %7s %7s %7s %9.2f" % (
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["time"])),
+            "-" if row["bedMean"] is None else "%.1f" % row["bedMean"],
+            "-" if row["bedMax"] is None else "%.1f" % row["bedMax"],
+            "-" if row["toolMean"] is None else "%.1f" % row["toolMean"],
+            "-" if row["toolMax"] is None else "%.1f" % row["toolMax"],
+            "-" if row["progressMax"] is None else row["progressMax"],
+            row["printingFraction"]))